@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# Нагрузочный бенчмарк OmniBot без сети.
+#
+# Поднимает в отдельном процессе заглушки Bot API и внешних сервисов
+# (погода, курсы, переводчик, Wikipedia, RSS) с настраиваемой задержкой
+# и долей ошибок, собирает приложение через main.build_application()
+# и прогоняет синтетические Update через настоящие обработчики
+# с заданной параллельностью.
+#
+# Отчёт: обновлений в секунду, p50/p95/p99 полной задержки и отдельно
+# времени работы обработчика (полная задержка минус ожидание очереди чата
+# и слота в процессоре обновлений),
+# прирост памяти на 10 тысяч чатов (сразу и после выгрузки чатов из памяти).
+# Результат сравнивается с базовой линией (bench_baseline.json, лежит в
+# репозитории): линии хранятся по окружениям (ОС, архитектура, Python,
+# число CPU) и сравниваются только прогоны с теми же параметрами.
+# Нет линии для этого окружения — код возврата 2; --save-baseline
+# записывает результат как линию текущего окружения.
+#
+#   python bench.py --updates 20000 --chats 2000 --concurrency 256
+#
+# По умолчанию параллельность прогона равна UPDATE_CONCURRENCY бота: при
+# большей почти вся задержка — ожидание в очереди процессора. Заглушки
+# закрепляются за отдельным ядром, если ядер больше одного.
+#   python bench.py --upstream-latency 0.05 --upstream-error-rate 0.02
+#   python bench.py --storage sqlite --memory-chats 5000
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+from urllib.parse import parse_qs
+
+BENCH_TOKEN = "123456:BENCH"
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# Сценарий одного чата: шаги выполняются по кругу, порядок внутри чата
+# сохраняется процессором обновлений
+SCENARIO = (
+    ("message", "/weather {city}"),
+    ("message", "/rates"),
+    ("message", "/search {city}"),
+    ("message", "/todo add купить молоко"),
+    ("message", "/todo list"),
+    ("message", "/quiz"),
+    ("callback", "quiz_answer"),
+    ("callback", "todo:list"),
+    ("callback", "src:en"),
+    ("callback", "tgt:ru"),
+    ("message", "Hello world. This is a benchmark sentence."),
+)
+
+# ------------------ Заглушки API ------------------
+TELEGRAM_METHODS = ("getMe", "sendMessage", "editMessageText", "editMessageReplyMarkup", "answerCallbackQuery",
+                    "sendChatAction", "deleteWebhook", "setWebhook", "getUpdates")
+
+RSS_FEED = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0"><channel><title>Bench</title>
+<item><title>Bench news</title><link>http://example.com/1</link><guid>1</guid></item>
+</channel></rss>"""
+
+def json_response(payload, status: int = 200) -> tuple:
+    return status, "application/json", json.dumps(payload).encode()
+
+def build_stub_routes(args, stats: dict) -> dict:
+    async def delay(latency: float) -> None:
+        if latency:
+            await asyncio.sleep(latency * random.uniform(1 - args.jitter, 1 + args.jitter))
+
+    def upstream(name: str, payload):
+        async def handler(request):
+            stats[name] = stats.get(name, 0) + 1
+            await delay(args.upstream_latency)
+            if random.random() < args.upstream_error_rate:
+                return json_response({"error": "stub"}, 503)
+            if isinstance(payload, bytes):
+                return 200, "application/rss+xml", payload
+            return json_response(payload)
+        return handler
+
+    message_ids = [0]
+
+    async def telegram(request):
+        method = request.path.rsplit("/", 1)[1]
+        stats[f"telegram.{method}"] = stats.get(f"telegram.{method}", 0) + 1
+        await delay(args.telegram_latency)
+        if random.random() < args.telegram_error_rate:
+            return json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, 500)
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            params = {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+            message_ids[0] += 1
+            result = {"message_id": int(params.get("message_id", message_ids[0])), "date": 0,
+                      "chat": {"id": int(params.get("chat_id", 1)), "type": "private"},
+                      "text": params.get("text", "")}
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+        return json_response({"ok": True, "result": result})
+
+    async def stub_stats(request):
+        return json_response(stats)
+
+    weather = {"cod": 200, "weather": [{"description": "ясно"}], "main": {"temp": 21.5, "humidity": 40}}
+    forecast = {"cod": "200", "list": [{"dt_txt": f"2024-01-01 {hour:02d}:00:00", "main": {"temp": 20},
+                                        "weather": [{"description": "облачно"}]} for hour in range(0, 24, 3)]}
+    fiat = {"rates": {"RUB": 1, "USD": 0.011, "EUR": 0.010, "GBP": 0.0087, "CNY": 0.079, "JPY": 1.6}}
+    crypto = {coin: {"rub": 1000.0 * (i + 1)} for i, coin in enumerate(("bitcoin", "ethereum", "tether", "binancecoin"))}
+    translation = {"responseStatus": 200, "responseData": {"translatedText": "Привет, мир. Это тестовое предложение."}}
+    opensearch = ["query", ["Title"], [""], ["https://ru.wikipedia.org/wiki/Title"]]
+    geo = [{"name": "Москва", "local_names": {"ru": "Москва"}}]
+
+    routes = {
+        ("GET", "/data/2.5/weather"): upstream("weather", weather),
+        ("GET", "/data/2.5/forecast"): upstream("forecast", forecast),
+        ("GET", "/geo/1.0/reverse"): upstream("geo", geo),
+        ("GET", "/v4/latest/RUB"): upstream("exchange", fiat),
+        ("GET", "/api/v3/simple/price"): upstream("coingecko", crypto),
+        ("GET", "/get"): upstream("translate", translation),
+        ("GET", "/w/api.php"): upstream("wikipedia", opensearch),
+        ("GET", "/rss.xml"): upstream("rss", RSS_FEED),
+        ("GET", "/stats"): stub_stats,
+    }
+    for method in TELEGRAM_METHODS:
+        routes[("POST", f"/bot{BENCH_TOKEN}/{method}")] = telegram
+    return routes
+
+# Процесс с заглушками: отдельный процесс, чтобы их работа не отнимала
+# время у измеряемого event loop
+def run_stub_server(args, conn, stub_core=None) -> None:
+    import main
+
+    async def serve():
+        stats = {}
+        if stub_core is not None:
+            os.sched_setaffinity(0, {stub_core})
+        server = main.HttpServer(build_stub_routes(args, stats), "127.0.0.1", 0, max_concurrency=10000)
+        await server.start()
+        conn.send(server.port)
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)
+        await server.stop(timeout=1)
+        conn.send(stats)
+
+    logging.disable(logging.CRITICAL)
+    asyncio.run(serve())
+
+# ------------------ Синтетические обновления ------------------
+def make_update_data(update_id: int, chat_id: int, kind: str, payload: str, cities: int) -> dict:
+    user = {"id": chat_id, "is_bot": False, "first_name": f"User{chat_id}"}
+    chat = {"id": chat_id, "type": "private"}
+    if kind == "callback":
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": payload,
+            "message": {"message_id": 1, "date": 0, "chat": chat, "text": "menu"},
+        }}
+    text = payload.format(city=f"City{chat_id % cities}")
+    message = {"message_id": update_id, "date": 0, "chat": chat, "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def build_updates(bot, count: int, chats: int, cities: int, first_chat: int = 1, scenario=SCENARIO) -> list:
+    from main import callback_data
+    from telegram import Update
+
+    updates = []
+    for update_id in range(count):
+        chat_id = first_chat + update_id % chats
+        # Чаты начинают сценарий с разных шагов, чтобы в каждом раунде
+        # были представлены все обработчики
+        kind, payload = scenario[(update_id // chats + chat_id) % len(scenario)]
+        if payload == "quiz_answer":
+            payload = callback_data("quiz", "answer", 0, 1)
+        updates.append(Update.de_json(make_update_data(update_id, chat_id, kind, payload, cities), bot))
+    return updates
+
+# ------------------ Прогон ------------------
+# (время прогона, [полная задержка], [время обработчика]); корутина
+# обработчика начинает выполняться, только когда процессор дал ей слот
+async def drive(app, updates: list, concurrency: int) -> tuple:
+    semaphore = asyncio.Semaphore(concurrency)
+    processor = app.update_processor
+    latencies = []
+    service_times = []
+
+    async def serve(update):
+        started = perf_counter()
+        try:
+            await app.process_update(update)
+        finally:
+            service_times.append(perf_counter() - started)
+
+    async def process(update):
+        async with semaphore:
+            started = perf_counter()
+            await processor.process_update(update, serve(update))
+            latencies.append(perf_counter() - started)
+
+    started = perf_counter()
+    await asyncio.gather(*(process(update) for update in updates))
+    return perf_counter() - started, latencies, service_times
+
+def latency_summary(values: list) -> dict:
+    values = sorted(values)
+    return {
+        "p50": round(percentile(values, 0.50) * 1000, 2),
+        "p95": round(percentile(values, 0.95) * 1000, 2),
+        "p99": round(percentile(values, 0.99) * 1000, 2),
+        "max": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+def percentile(values: list, share: float) -> float:
+    return values[min(len(values) - 1, int(share * len(values)))] if values else 0.0
+
+# Прирост памяти процесса на новых чатах (задачи, настройки, user_data),
+# пересчитанный на 10 тысяч чатов
+# Возвращает прирост памяти на 10k чатов сразу после сценария и после
+# принудительной выгрузки чатов из памяти (evict — None, если выгрузки нет)
+async def measure_memory(app, chats: int, first_chat: int, concurrency: int, evict=None) -> tuple:
+    scenario = (("message", "/todo add задача"), ("message", "/settings city {city}"),
+                ("callback", "src:en"), ("callback", "tgt:ru"))
+    updates = build_updates(app.bot, chats * len(scenario), chats, chats, first_chat, scenario)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    await drive(app, updates, concurrency)
+    del updates
+    # Ответы и фоновая запись доделываются после drive(); в замер должно
+    # попасть только то, что остаётся жить
+    await asyncio.sleep(1)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    evicted = None
+    if evict is not None:
+        evict()
+        gc.collect()
+        evicted = (tracemalloc.get_traced_memory()[0] - before) * 10000 / chats
+    tracemalloc.stop()
+    return (after - before) * 10000 / chats, evicted
+
+def evict_all_chats():
+    import main
+
+    idle_ttl, main.CHAT_IDLE_TTL = main.CHAT_IDLE_TTL, -1
+    try:
+        main.evict_chats()
+    finally:
+        main.CHAT_IDLE_TTL = idle_ttl
+
+def counter_total(metrics, name: str) -> int:
+    return int(sum(value for (key, _), value in metrics.counters.items() if key == name))
+
+async def run_bench(args) -> dict:
+    import main
+
+    main.http_client = main.create_http_client()
+    app = main.build_application()
+    await app.initialize()
+    await main.on_startup(app)
+    await app.start()
+    try:
+        if args.warmup:
+            await drive(app, build_updates(app.bot, args.warmup, min(args.warmup, args.chats), args.cities), args.concurrency)
+        updates = build_updates(app.bot, args.updates, args.chats, args.cities)
+        elapsed, latencies, service_times = await drive(app, updates, args.concurrency)
+        del updates
+        memory = evicted = None
+        if args.memory_chats:
+            memory, evicted = await measure_memory(app, args.memory_chats, args.chats + 1, args.concurrency,
+                                                   evict_all_chats if hasattr(main, "evict_chats") else None)
+        result = {
+            "updates": args.updates,
+            "chats": args.chats,
+            "concurrency": args.concurrency,
+            "seconds": round(elapsed, 3),
+            "updates_per_s": round(args.updates / elapsed, 1),
+            "latency_ms": latency_summary(latencies),
+            "service_ms": latency_summary(service_times),
+            "memory_per_10k_chats_mb": round(memory / 2 ** 20, 2) if memory is not None else None,
+            "memory_per_10k_chats_evicted_mb": round(evicted / 2 ** 20, 2) if evicted is not None else None,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "handler_errors": counter_total(main.metrics, "omnibot_handler_errors_total"),
+            "upstream_errors": counter_total(main.metrics, "omnibot_upstream_errors_total"),
+            "caches": {"weather": main.weather_cache.stats(), "translation": main.translation_cache.stats()},
+            "settings": {key: getattr(args, key) for key in ("upstream_latency", "upstream_error_rate",
+                                                             "telegram_latency", "telegram_error_rate", "cities")},
+        }
+    finally:
+        await app.stop()
+        await main.on_shutdown(app)
+        await app.shutdown()
+    return result
+
+# Цифры с другой машины или версии Python сравнивать бессмысленно
+def environment_key() -> str:
+    return (f"{platform.system()}-{platform.machine()}-py{sys.version_info.major}.{sys.version_info.minor}"
+            f"-{os.cpu_count()}cpu")
+
+# Параметры прогона, при которых результаты сравнимы
+def run_parameters(result: dict) -> dict:
+    return {key: result.get(key) for key in ("updates", "chats", "concurrency", "settings")}
+
+def load_baselines(path: str) -> dict:  # {окружение: результат}
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+# Сравнение с базовой линией: падение пропускной способности или рост
+# p95/памяти больше допуска считается регрессией
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    if result["updates_per_s"] < baseline["updates_per_s"] * (1 - tolerance):
+        regressions.append(f"updates/s: {result['updates_per_s']} < {baseline['updates_per_s']}")
+    # Стоимость обработчиков, а не ожидание в очереди: оно шумит от загрузки машины
+    if result["service_ms"]["p95"] > baseline["service_ms"]["p95"] * (1 + tolerance):
+        regressions.append(f"p95 обработчика: {result['service_ms']['p95']} ms > {baseline['service_ms']['p95']} ms")
+    memory, baseline_memory = result.get("memory_per_10k_chats_mb"), baseline.get("memory_per_10k_chats_mb")
+    if memory is not None and baseline_memory and memory > baseline_memory * (1 + tolerance):
+        regressions.append(f"память на 10k чатов: {memory} MB > {baseline_memory} MB")
+    return regressions
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк OmniBot с заглушками внешних API")
+    parser.add_argument("--updates", type=int, default=20000, help="число обновлений в замере")
+    parser.add_argument("--chats", type=int, default=2000, help="число разных чатов")
+    parser.add_argument("--cities", type=int, default=200, help="число разных городов (влияет на попадания в кэш)")
+    parser.add_argument("--concurrency", type=int, default=None,
+                        help="обновлений в обработке одновременно; по умолчанию — UPDATE_CONCURRENCY бота")
+    parser.add_argument("--warmup", type=int, default=500, help="обновлений на прогрев")
+    parser.add_argument("--storage", choices=("memory", "sqlite"), default="memory",
+                        help="хранилище бота; с memory выгруженные чаты остаются в памяти процесса")
+    parser.add_argument("--memory-chats", type=int, default=2000, help="новых чатов для замера памяти; 0 — не мерить")
+    parser.add_argument("--upstream-latency", type=float, default=0.02, help="задержка внешних API, с")
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0, help="доля ответов 503 от внешних API")
+    parser.add_argument("--telegram-latency", type=float, default=0.01, help="задержка Bot API, с")
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="доля ответов 500 от Bot API")
+    parser.add_argument("--telegram-limits", action="store_true", help="не снимать лимиты отправки Telegram")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержек, доля от среднего")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="файл базовой линии")
+    parser.add_argument("--save-baseline", action="store_true", help="записать результат как базовую линию текущего окружения")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое отклонение от базовой линии")
+    parser.add_argument("--verbose", action="store_true", help="не глушить логи бота")
+    return parser.parse_args(argv)
+
+def main_cli(argv=None) -> int:
+    args = parse_args(argv)
+    context = multiprocessing.get_context("spawn")
+    parent_conn, child_conn = context.Pipe()
+    # Заглушки на своём ядре не отнимают время у измеряемого event loop;
+    # на одном ядре они его делят — это записывается в результат
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    stub_core = cores[-1] if len(cores) > 1 else None
+    stub = context.Process(target=run_stub_server, args=(args, child_conn, stub_core), daemon=True)
+    stub.start()
+    if stub_core is not None:
+        os.sched_setaffinity(0, set(cores[:-1]))
+    stub_port = parent_conn.recv()
+    stub_url = f"http://127.0.0.1:{stub_port}"
+
+    # Конфигурация main.py читается при импорте, поэтому окружение
+    # выставляется до него
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "OPENWEATHER_API_KEY": "bench",
+        "TELEGRAM_API_URL": stub_url,
+        "OPENWEATHER_API_URL": stub_url,
+        "EXCHANGE_API_URL": stub_url,
+        "COINGECKO_API_URL": stub_url,
+        "TRANSLATE_API_URL": stub_url,
+        "WIKIPEDIA_API_URL": stub_url,
+        "NEWS_FEED_URL": f"{stub_url}/rss.xml",
+        "STORAGE_BACKEND": args.storage,
+        "STORAGE_PATH": os.path.join(tempfile.mkdtemp(prefix="omnibot-bench-"), "bot.db"),
+        "TRANSLATION_CACHE_PATH": "",
+        "METRICS_PORT": "0",
+    })
+    if not args.telegram_limits:
+        # Лимиты Telegram мерили бы лимитер, а не обработку обновлений
+        os.environ.update({"SEND_GLOBAL_RATE": "1000000", "SEND_PER_CHAT_RATE": "1000000",
+                           "SEND_PER_CHAT_BURST": "1000000"})
+    import main  # импорт после настройки окружения
+    if args.concurrency is None:
+        args.concurrency = main.UPDATE_CONCURRENCY
+    if not args.verbose:
+        logging.disable(logging.ERROR)
+
+    try:
+        result = asyncio.run(run_bench(args))
+    finally:
+        parent_conn.send("stop")
+        result_stats = parent_conn.recv() if parent_conn.poll(5) else {}
+        stub.join(timeout=5)
+    result["stub_calls"] = result_stats
+    result["environment"] = {"python": platform.python_version(), "platform": platform.platform(),
+                             "cpus": os.cpu_count(), "stub_on_separate_core": stub_core is not None,
+                             "date": datetime.now().isoformat(timespec="seconds")}
+
+    print(f"Обновлений: {result['updates']} за {result['seconds']} с — {result['updates_per_s']} upd/s")
+    for title, key in (("Задержка", "latency_ms"), ("Обработчик", "service_ms")):
+        latency = result[key]
+        print(f"{title}, мс: p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']}")
+    if stub_core is None:
+        print("Заглушки делят ядро с ботом: задержки завышены их работой")
+    if result["memory_per_10k_chats_mb"] is not None:
+        print(f"Память на 10k чатов: {result['memory_per_10k_chats_mb']} MB, после выгрузки "
+              f"{result['memory_per_10k_chats_evicted_mb']} MB (max RSS {result['max_rss_mb']} MB)")
+    print(f"Ошибки: обработчики={result['handler_errors']} внешние API={result['upstream_errors']}")
+
+    baselines = load_baselines(args.baseline)
+    environment = environment_key()
+    if args.save_baseline:
+        baselines[environment] = result
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Базовая линия для {environment} сохранена: {args.baseline}")
+        return 0
+    baseline = baselines.get(environment)
+    if baseline is None:
+        print(f"Нет базовой линии для окружения {environment} в {args.baseline} — "
+              f"сравнить не с чем; запустите с --save-baseline")
+        return 2
+    if run_parameters(result) != run_parameters(baseline):
+        print(f"Параметры прогона {run_parameters(result)} отличаются от базовой линии "
+              f"{run_parameters(baseline)} — сравнить не с чем")
+        return 2
+    regressions = compare(result, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"РЕГРЕССИЯ: {regression}")
+    if not regressions:
+        print("Регрессий относительно базовой линии нет.")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
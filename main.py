@@ -1,50 +1,262 @@
-import nest_asyncio
-nest_asyncio.apply()
+from time import monotonic, perf_counter
+STARTUP_STARTED = perf_counter()  # начало импорта модуля — точка отсчёта профиля запуска
 
 import logging
 import os
-import requests
+import sys
+import hmac
+import signal
+import re
+import json
+import hashlib
+import urllib.parse
+import sqlite3
+import threading
 import random
-import feedparser
 import string
 import asyncio
-from datetime import time
+import base64
+import multiprocessing
+import zlib
+import html
+import importlib
+from collections import OrderedDict, deque, namedtuple
+from http import HTTPStatus
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from heapq import heappop, heappush, heapify, nlargest, nsmallest
+from functools import lru_cache, partial, wraps
+from math import asin, ceil, cos, floor, gcd, isfinite, radians, sin, sqrt
+from datetime import datetime, time, timedelta
+from enum import IntEnum
+
+# ------------------ Профиль запуска ------------------
+# Время каждой фазы холодного старта: импорты, инициализация модуля,
+# сборка приложения, загрузка состояния, подключение к Telegram и фоновый
+# прогрев ленивых зависимостей. Отчёт пишется в лог и, если задан
+# STARTUP_PROFILE_PATH, дописывается строкой JSON — для сравнения релизов.
+class StartupProfile:
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.phases = []   # [(фаза, сек), ...] — до готовности принимать обновления
+        self.warm_up = []  # [(что, сек), ...] — фоновый прогрев после старта
+
+    def mark(self, phase: str) -> None:
+        now = perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def ready_in(self) -> float:
+        return self.last - self.started
+
+    def report(self, **extra) -> None:
+        def fmt(items):
+            return ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in items)
+        logger.info("Готов к работе за %.0f мс: %s", self.ready_in() * 1000, fmt(self.phases))
+        if self.warm_up:
+            logger.info("Фоновый прогрев: %s", fmt(self.warm_up))
+        if not STARTUP_PROFILE_PATH:
+            return
+        record = dict(extra, at=datetime.now().isoformat(timespec="seconds"), ready=round(self.ready_in(), 4),
+                      phases={name: round(seconds, 4) for name, seconds in self.phases},
+                      warm_up={name: round(seconds, 4) for name, seconds in self.warm_up})
+        try:
+            with open(STARTUP_PROFILE_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            logger.error("Не удалось записать профиль запуска %s: %s", STARTUP_PROFILE_PATH, e)
+
+startup_profile = StartupProfile(STARTUP_STARTED)
+startup_profile.mark("import stdlib")
+
+import httpx
+startup_profile.mark("import httpx")
 
 from dotenv import load_dotenv
 load_dotenv()  # Загружает переменные из .env
+startup_profile.mark("load_dotenv")
 
 from telegram import (
     Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ReplyKeyboardMarkup,
-    KeyboardButton
+    KeyboardButton,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
 )
-from telegram.constants import ParseMode
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
 )
+startup_profile.mark("import telegram")
 
 # ------------------ Логирование ------------------
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+logging.getLogger("httpx").setLevel(logging.WARNING)  # не логировать каждый запрос к API
 
 # ------------------ Конфигурация ------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
 BASE_CURRENCY = "RUB"
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")  # можно указать локальный Bot API
+
+# Адреса внешних API (переопределяются для тестовых стендов и bench.py)
+OPENWEATHER_API_URL = os.getenv("OPENWEATHER_API_URL", "http://api.openweathermap.org")
+EXCHANGE_API_URL = os.getenv("EXCHANGE_API_URL", "https://api.exchangerate-api.com")
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com")
+TRANSLATE_API_URL = os.getenv("TRANSLATE_API_URL", "https://api.mymemory.translated.net")
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", "https://ru.wikipedia.org")
+NEWS_FEED_URL = os.getenv("NEWS_FEED_URL", "http://feeds.bbci.co.uk/russian/rss.xml")
+
+# Режим получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                           # публичный адрес, на который шлёт Telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                     # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # одновременных запросов от Telegram
+
+# Сетевые параметры внешних API
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "10"))                # общий таймаут запроса, сек
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))  # размер пула соединений
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "20"))    # одновременных запросов к одному хосту
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))                   # повторов при сетевых ошибках и 5xx/429
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))               # базовая задержка между повторами, сек
+HTTP_MAX_RETRY_AFTER = float(os.getenv("HTTP_MAX_RETRY_AFTER", "5"))  # дольше Retry-After не ждём — отдаём ответ как есть
+
+# Кэш OpenWeather
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "600"))       # текущая погода, сек
+FORECAST_CACHE_TTL = int(os.getenv("FORECAST_CACHE_TTL", "1800"))    # прогноз, сек
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "5000"))    # максимум городов в кэше
+
+# Обратное геокодирование (координаты → город)
+GEO_CELL_SIZE = float(os.getenv("GEO_CELL_SIZE", "0.05"))            # сторона ячейки сетки кэша, градусов (~5 км)
+GEO_CACHE_TTL = int(os.getenv("GEO_CACHE_TTL", "2592000"))           # 30 дней — города не переезжают
+GEO_CACHE_SIZE = int(os.getenv("GEO_CACHE_SIZE", "50000"))           # ячеек в кэше
+GEO_CITIES_PATH = os.getenv("GEO_CITIES_PATH", "")                   # офлайн-база городов (GeoNames citiesN.txt); пусто — только API
+GEO_CITY_MAX_DISTANCE = float(os.getenv("GEO_CITY_MAX_DISTANCE", "25"))  # дальше ближайшего города из базы — спросить API, км
+
+# Состояние чатов в памяти
+CHAT_CACHE_SIZE = int(os.getenv("CHAT_CACHE_SIZE", "100000"))        # чатов в памяти, остальные — только в хранилище
+CHAT_IDLE_TTL = int(os.getenv("CHAT_IDLE_TTL", "3600"))              # выгружать чаты, молчащие дольше, сек
+CHAT_EVICT_INTERVAL = int(os.getenv("CHAT_EVICT_INTERVAL", "60"))       # как часто проверять молчащие чаты, сек
+
+# Хранилище задач, настроек и подписок
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")             # sqlite или memory
+STORAGE_PATH = os.getenv("STORAGE_PATH", "omnibot.db")
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "1"))  # период записи пачки, сек
+STORAGE_BATCH_SIZE = int(os.getenv("STORAGE_BATCH_SIZE", "500"))     # записать досрочно при таком числе изменений
+
+# Таблица курсов для конвертера валют (currency-converter, данные ЕЦБ)
+CURRENCY_TABLE_TTL = int(os.getenv("CURRENCY_TABLE_TTL", "86400"))  # период обновления таблицы, сек
+
+# Курсы валют и криптовалют для /rates
+RATES_REFRESH_INTERVAL = int(os.getenv("RATES_REFRESH_INTERVAL", "300"))  # период фонового обновления, сек
+
+# Новости (RSS/Atom)
+NEWS_FEEDS = os.getenv("NEWS_FEEDS", "")                             # «id=url» через запятую; пусто — bbc=NEWS_FEED_URL
+NEWS_REFRESH_INTERVAL = int(os.getenv("NEWS_REFRESH_INTERVAL", "600"))  # период фонового опроса лент, сек
+NEWS_DIGEST_SIZE = int(os.getenv("NEWS_DIGEST_SIZE", "5"))           # записей ленты в дайджесте
+NEWS_SEEN_SIZE = int(os.getenv("NEWS_SEEN_SIZE", "1000"))            # GUID, запоминаемых по каждой ленте
+NEWS_MAX_FEEDS_PER_CHAT = 5
+
+# Переводчик (MyMemory)
+TRANSLATION_CACHE_TTL = int(os.getenv("TRANSLATION_CACHE_TTL", "604800"))    # 7 дней
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "10000"))  # фрагментов в памяти
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", "")           # SQLite-кэш на диске; пусто — выключен
+TRANSLATION_CHUNK_SIZE = int(os.getenv("TRANSLATION_CHUNK_SIZE", "450"))    # байт UTF-8 в запросе; MyMemory принимает до 500
+TRANSLATION_CONCURRENCY = int(os.getenv("TRANSLATION_CONCURRENCY", "4"))   # параллельных запросов на перевод
+
+# Поиск в Wikipedia
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "3"))                 # статей в ответе /search
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "3600"))          # кэш результатов поиска, сек
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "5000"))
+SEARCH_SUMMARY_TTL = int(os.getenv("SEARCH_SUMMARY_TTL", "86400"))     # кэш кратких описаний статей, сек
+SEARCH_INDEX_SIZE = int(os.getenv("SEARCH_INDEX_SIZE", "50000"))       # названий в локальном префиксном индексе
+
+# Квиз
+QUIZ_BANK_PATH = os.getenv("QUIZ_BANK_PATH", "")                     # JSON Lines с вопросами; пусто — встроенные
+QUIZ_CACHE_SIZE = int(os.getenv("QUIZ_CACHE_SIZE", "2048"))          # разобранных вопросов в памяти
+QUIZ_LEADERBOARD_SIZE = int(os.getenv("QUIZ_LEADERBOARD_SIZE", "100"))  # сколько лидеров держать в памяти
+QUIZ_TOP_SHOWN = 10
+
+# Многопроцессный режим: фронт-процесс принимает обновления и раздаёт их
+# по хэшу chat_id рабочим процессам (шардам)
+WORKERS = int(os.getenv("WORKERS", "1"))                             # 1 — всё в одном процессе
+SHARD_BATCH_SIZE = int(os.getenv("SHARD_BATCH_SIZE", "100"))         # обновлений в одной пересылке шарду
+SHARED_CACHE_SIZE = int(os.getenv("SHARED_CACHE_SIZE", "100000"))    # записей в общем кэше фронта
+
+# Параллельная обработка обновлений
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))      # обновлений в работе одновременно
+UPDATE_BACKLOG = int(os.getenv("UPDATE_BACKLOG", "10000"))           # максимум принятых, но не завершённых
+
+# Метрики в формате Prometheus
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))                   # 0 — эндпоинт /metrics выключен
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# Оповещения о погоде (/alert)
+ALERT_CHECK_INTERVAL = int(os.getenv("ALERT_CHECK_INTERVAL", "600"))  # период проверки городов с оповещениями, сек
+ALERT_MAX_PER_CHAT = int(os.getenv("ALERT_MAX_PER_CHAT", "20"))
+ALERT_RAIN_HOURS = int(os.getenv("ALERT_RAIN_HOURS", "3"))           # горизонт прогноза для «rain», часов (шаг 3 ч)
+ALERT_RAIN_PROBABILITY = 0.5                                         # вероятность осадков (pop), с которой считаем «будет дождь»
+
+# Холодный старт
+WARM_UP = os.getenv("WARM_UP", "1") == "1"                           # догружать ленивые зависимости в фоне после старта
+STARTUP_PROFILE_PATH = os.getenv("STARTUP_PROFILE_PATH", "")         # JSON Lines с профилем каждого запуска; пусто — только лог
+
+# Напоминания
+REMINDER_MAX_PER_CHAT = int(os.getenv("REMINDER_MAX_PER_CHAT", "100"))  # активных напоминаний в одном чате
+REMINDER_MAX_SLEEP = 60   # диспетчер просыпается не реже, чтобы учесть перевод системных часов
+REMINDER_RETRY_DELAY = int(os.getenv("REMINDER_RETRY_DELAY", "60"))  # повтор неотправленного напоминания через, сек
+REMINDER_RETRIES = int(os.getenv("REMINDER_RETRIES", "5"))           # попыток отправить напоминание
+
+# Задачи (To-Do)
+TODO_MAX_PER_CHAT = int(os.getenv("TODO_MAX_PER_CHAT", "1000"))      # задач в одном чате
+TODO_PAGE_SIZE = int(os.getenv("TODO_PAGE_SIZE", "10"))              # задач на странице списка и удаления
+TODO_TEXT_MAX = 200                                                  # длина текста задачи, символов
+
+# Inline-режим (@бот запрос в любом чате)
+INLINE_DEBOUNCE = float(os.getenv("INLINE_DEBOUNCE", "0.4"))         # пауза в наборе перед запросом к внешним API, сек
+INLINE_TIMEOUT = float(os.getenv("INLINE_TIMEOUT", "3"))             # бюджет ответа с внешними запросами, сек
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "10000"))     # готовых ответов в памяти
+
+# Лимиты Telegram на отправку
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))        # сообщений в секунду на бота
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", "1"))     # сообщений в секунду в один чат
+SEND_PER_CHAT_BURST = float(os.getenv("SEND_PER_CHAT_BURST", "3"))   # короткий всплеск в чат без ожидания
+SEND_MERGE = os.getenv("SEND_MERGE", "1") == "1"                     # склеивать рассылки в один чат в очереди
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))                   # параллельных отправителей рассылки
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "5"))                   # попыток на запрос к Bot API
 
 # ------------------ Глобальные переменные ------------------
-todo_tasks = {}         # {chat_id: [task, ...]}
-user_settings = {}      # {chat_id: {"city": "..." }}
-subscriptions = {}      # {(chat_id, subscription_type): job}
+chat_states = OrderedDict()  # {chat_id: ChatState} — LRU загруженных чатов, недавние в конце
+quiz_stats = OrderedDict()  # {user_id: [статистика, last_seen]} — LRU загруженных игроков, недавние в конце
+storage = None          # Storage, создаётся в on_startup()
+storage_writer = None   # StorageWriter — пакетная фоновая запись в storage
+subscriptions = {"weather": {}, "news": {}}  # {тип подписки: {chat_id: time}}
+subscription_slots = {} # {time: {"weather": {chat_id, ...}, "news": {chat_id, ...}}}
+slot_jobs = {}          # {time: job} — одна задача JobQueue на слот времени
+send_pipeline = None    # SendPipeline, создаётся в on_startup()
+shard_id = None         # номер шарда в многопроцессном режиме
+shared_cache = None     # SharedCacheClient — общий кэш фронт-процесса (только в шардах)
+metrics_server = None   # HttpServer с /metrics, если задан METRICS_PORT
+application = None      # запущенное Application — для коллектора метрик
 quiz_questions = [
     {"question": "Сколько будет 2+2?", "options": ["3", "4", "5"], "answer": "4"},
     {"question": "Столица Франции?", "options": ["Берлин", "Париж", "Рим"], "answer": "Париж"},
@@ -56,119 +268,3160 @@ quiz_questions = [
     {"question": "Что всегда растёт, но не стареет?", "options": ["Дерево", "Растение", "Возраст"], "answer": "Возраст"}
 ]
 
-# Языки для переводчика
-LANGUAGES = {
-    "ru": {"name": "Русский", "flag": "🇷🇺"},
-    "en": {"name": "Английский", "flag": "🇬🇧"},
-    "zh-CN": {"name": "Китайский", "flag": "🇨🇳"},
-    "ar": {"name": "Арабский", "flag": "🇸🇦"},
-    "es": {"name": "Испанский", "flag": "🇪🇸"},
-    "pt": {"name": "Португальский", "flag": "🇵🇹"},
-    "fr": {"name": "Французский", "flag": "🇫🇷"},
-    "de": {"name": "Немецкий", "flag": "🇩🇪"},
-    "it": {"name": "Итальянский", "flag": "🇮🇹"},
-    "tr": {"name": "Турецкий", "flag": "🇹🇷"}
-}
+# Языки для переводчика
+LANGUAGES = {
+    "ru": {"name": "Русский", "flag": "🇷🇺"},
+    "en": {"name": "Английский", "flag": "🇬🇧"},
+    "zh-CN": {"name": "Китайский", "flag": "🇨🇳"},
+    "ar": {"name": "Арабский", "flag": "🇸🇦"},
+    "es": {"name": "Испанский", "flag": "🇪🇸"},
+    "pt": {"name": "Португальский", "flag": "🇵🇹"},
+    "fr": {"name": "Французский", "flag": "🇫🇷"},
+    "de": {"name": "Немецкий", "flag": "🇩🇪"},
+    "it": {"name": "Итальянский", "flag": "🇮🇹"},
+    "tr": {"name": "Турецкий", "flag": "🇹🇷"}
+}
+
+# ------------------ Метрики ------------------
+# Счётчики и гистограммы задержек в памяти процесса; на горячем пути —
+# только perf_counter, bisect и словарь. Значения, которые уже считают
+# другие компоненты (кэши, очереди), снимаются коллекторами в момент запроса
+# /metrics. Метки — кортеж пар ((имя, значение), ...).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}    # {(имя, метки): значение}
+        self.histograms = {}  # {(имя, метки): Histogram}
+        self.collectors = []  # функции, возвращающие [(имя, тип, метки, значение), ...]
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1) -> None:
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float) -> None:
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def collector(self, fn):
+        self.collectors.append(fn)
+        return fn
+
+    @staticmethod
+    def _labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{key}="{escape_label(value)}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        families = {}  # {имя: (тип, [(метки, значение), ...])}
+        for (name, labels), value in self.counters.items():
+            families.setdefault(name, ("counter", []))[1].append((labels, value))
+        for collect in self.collectors:
+            try:
+                for name, kind, labels, value in collect():
+                    families.setdefault(name, (kind, []))[1].append((labels, value))
+            except Exception as e:
+                logger.error("Ошибка сбора метрик: %s", e)
+        lines = []
+        for name in sorted(families):
+            kind, samples = families[name]
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(f"{name}{self._labels(labels)} {value}" for labels, value in samples)
+        by_name = {}
+        for (name, labels), histogram in self.histograms.items():
+            by_name.setdefault(name, []).append((labels, histogram))
+        for name in sorted(by_name):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in by_name[name]:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    bucket = self._labels(labels, f'le="{bound}"')
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Обёртка для обработчиков и задач JobQueue: время выполнения и число ошибок
+def instrumented(name: str, callback, kind: str = "handler"):
+    labels = ((kind, name),)
+    histogram_name = f"omnibot_{kind}_seconds"
+    errors_name = f"omnibot_{kind}_errors_total"
+
+    @wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            metrics.inc(errors_name, labels)
+            raise
+        finally:
+            metrics.observe(histogram_name, labels, perf_counter() - started)
+    return wrapper
+
+async def metrics_handler(request) -> tuple:
+    return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode()
+
+# ------------------ HTTP-клиент ------------------
+# Один пул соединений на весь бот: keep-alive, ограничение параллелизма
+# на хост, таймауты и повторы с экспоненциальной задержкой.
+http_client = None      # httpx.AsyncClient, создаётся в main()
+host_semaphores = {}    # {host: asyncio.Semaphore}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_TIMEOUT, connect=min(HTTP_TIMEOUT, 5.0)),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=30,
+        ),
+        headers={"User-Agent": "OmniBot/1.0 (Telegram bot)"},
+        follow_redirects=True,
+    )
+
+async def http_get(url: str, params: dict = None, headers: dict = None) -> httpx.Response:
+    host = httpx.URL(url).host
+    semaphore = host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = host_semaphores[host] = asyncio.Semaphore(HTTP_PER_HOST_LIMIT)
+    labels = (("host", host),)
+    for attempt in range(HTTP_RETRIES + 1):
+        try:
+            async with semaphore:
+                started = perf_counter()
+                try:
+                    response = await http_client.get(url, params=params, headers=headers)
+                finally:
+                    metrics.observe("omnibot_upstream_seconds", labels, perf_counter() - started)
+            if response.status_code >= 400:
+                metrics.inc("omnibot_upstream_errors_total", labels + (("reason", str(response.status_code)),))
+            if response.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                return response
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else HTTP_BACKOFF * 2 ** attempt
+            # Обработчик пользователя (а с ним и очередь его чата) не может ждать минутами
+            if delay > max(HTTP_MAX_RETRY_AFTER, HTTP_BACKOFF * 2 ** attempt):
+                logger.warning("%s просит повторить через %s с — не ждём", host, retry_after)
+                return response
+        except httpx.TransportError as e:
+            metrics.inc("omnibot_upstream_errors_total", labels + (("reason", type(e).__name__),))
+            if attempt == HTTP_RETRIES:
+                raise
+            logger.warning("Сетевая ошибка %s (попытка %d): %s", host, attempt + 1, e)
+            delay = HTTP_BACKOFF * 2 ** attempt
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+
+async def fetch_json(url: str, params: dict = None):
+    response = await http_get(url, params=params)
+    try:
+        return response.json()
+    except ValueError:
+        # Ошибки API приходят JSON-ом (их разбирают вызывающие), а страница
+        # ошибки прокси или балансировщика — нет
+        response.raise_for_status()
+        raise
+
+# То же, но в многопроцессном режиме ответ сначала ищется в общем кэше
+# фронта, чтобы шарды не ходили к API за одними и теми же данными.
+# Локальные кэши шарда могут добавить к возрасту данных ещё один свой TTL.
+async def shared_fetch_json(key: str, url: str, params: dict = None, ttl: float = 60, cacheable=None):
+    if shared_cache is not None:
+        found = await shared_cache.get(key)
+        if found is not None:
+            return found
+    data = await fetch_json(url, params)
+    if shared_cache is not None and (cacheable is None or cacheable(data)):
+        await shared_cache.set(key, data, ttl)
+    return data
+
+# ------------------ HTTP-сервер ------------------
+# Минимальный HTTP/1.1-сервер на asyncio для webhook: без сторонних
+# зависимостей, с ограничением одновременно обрабатываемых запросов
+# и корректной остановкой (новые соединения не принимаются, начатые
+# запросы дорабатывают).
+HttpRequest = namedtuple("HttpRequest", "method path headers body")
+HTTP_MAX_BODY = 1024 * 1024
+
+class HttpServer:
+    def __init__(self, routes: dict, host: str, port: int, max_concurrency: int = 100):
+        self.routes = routes  # {(method, path): async handler(HttpRequest) -> (status, content_type, body)}
+        self.host = host
+        self.port = port
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.server = None
+        self.connections = {}  # {task: writer}
+        self.busy = set()      # соединения, у которых запрос в обработке
+        self.stopping = False
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self, timeout: float = 10) -> None:
+        self.stopping = True
+        self.server.close()
+        # Простаивающие keep-alive соединения закрываем сразу, начатые запросы дожидаемся
+        for task, writer in list(self.connections.items()):
+            if task not in self.busy:
+                writer.close()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=timeout)
+        for task, writer in list(self.connections.items()):
+            writer.close()
+            task.cancel()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while not self.stopping:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                self.busy.add(task)
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length > HTTP_MAX_BODY:
+                    await self._respond(writer, 413, "text/plain", b"too large", close=True)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                path = target.split("?", 1)[0]
+                handler = self.routes.get((method, path))
+                if handler is None:
+                    status, content_type, payload = 404, "text/plain", b"not found"
+                else:
+                    async with self.semaphore:
+                        try:
+                            status, content_type, payload = await handler(HttpRequest(method, path, headers, body))
+                        except Exception as e:
+                            logger.error("Ошибка обработки %s %s: %s", method, path, e)
+                            status, content_type, payload = 500, "text/plain", b"error"
+                close = self.stopping or headers.get("connection", "").lower() == "close"
+                await self._respond(writer, status, content_type, payload, close)
+                self.busy.discard(task)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            self.busy.discard(task)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, content_type: str, payload: bytes, close: bool = False) -> None:
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n")
+        writer.write(head.encode() + payload)
+        await writer.drain()
+
+# Приём обновлений от Telegram: проверка секретного токена и передача
+# в очередь обновлений приложения
+def make_webhook_handler(app):
+    async def webhook_handler(request: HttpRequest):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if WEBHOOK_SECRET and not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return 403, "text/plain", b"forbidden"
+        try:
+            data = json.loads(request.body)
+            # Список — пачка обновлений от фронт-процесса (многопроцессный режим)
+            updates = [Update.de_json(item, app.bot) for item in (data if isinstance(data, list) else [data])]
+        except (ValueError, TypeError):
+            return 400, "text/plain", b"bad request"
+        for update in updates:
+            await app.update_queue.put(update)
+        return 200, "text/plain", b"ok"
+    return webhook_handler
+
+# ------------------ Параллельная обработка обновлений ------------------
+# Обновления разных чатов обрабатываются параллельно (до UPDATE_CONCURRENCY),
+# обновления одного чата — строго по очереди, чтобы состояния диалогов в
+# ChatState (режим диалога, языки перевода) не перемешивались.
+# Слот общего лимита занимается только после блокировки чата, поэтому
+# серия сообщений из одного чата не отнимает слоты у остальных.
+def update_chat_key(update: object):
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return update.effective_user.id
+    return None
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, concurrency: int, backlog: int):
+        super().__init__(max(backlog, concurrency))
+        self.concurrency = concurrency
+        self.slots = asyncio.Semaphore(concurrency)
+        self.chat_locks = {}  # {chat_id: [asyncio.Lock, обновлений в работе или в ожидании]}
+        self.waiting = 0      # ждут очереди чата или свободного слота
+        self.active = 0
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        # Inline-запросы состояние чата не меняют, а устаревшие отсеивает
+        # debounce — в очередь пользователя их не ставим
+        key = None if isinstance(update, Update) and update.inline_query else update_chat_key(update)
+        entry = None
+        if key is not None:
+            entry = self.chat_locks.get(key)
+            if entry is None:
+                entry = self.chat_locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        started = perf_counter()
+        self.waiting += 1
+        waiting = True
+        try:
+            if entry is not None:
+                await entry[0].acquire()
+            try:
+                async with self.slots:
+                    waited = perf_counter() - started
+                    self.waiting -= 1
+                    waiting = False
+                    self.processed += 1
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                    self.active += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if waiting:
+                self.waiting -= 1
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.chat_locks[key]
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "processed": self.processed,
+            "wait_avg": round(self.wait_total / self.processed, 4) if self.processed else 0.0,
+            "wait_max": round(self.wait_max, 4),
+        }
+
+# ------------------ Кэш ------------------
+# LRU-кэш с TTL и объединением одновременных запросов (single-flight):
+# пока запрос по ключу в полёте, остальные ждут его результат.
+# Ведущий запрос single-flight отменили (клиент ушёл, остановка): ожидающие
+# его результата не отменены и повторяют запрос сами
+class FetchAbandoned(Exception):
+    pass
+
+class TTLCache:
+    def __init__(self, ttl: float, maxsize: int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+        self._inflight = {}         # {key: asyncio.Future}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] <= monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key, value, ttl: float = None) -> None:
+        self._data[key] = (monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_fetch(self, key, fetch, cacheable=None):
+        item = self._data.get(key)
+        if item is not None and item[0] > monotonic():
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except FetchAbandoned:
+                return await self.get_or_fetch(key, fetch, cacheable)
+        self.misses += 1
+        future = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            future.set_exception(FetchAbandoned(key))
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ожидающих может не быть — не пишем «exception never retrieved»
+            raise
+        else:
+            if cacheable is None or cacheable(value):
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.coalesced + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "coalesced": self.coalesced,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+
+# ------------------ Геокодирование ------------------
+# Координаты раскладываются по ячейкам сетки GEO_CELL_SIZE градусов:
+# все точки одной ячейки считаются одним местом, поэтому соседние
+# пользователи одного города разделяют и ответ геокодера, и погоду.
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.2
+
+def geo_cell(lat: float, lon: float) -> tuple:
+    return floor(lat / GEO_CELL_SIZE), floor(lon / GEO_CELL_SIZE)
+
+def distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    dlat = radians(lat2 - lat1)
+    dlon = radians(lon2 - lon1)
+    a = sin(dlat / 2) ** 2 + cos(radians(lat1)) * cos(radians(lat2)) * sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a)))
+
+# Офлайн-база городов с индексом-сеткой по 1°: ближайший город ищется
+# только в ячейках, до которых может быть не дальше max_km.
+# Формат — выгрузка GeoNames (citiesN.txt: id, name, asciiname,
+# alternatenames, lat, lon, ...) или строки «город<TAB>lat<TAB>lon».
+class CityIndex:
+    CELL = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.names = []
+        self.lats = array("d")
+        self.lons = array("d")
+        self.grid = {}  # {(ячейка lat, ячейка lon): [номер города, ...]}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            try:
+                await asyncio.to_thread(self._read)
+                logger.info("База городов %s: %d городов", self.path, len(self.names))
+            except OSError as e:
+                logger.error("Не удалось загрузить базу городов %s: %s", self.path, e)
+            self.loaded = True
+
+    def _read(self) -> None:
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                try:
+                    if len(fields) >= 6:
+                        name, lat, lon = fields[1], float(fields[4]), float(fields[5])
+                    else:
+                        name, lat, lon = fields[0], float(fields[1]), float(fields[2])
+                except (ValueError, IndexError):
+                    continue
+                cell = (floor(lat / self.CELL), floor(lon / self.CELL))
+                self.grid.setdefault(cell, []).append(len(self.names))
+                self.names.append(name)
+                self.lats.append(lat)
+                self.lons.append(lon)
+
+    def nearest(self, lat: float, lon: float, max_km: float):
+        lat_cells = ceil(max_km / KM_PER_DEGREE / self.CELL)
+        lon_km = KM_PER_DEGREE * max(cos(radians(lat)), 0.01)
+        lon_cells = min(ceil(max_km / lon_km / self.CELL), int(180 / self.CELL))
+        cell_lat, cell_lon = floor(lat / self.CELL), floor(lon / self.CELL)
+        lon_count = int(360 / self.CELL)
+        best, best_distance = None, max_km
+        for i in range(cell_lat - lat_cells, cell_lat + lat_cells + 1):
+            for j in range(cell_lon - lon_cells, cell_lon + lon_cells + 1):
+                # долгота по кругу: ячейки за 180° продолжаются с -180°
+                wrapped = (j + lon_count // 2) % lon_count - lon_count // 2
+                for index in self.grid.get((i, wrapped), ()):
+                    distance = distance_km(lat, lon, self.lats[index], self.lons[index])
+                    if distance <= best_distance:
+                        best, best_distance = self.names[index], distance
+        return best
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+# Координаты → название города: кэш по ячейкам сетки, затем офлайн-база
+# (если задана), затем reverse-геокодер OpenWeather. "" — в ячейке
+# города нет (море, тайга), такой ответ тоже кэшируется.
+class ReverseGeocoder:
+    def __init__(self, cities: CityIndex = None):
+        self.cache = TTLCache(GEO_CACHE_TTL, GEO_CACHE_SIZE)  # {ячейка: город}
+        self.cities = cities
+        self.local_hits = 0
+
+    async def city_at(self, lat: float, lon: float):
+        cell = geo_cell(lat, lon)
+
+        async def fetch():
+            if self.cities is not None:
+                await self.cities.load()
+                city = self.cities.nearest(lat, lon, GEO_CITY_MAX_DISTANCE)
+                if city:
+                    self.local_hits += 1
+                    return city
+            data = await shared_fetch_json(f"geo:{cell[0]}:{cell[1]}", f"{OPENWEATHER_API_URL}/geo/1.0/reverse",
+                                           {"lat": lat, "lon": lon, "limit": 1, "appid": OPENWEATHER_API_KEY},
+                                           GEO_CACHE_TTL, lambda data: isinstance(data, list))
+            if not isinstance(data, list):
+                return None  # ошибка API — не кэшируем
+            return data[0].get("name", "") if data else ""
+
+        return await self.cache.get_or_fetch(cell, fetch, cacheable=lambda city: city is not None)
+
+reverse_geocoder = ReverseGeocoder(CityIndex(GEO_CITIES_PATH) if GEO_CITIES_PATH else None)
+
+# ------------------ Погода (OpenWeather) ------------------
+# Город из /settings или аргумента ищется по названию; если место задано
+# геолокацией, погода запрашивается по координатам и кэшируется по ячейке.
+weather_cache = TTLCache(WEATHER_CACHE_TTL, WEATHER_CACHE_SIZE)    # {город или @ячейка: ответ /weather}
+forecast_cache = TTLCache(FORECAST_CACHE_TTL, WEATHER_CACHE_SIZE)  # {город или @ячейка: ответ /forecast}
+
+def normalize_city(city: str) -> str:
+    return " ".join(city.split()).casefold()
+
+def weather_key(city: str, coords: tuple = None) -> str:
+    if coords:
+        return "@{}:{}".format(*geo_cell(*coords))
+    return normalize_city(city)
+
+def weather_params(city: str, coords: tuple = None) -> dict:
+    params = {"lat": coords[0], "lon": coords[1]} if coords else {"q": city}
+    params.update(appid=OPENWEATHER_API_KEY, units="metric", lang="ru")
+    return params
+
+# (город, координаты или None) для чата без явно указанного города
+def saved_place(chat_id: int) -> tuple:
+    state = get_chat(chat_id)
+    coords = (state.lat, state.lon) if state.lat is not None else None
+    return state.city, coords
+
+async def get_weather(city: str, coords: tuple = None) -> dict:
+    key = weather_key(city, coords)
+    cacheable = lambda data: data.get("cod") == 200
+    return await weather_cache.get_or_fetch(
+        key,
+        lambda: shared_fetch_json(f"weather:{key}", f"{OPENWEATHER_API_URL}/data/2.5/weather",
+                                  weather_params(city, coords), WEATHER_CACHE_TTL, cacheable),
+        cacheable=cacheable,
+    )
+
+async def get_forecast(city: str, coords: tuple = None) -> dict:
+    key = weather_key(city, coords)
+    cacheable = lambda data: data.get("cod") == "200"
+    return await forecast_cache.get_or_fetch(
+        key,
+        lambda: shared_fetch_json(f"forecast:{key}", f"{OPENWEATHER_API_URL}/data/2.5/forecast",
+                                  weather_params(city, coords), FORECAST_CACHE_TTL, cacheable),
+        cacheable=cacheable,
+    )
+
+def format_weather(city: str, data: dict) -> str:
+    desc = data["weather"][0]["description"].capitalize()
+    temp = data["main"]["temp"]
+    humidity = data["main"]["humidity"]
+    return f"Погода в <b>{city}</b>:\nУсловия: {desc}\nТемпература: {temp}°C\nВлажность: {humidity}%"
+
+def format_forecast(city: str, data: dict) -> str:
+    message = f"<b>Прогноз погоды в {city} на ближайшие 24 часа:</b>\n"
+    for entry in data["list"][:8]:
+        dt = entry["dt_txt"]
+        temp = entry["main"]["temp"]
+        desc = entry["weather"][0]["description"].capitalize()
+        message += f"{dt}: {temp}°C, {desc}\n"
+    return message
+
+# ------------------ Хранилище ------------------
+# Интерфейс хранилища. Изменения приходят пачками через apply():
+# [(вид, ключ, значение), ...], где значение None означает удаление.
+# Для задач значение — изменённые задачи чата [(id, строка или None), ...].
+class Storage:
+    def load_tasks(self, chat_id: int) -> list:  # [(id, текст, приоритет, срок, id напоминания), ...]
+        raise NotImplementedError
+
+    def load_settings(self, chat_id: int) -> dict:
+        raise NotImplementedError
+
+    # Для рассылок: вызывается из пула потоков, чаты без настроек пропускаются
+    def load_settings_many(self, chat_ids: list) -> dict:  # {chat_id: настройки}
+        raise NotImplementedError
+
+    def load_subscriptions(self) -> list:  # [(chat_id, sub_type, "HH:MM"), ...]
+        raise NotImplementedError
+
+    def load_quiz(self, user_id: int) -> dict:
+        raise NotImplementedError
+
+    def load_quiz_top(self, limit: int) -> list:  # [(user_id, {...}), ...] по убыванию очков
+        raise NotImplementedError
+
+    def load_reminders(self) -> list:  # [(id, chat_id, due, text), ...]
+        raise NotImplementedError
+
+    def load_alerts(self) -> list:  # [(id, chat_id, {условие}), ...]
+        raise NotImplementedError
+
+    # Следующий свободный id: ("tasks", chat_id), ("reminder", 0), ("alert", 0).
+    # Хранится отдельно от строк, чтобы id удалённых записей не выдавались снова.
+    def load_next_id(self, scope: str, key: int) -> int:
+        raise NotImplementedError
+
+    def apply(self, ops: list) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self.tasks = {}
+        self.settings = {}
+        self.subscriptions = {}
+        self.quiz = {}
+        self.reminders = {}
+        self.alerts = {}
+        self.next_ids = {}
+
+    def load_tasks(self, chat_id: int) -> list:
+        return [(task_id, *row) for task_id, row in self.tasks.get(chat_id, {}).items()]
+
+    def load_settings(self, chat_id: int) -> dict:
+        return dict(self.settings.get(chat_id, {}))
+
+    def load_settings_many(self, chat_ids: list) -> dict:
+        return {chat_id: dict(self.settings[chat_id]) for chat_id in chat_ids if chat_id in self.settings}
+
+    def load_subscriptions(self) -> list:
+        return [(chat_id, sub_type, time_str) for (chat_id, sub_type), time_str in self.subscriptions.items()]
+
+    def load_quiz(self, user_id: int) -> dict:
+        return dict(self.quiz.get(user_id, {}))
+
+    def load_quiz_top(self, limit: int) -> list:
+        ranked = sorted(self.quiz.items(), key=lambda item: (-item[1].get("score", 0), item[1].get("updated", 0)))
+        return [(user_id, dict(data)) for user_id, data in ranked[:limit] if data.get("score")]
+
+    def load_reminders(self) -> list:
+        return [(reminder_id, *value) for reminder_id, value in self.reminders.items()]
+
+    def load_alerts(self) -> list:
+        return [(alert_id, chat_id, dict(data)) for alert_id, (chat_id, data) in self.alerts.items()]
+
+    def load_next_id(self, scope: str, key: int) -> int:
+        return self.next_ids.get((scope, key), 1)
+
+    def apply(self, ops: list) -> None:
+        tables = {"tasks": self.tasks, "settings": self.settings, "subscription": self.subscriptions,
+                  "quiz": self.quiz, "reminder": self.reminders, "alert": self.alerts, "next_id": self.next_ids}
+        for kind, key, value in ops:
+            if kind == "tasks":
+                rows = self.tasks.setdefault(key, {})
+                for task_id, row in value:
+                    if row:
+                        rows[task_id] = row
+                    else:
+                        rows.pop(task_id, None)
+                if not rows:
+                    del self.tasks[key]
+            elif value:
+                tables[kind][key] = value
+            else:
+                tables[kind].pop(key, None)
+
+class SQLiteStorage(Storage):
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS todo_tasks (
+            chat_id INTEGER NOT NULL,
+            id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 2,
+            due INTEGER,
+            reminder INTEGER,
+            PRIMARY KEY (chat_id, id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS user_settings (
+            chat_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            chat_id INTEGER NOT NULL,
+            sub_type TEXT NOT NULL,
+            time TEXT NOT NULL,
+            PRIMARY KEY (chat_id, sub_type)
+        );
+        CREATE INDEX IF NOT EXISTS subscriptions_type_time ON subscriptions (sub_type, time);
+        CREATE TABLE IF NOT EXISTS quiz_stats (
+            user_id INTEGER PRIMARY KEY,
+            score INTEGER NOT NULL,
+            updated REAL NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS quiz_stats_score ON quiz_stats (score DESC, updated);
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            due REAL NOT NULL,
+            text TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS weather_alerts (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS id_counters (
+            scope TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            next_id INTEGER NOT NULL,
+            PRIMARY KEY (scope, key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Отдельные соединения: чтение идёт из event loop, запись — из пула потоков.
+        # В режиме WAL читатели не блокируются пишущим.
+        self.writer = sqlite3.connect(path, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.executescript(self.SCHEMA)
+        self.migrate()
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+
+    # Задачи раньше хранились списком (position с нуля, text): позиция
+    # становится id с единицы — прежние номера задач сохраняются
+    def migrate(self) -> None:
+        columns = {name for _, name, *_ in self.writer.execute("PRAGMA table_info(todo_tasks)")}
+        if "position" not in columns:
+            return
+        with self.writer:
+            self.writer.execute("ALTER TABLE todo_tasks RENAME COLUMN position TO id")
+            self.writer.execute("ALTER TABLE todo_tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 2")
+            self.writer.execute("ALTER TABLE todo_tasks ADD COLUMN due INTEGER")
+            self.writer.execute("ALTER TABLE todo_tasks ADD COLUMN reminder INTEGER")
+            self.writer.execute("UPDATE todo_tasks SET id = -id - 1")  # в два шага, чтобы не столкнуться с ключом
+            self.writer.execute("UPDATE todo_tasks SET id = -id")
+
+    def load_tasks(self, chat_id: int) -> list:
+        return self.reader.execute(
+            "SELECT id, text, priority, due, reminder FROM todo_tasks WHERE chat_id = ?", (chat_id,)).fetchall()
+
+    def load_settings(self, chat_id: int) -> dict:
+        row = self.reader.execute("SELECT data FROM user_settings WHERE chat_id = ?", (chat_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    # Своё соединение: читатель event loop в это время продолжает работать
+    def load_settings_many(self, chat_ids: list) -> dict:
+        found = {}
+        connection = sqlite3.connect(self.path)
+        try:
+            for i in range(0, len(chat_ids), 500):
+                chunk = chat_ids[i:i + 500]
+                rows = connection.execute(
+                    f"SELECT chat_id, data FROM user_settings WHERE chat_id IN ({','.join('?' * len(chunk))})", chunk)
+                found.update((chat_id, json.loads(data)) for chat_id, data in rows)
+        finally:
+            connection.close()
+        return found
+
+    def load_subscriptions(self) -> list:
+        return self.reader.execute("SELECT chat_id, sub_type, time FROM subscriptions").fetchall()
+
+    def load_quiz(self, user_id: int) -> dict:
+        row = self.reader.execute("SELECT data FROM quiz_stats WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def load_quiz_top(self, limit: int) -> list:
+        rows = self.reader.execute(
+            "SELECT user_id, data FROM quiz_stats WHERE score > 0 ORDER BY score DESC, updated LIMIT ?", (limit,))
+        return [(user_id, json.loads(data)) for user_id, data in rows]
+
+    def load_reminders(self) -> list:
+        return self.reader.execute("SELECT id, chat_id, due, text FROM reminders").fetchall()
+
+    def load_alerts(self) -> list:
+        rows = self.reader.execute("SELECT id, chat_id, data FROM weather_alerts")
+        return [(alert_id, chat_id, json.loads(data)) for alert_id, chat_id, data in rows]
+
+    def load_next_id(self, scope: str, key: int) -> int:
+        row = self.reader.execute("SELECT next_id FROM id_counters WHERE scope = ? AND key = ?", (scope, key)).fetchone()
+        return row[0] if row else 1
+
+    def apply(self, ops: list) -> None:
+        with self.writer:
+            for kind, key, value in ops:
+                if kind == "tasks":
+                    self.writer.executemany("DELETE FROM todo_tasks WHERE chat_id = ? AND id = ?",
+                                            [(key, task_id) for task_id, row in value if row is None])
+                    self.writer.executemany("INSERT OR REPLACE INTO todo_tasks VALUES (?, ?, ?, ?, ?, ?)",
+                                            [(key, task_id, *row) for task_id, row in value if row is not None])
+                elif kind == "settings":
+                    if value:
+                        self.writer.execute("INSERT OR REPLACE INTO user_settings VALUES (?, ?)",
+                                            (key, json.dumps(value, ensure_ascii=False)))
+                    else:
+                        self.writer.execute("DELETE FROM user_settings WHERE chat_id = ?", (key,))
+                elif kind == "subscription":
+                    if value:
+                        self.writer.execute("INSERT OR REPLACE INTO subscriptions VALUES (?, ?, ?)", (*key, value))
+                    else:
+                        self.writer.execute("DELETE FROM subscriptions WHERE chat_id = ? AND sub_type = ?", key)
+                elif kind == "quiz":
+                    if value:
+                        self.writer.execute("INSERT OR REPLACE INTO quiz_stats VALUES (?, ?, ?, ?)",
+                                            (key, value.get("score", 0), value.get("updated", 0),
+                                             json.dumps(value, ensure_ascii=False)))
+                    else:
+                        self.writer.execute("DELETE FROM quiz_stats WHERE user_id = ?", (key,))
+                elif kind == "reminder":
+                    if value:
+                        self.writer.execute("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?)", (key, *value))
+                    else:
+                        self.writer.execute("DELETE FROM reminders WHERE id = ?", (key,))
+                elif kind == "alert":
+                    if value:
+                        self.writer.execute("INSERT OR REPLACE INTO weather_alerts VALUES (?, ?, ?)",
+                                            (key, value[0], json.dumps(value[1], ensure_ascii=False)))
+                    else:
+                        self.writer.execute("DELETE FROM weather_alerts WHERE id = ?", (key,))
+                elif kind == "next_id":
+                    self.writer.execute("INSERT OR REPLACE INTO id_counters VALUES (?, ?, ?)", (*key, value))
+
+    def close(self) -> None:
+        self.reader.close()
+        self.writer.close()
+
+def create_storage() -> Storage:
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    return SQLiteStorage(STORAGE_PATH)
+
+# Отложенная запись: изменения копятся (повторные по одному ключу схлопываются)
+# и раз в STORAGE_FLUSH_INTERVAL уходят в хранилище одной транзакцией в потоке.
+class StorageWriter:
+    def __init__(self, storage: Storage):
+        self.storage = storage
+        self.pending = {}   # {(вид, ключ): значение}
+        self.inflight = {}  # то же для пачки, которая сейчас пишется
+        self.wakeup = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.stopping = False
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # Фоновую запись не отменяем: поток с apply() отмена не остановит, и
+        # соединение закрылось бы под ним. Цикл сам допишет пачку и выйдет.
+        if self.task is not None:
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+        await self.flush()
+        self.storage.close()
+
+    def put(self, kind: str, key, value) -> None:
+        self.pending[(kind, key)] = value
+        if len(self.pending) >= STORAGE_BATCH_SIZE:
+            self.wakeup.set()
+
+    # Последнее значение, ещё не дошедшее до хранилища: выгруженный чат
+    # поднимается с ним, а не с устаревшей строкой из базы
+    def lookup(self, kind: str, key, default=None):
+        item = (kind, key)
+        if item in self.pending:
+            return self.pending[item]
+        return self.inflight.get(item, default)
+
+    async def flush(self) -> None:
+        async with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            self.inflight = pending
+            # Снимок делаем в event loop, пока значения никто не меняет;
+            # от списка задач берутся только изменённые задачи
+            ops = [(kind, key, value.take_changes() if isinstance(value, TodoList)
+                    else value.copy() if isinstance(value, (list, dict)) else value)
+                   for (kind, key), value in pending.items()]
+            try:
+                await asyncio.to_thread(self.storage.apply, ops)
+            except Exception as e:
+                logger.error("Ошибка записи в хранилище: %s", e)
+                for (_, _, written), (item, value) in zip(ops, pending.items()):
+                    if isinstance(value, TodoList):
+                        value.changed.update(task_id for task_id, _ in written)
+                    self.pending.setdefault(item, value)
+            finally:
+                self.inflight = {}
+
+    async def _run(self) -> None:
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), STORAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+# ------------------ Задачи (To-Do) ------------------
+# Задачи чата — словарь {id: Task}: id стабильны (удаление не сдвигает
+# номера остальных задач) и удаляются за O(1). Список выводится по
+# приоритету, сроку и id; страницу выбирает heapq.nsmallest по ключам от
+# курсора, поэтому держать задачи отсортированными не нужно. Курсор —
+# ключ первой задачи страницы, он и уходит в callback_data кнопок. Срок
+# задачи ставится напоминанием в ReminderScheduler, его куча и доставляет.
+# В хранилище пишутся только задачи, изменённые с прошлой записи.
+TASK_PRIORITIES = {1: "🔴 ", 2: "", 3: "🔵 "}  # 1 — высокий, 2 — обычный, 3 — низкий
+TASK_PRIORITY_MARK = re.compile(r"!([123])")
+TASK_ID_RANGE = re.compile(r"#?(\d+)(?:-#?(\d+))?")
+NO_DUE = 2 ** 40  # задачи без срока в ключе сортировки идут после всех сроков
+
+class Task:
+    __slots__ = ("text", "priority", "due", "reminder")
+
+    def __init__(self, text: str, priority: int = 2, due: int = None, reminder: int = None):
+        self.text = text
+        self.priority = priority
+        self.due = due            # timestamp или None
+        self.reminder = reminder  # id напоминания о сроке или None
+
+    def row(self) -> tuple:
+        return self.text, self.priority, self.due, self.reminder
+
+class TodoList:
+    __slots__ = ("tasks", "next_id", "changed")
+
+    def __init__(self, rows=(), next_id: int = 1):
+        self.tasks = {}  # {id: Task} в порядке добавления
+        for task_id, text, priority, due, reminder in rows:
+            self.tasks[task_id] = Task(text, priority, due, reminder)
+        # Сохранённый счётчик: id удалённой последней задачи не достаётся новой
+        self.next_id = max(next_id, max(self.tasks, default=0) + 1)
+        self.changed = set()  # id задач, изменённых с прошлой записи в хранилище
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+    def key(self, task_id: int) -> tuple:
+        task = self.tasks[task_id]
+        return task.priority, task.due or NO_DUE, task_id
+
+    def add(self, text: str, priority: int = 2, due: int = None) -> int:
+        task_id = self.next_id
+        self.next_id += 1
+        self.tasks[task_id] = Task(text, priority, due)
+        self.changed.add(task_id)
+        return task_id
+
+    def remove(self, task_id: int):
+        task = self.tasks.pop(task_id, None)
+        if task is not None:
+            self.changed.add(task_id)
+        return task
+
+    # Страница с задачи start включительно или последняя полная страница
+    # перед before: ([(id, Task), ...], есть ли задачи раньше, ключ следующей страницы)
+    def page(self, size: int, start: tuple = None, before: tuple = None) -> tuple:
+        keys = [self.key(task_id) for task_id in self.tasks]
+        if before is not None:
+            chosen = nlargest(size, (key for key in keys if key < before))
+            return self.page(size, start=min(chosen)) if len(chosen) == size else self.page(size)
+        chosen = nsmallest(size + 1, (key for key in keys if start is None or key >= start))
+        if not chosen and start is not None and keys:  # страница опустела после удаления
+            return self.page(size, before=start)
+        next_key = chosen.pop() if len(chosen) > size else None
+        has_prev = bool(chosen) and any(key < chosen[0] for key in keys)
+        return [(key[2], self.tasks[key[2]]) for key in chosen], has_prev, next_key
+
+    def take_changes(self) -> list:  # [(id, строка или None), ...]
+        changed, self.changed = self.changed, set()
+        return [(task_id, self.tasks[task_id].row() if task_id in self.tasks else None) for task_id in changed]
+
+# Строка задачи: текст с необязательными пометками «!1»…«!3» (приоритет)
+# и «@когда» (срок в формате /reminder: @90m, @18:30, @2025-01-31 18:30).
+# Возвращает (текст, приоритет, срок) или None, если срок не разобран.
+def parse_task(line: str, now: datetime):
+    words, priority, due = [], 2, None
+    tokens = line.split()
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        mark = TASK_PRIORITY_MARK.fullmatch(token)
+        if mark:
+            priority = int(mark.group(1))
+        elif token.startswith("@") and len(token) > 1:
+            parsed = parse_reminder_time([token[1:], *tokens[i + 1:i + 2]], now)
+            if parsed is None:
+                return None
+            due = ceil(parsed[0])
+            i += parsed[1] - 1
+        else:
+            words.append(token)
+        i += 1
+    return " ".join(words)[:TODO_TEXT_MAX], priority, due
+
+# «1-5,8» → [1, 2, 3, 4, 5, 8]; диапазоны обрезаются по last_id. None — не разобрано.
+def parse_task_ids(spec: str, last_id: int):
+    task_ids = []
+    for part in filter(None, spec.replace(" ", "").split(",")):
+        match = TASK_ID_RANGE.fullmatch(part)
+        if not match:
+            return None
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if last < first:
+            return None
+        task_ids.extend(range(first, min(last, last_id) + 1))
+    return task_ids
+
+def schedule_task_reminder(chat_id: int, task_id: int, task: Task, now: float) -> bool:
+    if task.due is None or task.due <= now or reminder_scheduler.count(chat_id) >= REMINDER_MAX_PER_CHAT:
+        return False
+    task.reminder = reminder_scheduler.add(chat_id, task.due, f"задача #{task_id}: {task.text}")
+    return True
+
+def cancel_task_reminder(chat_id: int, task: Task) -> None:
+    if task.reminder is not None:
+        reminder_scheduler.cancel(chat_id, task.reminder)
+
+# Каждая непустая строка текста — отдельная задача. Возвращает HTML-ответ.
+def add_tasks(chat_id: int, text: str) -> str:
+    todo = get_tasks(chat_id)
+    now = datetime.now()
+    added, skipped = [], []
+    for line in filter(str.strip, text.splitlines()):
+        if len(todo) >= TODO_MAX_PER_CHAT:
+            skipped.append(f"не больше {TODO_MAX_PER_CHAT} задач в списке")
+            break
+        try:
+            parsed = parse_task(line, now)
+        except (ValueError, OverflowError):
+            parsed = None
+        if parsed is None or not parsed[0]:
+            skipped.append(f"не разобрана строка «{html.escape(line.strip()[:50])}»")
+            continue
+        task_id = todo.add(*parsed)
+        schedule_task_reminder(chat_id, task_id, todo.tasks[task_id], now.timestamp())
+        added.append(task_id)
+    if added:
+        save_tasks(chat_id)
+    if len(added) == 1:
+        lines = ["Задача добавлена: " + format_task(added[0], todo.tasks[added[0]], now.timestamp())]
+    elif added:
+        lines = [f"Добавлено задач: {len(added)} (#{added[0]}–#{added[-1]})"]
+    else:
+        lines = ["Задачи не добавлены."]
+    lines += [f"• {reason}" for reason in skipped]
+    return "\n".join(lines)
+
+def remove_tasks(chat_id: int, task_ids: list) -> list:  # [(id, Task), ...] удалённых
+    todo = get_tasks(chat_id)
+    removed = []
+    for task_id in task_ids:
+        task = todo.remove(task_id)
+        if task is not None:
+            cancel_task_reminder(chat_id, task)
+            removed.append((task_id, task))
+    if removed:
+        save_tasks(chat_id)
+    return removed
+
+def format_task(task_id: int, task: Task, now: float) -> str:
+    line = f"#{task_id} {TASK_PRIORITIES[task.priority]}{html.escape(task.text)}"
+    if task.due is not None:
+        line += f" — до {datetime.fromtimestamp(task.due):%d.%m.%Y %H:%M}" + (" ⚠️" if task.due <= now else "")
+    return line
+
+# Курсор страницы в callback_data: (1, *ключ) — с задачи, (0, *ключ) — перед ней
+def todo_cursor(args: tuple) -> dict:
+    if len(args) != 4:
+        return {}
+    return {"start" if args[0] else "before": tuple(args[1:])}
+
+def render_todo_page(chat_id: int, cursor: dict, removing: bool = False) -> tuple:
+    todo = get_tasks(chat_id)
+    if not todo:
+        return "Список задач пуст.", None
+    items, has_prev, next_key = todo.page(TODO_PAGE_SIZE, **cursor)
+    now = datetime.now().timestamp()
+    lines = ["<b>Выберите задачу для удаления:</b>" if removing else "<b>Ваш список задач:</b>"]
+    lines += [format_task(task_id, task, now) for task_id, task in items]
+    lines.append(f"\nВсего задач: {len(todo)}. Удалить несколько: /todo remove 1-5,8")
+    first_key = todo.key(items[0][0])
+    action = "remove" if removing else "list"
+    rows = []
+    if removing:
+        rows += [[InlineKeyboardButton(f"❌ #{task_id} {task.text[:30]}",
+                                       callback_data=callback_data("todo", "del", task_id, 1, *first_key))]
+                 for task_id, task in items]
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("« Назад", callback_data=callback_data("todo", action, 0, *first_key)))
+    if next_key is not None:
+        nav.append(InlineKeyboardButton("Дальше »", callback_data=callback_data("todo", action, 1, *next_key)))
+    if nav:
+        rows.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(rows) if rows else None
+
+# ------------------ Состояние чатов ------------------
+# Всё, что бот помнит о чате, — одна запись ChatState со __slots__: задачи,
+# настройки и шаг диалога (вместо словарей todo_tasks, user_settings и
+# context.user_data). Записи лежат в LRU chat_states; чаты сверх
+# CHAT_CACHE_SIZE и молчащие дольше CHAT_IDLE_TTL выгружаются. Их данные уже
+# в хранилище или в очереди StorageWriter, оттуда они и поднимаются при
+# следующем обновлении. Незаконченный шаг диалога при выгрузке дописывается
+# в настройки чата.
+class ChatMode(IntEnum):
+    IDLE = 0
+    TODO_ADD = 1   # следующий текст — новая задача
+    TRANSLATE = 2  # следующий текст — перевести с src_lang на target_lang
+
+# Коды языков — общие строки из LANGUAGES, а не копии из каждого callback_data
+LANGUAGE_CODES = {code: code for code in LANGUAGES}
+
+class ChatState:
+    __slots__ = ("tasks", "city", "lat", "lon", "feeds", "mode", "src_lang", "target_lang", "spilled", "last_seen")
+
+    def __init__(self, data: dict):
+        self.tasks = None  # TodoList; загружается при первом обращении
+        self.city = data.get("city")
+        self.lat = data.get("lat")
+        self.lon = data.get("lon")
+        self.feeds = tuple(sys.intern(feed_id) for feed_id in data.get("feeds", ()))
+        self.mode = ChatMode(data.get("mode", ChatMode.IDLE))
+        self.src_lang = LANGUAGE_CODES.get(data.get("src"))
+        self.target_lang = LANGUAGE_CODES.get(data.get("tgt"))
+        self.spilled = "mode" in data  # в хранилище записан шаг диалога
+        self.last_seen = monotonic()
+
+    def settings(self) -> dict:
+        data = {}
+        if self.city:
+            data["city"] = self.city
+        if self.lat is not None:
+            data.update(lat=self.lat, lon=self.lon)
+        if self.feeds:
+            data["feeds"] = list(self.feeds)
+        if self.mode != ChatMode.IDLE:
+            data.update(mode=int(self.mode), src=self.src_lang, tgt=self.target_lang)
+        return data
+
+    def reset_dialog(self) -> None:
+        self.mode = ChatMode.IDLE
+        self.src_lang = self.target_lang = None
+
+chats_evicted = 0
+
+def get_chat(chat_id: int) -> ChatState:
+    state = chat_states.get(chat_id)
+    if state is not None:
+        chat_states.move_to_end(chat_id)
+        state.last_seen = monotonic()
+        return state
+    data = storage_writer.lookup("settings", chat_id)
+    state = chat_states[chat_id] = ChatState(data if data is not None else storage.load_settings(chat_id))
+    if len(chat_states) > CHAT_CACHE_SIZE:
+        evict_chats()
+    return state
+
+# Город и координаты для рассылки: слот в 08:00 охватывает десятки тысяч
+# чатов, поэтому выгруженные читаются одним запросом в потоке и в
+# chat_states не попадают — активные чаты из памяти не вытесняются
+async def subscriber_places(chat_ids: list) -> dict:  # {chat_id: (город, координаты)}
+    places, missing = {}, []
+    for chat_id in chat_ids:
+        state = chat_states.get(chat_id)
+        if state is not None:
+            places[chat_id] = (state.city, (state.lat, state.lon) if state.lat is not None else None)
+            continue
+        data = storage_writer.lookup("settings", chat_id)
+        if data is None:
+            missing.append(chat_id)
+        else:
+            places[chat_id] = settings_place(data)
+    if missing:
+        loaded = await asyncio.to_thread(storage.load_settings_many, missing)
+        for chat_id in missing:
+            places[chat_id] = settings_place(loaded.get(chat_id, {}))
+    return places
+
+def settings_place(data: dict) -> tuple:
+    coords = (data["lat"], data["lon"]) if data.get("lat") is not None else None
+    return data.get("city"), coords
+
+def evict_chats() -> int:
+    global chats_evicted
+    deadline = monotonic() - CHAT_IDLE_TTL
+    evicted = 0
+    while chat_states:
+        chat_id, state = next(iter(chat_states.items()))
+        if len(chat_states) <= CHAT_CACHE_SIZE and state.last_seen > deadline:
+            break
+        del chat_states[chat_id]
+        if state.mode != ChatMode.IDLE or state.spilled:
+            save_settings(chat_id, state)
+        evicted += 1
+    chats_evicted += evicted
+    return evicted
+
+# Статистика квиза записывается при каждом изменении, поэтому игроков
+# выгружаем по тем же правилам, что и чаты, ничего не дописывая
+def evict_quiz_players() -> int:
+    deadline = monotonic() - CHAT_IDLE_TTL
+    evicted = 0
+    while quiz_stats:
+        user_id, (_, last_seen) = next(iter(quiz_stats.items()))
+        if len(quiz_stats) <= CHAT_CACHE_SIZE and last_seen > deadline:
+            break
+        del quiz_stats[user_id]
+        evicted += 1
+    return evicted
+
+async def evict_idle_chats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    evicted = evict_chats()
+    if evicted:
+        logger.info("Выгружено чатов: %d, в памяти: %d", evicted, len(chat_states))
+    evicted = evict_quiz_players()
+    if evicted:
+        logger.info("Выгружено игроков квиза: %d, в памяти: %d", evicted, len(quiz_stats))
+
+@metrics.collector
+def collect_chat_metrics() -> list:
+    return [
+        ("omnibot_chats_resident", "gauge", (), len(chat_states)),
+        ("omnibot_chats_evicted_total", "counter", (), chats_evicted),
+        ("omnibot_quiz_players_resident", "gauge", (), len(quiz_stats)),
+    ]
+
+# Application без persistence всё равно копит id каждого чата и пользователя
+# в множествах «на сохранение», которые никто не очищает, — это растущая
+# без предела память. Хранилище у бота своё, так что эти множества не нужны.
+class OmniApplication(Application):
+    def _mark_for_persistence_update(self, *, update=None, job=None) -> None:
+        if self.persistence is not None:
+            super()._mark_for_persistence_update(update=update, job=job)
+
+def get_tasks(chat_id: int) -> TodoList:
+    state = get_chat(chat_id)
+    if state.tasks is None:
+        tasks = storage_writer.lookup("tasks", chat_id)
+        state.tasks = tasks if tasks is not None else TodoList(storage.load_tasks(chat_id), load_next_id("tasks", chat_id))
+    return state.tasks
+
+def save_tasks(chat_id: int) -> None:
+    tasks = get_tasks(chat_id)
+    storage_writer.put("tasks", chat_id, tasks)
+    storage_writer.put("next_id", ("tasks", chat_id), tasks.next_id)
+
+# Счётчик id с учётом ещё не записанного в хранилище
+def load_next_id(scope: str, key: int = 0) -> int:
+    next_id = storage_writer.lookup("next_id", (scope, key))
+    return next_id if next_id is not None else storage.load_next_id(scope, key)
+
+def save_settings(chat_id: int, state: ChatState = None) -> None:
+    state = state or get_chat(chat_id)
+    data = state.settings()
+    state.spilled = "mode" in data
+    storage_writer.put("settings", chat_id, data)
+
+# Незаписанная статистика берётся из очереди StorageWriter, промах читается
+# из хранилища в потоке, чтобы не блокировать event loop
+async def get_quiz_stats(user_id: int) -> dict:
+    entry = quiz_stats.get(user_id)
+    if entry is None:
+        stats = storage_writer.lookup("quiz", user_id)
+        if stats is None:
+            stats = await asyncio.to_thread(storage.load_quiz, user_id)
+        # Пока читали, игрока мог загрузить параллельный обработчик
+        entry = quiz_stats.get(user_id)
+        if entry is None:
+            entry = quiz_stats[user_id] = [stats, monotonic()]
+            if len(quiz_stats) > CHAT_CACHE_SIZE:
+                evict_quiz_players()
+            return stats
+    quiz_stats.move_to_end(user_id)
+    entry[1] = monotonic()
+    return entry[0]
+
+def save_quiz_stats(user_id: int, stats: dict) -> None:
+    storage_writer.put("quiz", user_id, stats)
+
+# ------------------ Отправка сообщений ------------------
+# Токен-бакет с резервированием: take() списывает токен и возвращает,
+# сколько нужно подождать до отправки (баланс может уйти в минус).
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    # Через сколько появится целый токен — без списания
+    def available_in(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+# Все запросы к Bot API (reply_text, edit_message_text, bot.send_message, ...)
+# проходят через этот лимитер: общий бакет на бота и бакеты по чатам для
+# методов, пишущих в чат. Ответы пользователям резервируют токен сразу
+# (в долг), рассылки берут токен, только когда он свободен, — поэтому
+# интерактивные ответы всегда обгоняют рассылку. RetryAfter ставит на паузу
+# все запросы бота, сетевые ошибки повторяются с экспоненциальной задержкой.
+PRIORITY_BROADCAST = "broadcast"  # rate_limit_args для запросов рассылки
+UNLIMITED_ENDPOINTS = frozenset({"getMe", "getUpdates", "setWebhook", "deleteWebhook", "getWebhookInfo",
+                                 "logOut", "close"})
+CHAT_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+# После таймаута чтения или обрыва соединения запрос мог уже дойти до Telegram,
+# и повтор send*/edit* задвоил бы сообщение. Для них повторяем только ошибки,
+# при которых запрос точно не был отправлен.
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class OutboundRateLimiter(BaseRateLimiter):
+    def __init__(self):
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chat_buckets = {}  # {chat_id: TokenBucket}
+        self.paused_until = 0.0
+        self.retry_after = 0
+        self.retries = 0
+        self.delayed = {"interactive": 0, "broadcast": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if not b.full()}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(SEND_PER_CHAT_RATE, SEND_PER_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id, broadcast: bool) -> None:
+        lane = "broadcast" if broadcast else "interactive"
+        delayed = False
+        while True:
+            pause = self.paused_until - monotonic()
+            if pause > 0:
+                delayed = True
+                await asyncio.sleep(pause)
+                continue
+            chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if broadcast:
+                wait = max(self.global_bucket.available_in(), chat_bucket.available_in() if chat_bucket else 0.0)
+                if wait > 0:
+                    delayed = True
+                    await asyncio.sleep(wait)
+                    continue
+            wait = max(self.global_bucket.take(), chat_bucket.take() if chat_bucket else 0.0)
+            if wait > 0:
+                delayed = True
+                await asyncio.sleep(wait)
+            if delayed:
+                self.delayed[lane] += 1
+            return
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        broadcast = rate_limit_args == PRIORITY_BROADCAST
+        writes_chat = endpoint.startswith(CHAT_ENDPOINT_PREFIXES)
+        chat_id = data.get("chat_id") if writes_chat else None
+        for attempt in range(SEND_RETRIES):
+            await self._acquire(chat_id, broadcast)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                if attempt == SEND_RETRIES - 1:
+                    raise
+                self.paused_until = max(self.paused_until, monotonic() + e.retry_after)
+                logger.warning("Telegram просит подождать %s с (%s)", e.retry_after, endpoint)
+            except BadRequest:
+                raise  # подкласс NetworkError, но повтор не поможет
+            except NetworkError as e:
+                if attempt == SEND_RETRIES - 1 or writes_chat and not isinstance(e.__cause__, UNSENT_ERRORS):
+                    raise
+                self.retries += 1
+                logger.warning("Повтор %s после ошибки сети: %s", endpoint, e)
+                await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
+# Очередь массовой отправки (нижний приоритет в OutboundRateLimiter).
+# Пока сообщение ждёт в очереди, новые сообщения в тот же чат с теми же
+# параметрами дописываются к нему (SEND_MERGE), если влезают в лимит длины.
+class SendPipeline:
+    def __init__(self, bot):
+        self.bot = bot
+        self.queue = asyncio.Queue()
+        self.queued = {}  # {chat_id: [chat_id, text, kwargs, on_done]} — ещё не взятые в отправку
+        self.workers = []
+        self.sent = 0
+        self.failed = 0
+        self.merged = 0
+
+    def start(self) -> None:
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(SEND_WORKERS)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Рассылка: не отправлено %d сообщений при остановке", self.queue.qsize())
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+
+    # on_done(error) вызывается после попытки отправки: error — None, если
+    # сообщение ушло, иначе исключение
+    def submit(self, chat_id: int, text: str, on_done=None, **kwargs) -> None:
+        if SEND_MERGE:
+            entry = self.queued.get(chat_id)
+            if entry is not None and entry[2] == kwargs and len(entry[1]) + len(text) + 2 <= MessageLimit.MAX_TEXT_LENGTH:
+                entry[1] += "\n\n" + text
+                if on_done is not None:
+                    entry[3].append(on_done)
+                self.merged += 1
+                return
+        entry = [chat_id, text, kwargs, [on_done] if on_done is not None else []]
+        if SEND_MERGE:
+            self.queued[chat_id] = entry
+        self.queue.put_nowait(entry)
+
+    async def _worker(self) -> None:
+        while True:
+            entry = await self.queue.get()
+            if self.queued.get(entry[0]) is entry:
+                del self.queued[entry[0]]
+            chat_id, text, kwargs, on_done = entry
+            error = None
+            try:
+                await self.bot.send_message(chat_id, text=text, rate_limit_args=PRIORITY_BROADCAST, **kwargs)
+                self.sent += 1
+            except Forbidden as e:
+                self.failed += 1  # пользователь заблокировал бота
+                error = e
+            except Exception as e:
+                self.failed += 1
+                error = e
+                logger.error("Ошибка рассылки в чат %s: %s", chat_id, e)
+            finally:
+                self.queue.task_done()
+            for callback in on_done:
+                callback(error)
+
+# ------------------ Напоминания ------------------
+# Все напоминания — в куче [(срок, id)] и словаре по id; отменённые из кучи
+# не удаляются, а пропускаются при извлечении. Один диспетчер спит до
+# ближайшего срока (или до добавления более раннего напоминания), забирает
+# всё, что наступило, и отдаёт пачкой в очередь рассылки. Хранилище — таблица
+# reminders, при старте она загружается целиком. Из хранилища напоминание
+# удаляется только после отправки; неотправленное возвращается в кучу через
+# REMINDER_RETRY_DELAY, пока не кончатся попытки.
+class ReminderScheduler:
+    def __init__(self):
+        self.heap = []       # [(due, id), ...]
+        self.reminders = {}  # {id: (chat_id, due, text)}
+        self.by_chat = {}    # {chat_id: {id, ...}}
+        self.sending = {}    # {id: (chat_id, due, text, попытка)} — отданные в рассылку
+        self.next_id = 1
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.delivered = 0
+
+    def load(self, rows: list, next_id: int = 1) -> None:
+        self.next_id = max(self.next_id, next_id)
+        for reminder_id, chat_id, due, text in rows:
+            self.reminders[reminder_id] = (chat_id, due, text)
+            self.by_chat.setdefault(chat_id, set()).add(reminder_id)
+            self.heap.append((due, reminder_id))
+            self.next_id = max(self.next_id, reminder_id + 1)
+        heapify(self.heap)
+
+    def start(self, pipeline) -> None:
+        self.task = asyncio.create_task(self._run(pipeline))
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def count(self, chat_id: int) -> int:
+        return len(self.by_chat.get(chat_id, ()))
+
+    def add(self, chat_id: int, due: float, text: str) -> int:
+        reminder_id = self.next_id
+        self.next_id += 1
+        storage_writer.put("next_id", ("reminder", 0), self.next_id)
+        self.reminders[reminder_id] = (chat_id, due, text)
+        self.by_chat.setdefault(chat_id, set()).add(reminder_id)
+        if not self.heap or due < self.heap[0][0]:
+            self.wakeup.set()
+        heappush(self.heap, (due, reminder_id))
+        storage_writer.put("reminder", reminder_id, (chat_id, due, text))
+        return reminder_id
+
+    def _discard(self, reminder_id: int, keep_stored: bool = False):
+        item = self.reminders.pop(reminder_id, None)
+        if item is not None:
+            ids = self.by_chat[item[0]]
+            ids.discard(reminder_id)
+            if not ids:
+                del self.by_chat[item[0]]
+            if not keep_stored:
+                self.sending.pop(reminder_id, None)
+                storage_writer.put("reminder", reminder_id, None)
+        return item
+
+    def cancel(self, chat_id: int, reminder_id: int) -> bool:
+        if reminder_id not in self.by_chat.get(chat_id, ()):
+            return False
+        self._discard(reminder_id)
+        return True
+
+    def cancel_all(self, chat_id: int) -> int:
+        ids = list(self.by_chat.get(chat_id, ()))
+        for reminder_id in ids:
+            self._discard(reminder_id)
+        return len(ids)
+
+    def list(self, chat_id: int) -> list:  # [(id, due, text), ...] по сроку
+        items = [(reminder_id, *self.reminders[reminder_id][1:]) for reminder_id in self.by_chat.get(chat_id, ())]
+        return sorted(items, key=lambda item: item[1])
+
+    # Наступившие напоминания переходят в sending и остаются в хранилище
+    # до подтверждения отправки (done)
+    def pop_due(self, now: float) -> list:  # [(id, chat_id, text), ...]
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, reminder_id = heappop(self.heap)
+            item = self._discard(reminder_id, keep_stored=True)
+            if item is not None:
+                attempt = self.sending.pop(reminder_id, (0, 0, "", 0))[3] + 1
+                self.sending[reminder_id] = (*item, attempt)
+                due.append((reminder_id, item[0], item[2]))
+        # Кучу чистим от отменённых, если их стало больше половины
+        if len(self.heap) > 1024 and len(self.heap) > 2 * len(self.reminders):
+            self.heap = [(due_at, reminder_id) for due_at, reminder_id in self.heap if reminder_id in self.reminders]
+            heapify(self.heap)
+        return due
+
+    # Итог отправки: ушло или получатель заблокировал бота — удаляем,
+    # иначе повторяем позже
+    def done(self, reminder_id: int, error) -> None:
+        chat_id, due, text, attempt = self.sending[reminder_id]
+        if error is None or isinstance(error, Forbidden) or attempt >= REMINDER_RETRIES:
+            del self.sending[reminder_id]
+            storage_writer.put("reminder", reminder_id, None)
+            if error is None:
+                self.delivered += 1
+            elif not isinstance(error, Forbidden):
+                logger.error("Напоминание #%d не отправлено после %d попыток", reminder_id, attempt)
+            return
+        retry_at = datetime.now().timestamp() + REMINDER_RETRY_DELAY
+        self.reminders[reminder_id] = (chat_id, retry_at, text)
+        self.by_chat.setdefault(chat_id, set()).add(reminder_id)
+        if not self.heap or retry_at < self.heap[0][0]:
+            self.wakeup.set()
+        heappush(self.heap, (retry_at, reminder_id))
+        storage_writer.put("reminder", reminder_id, (chat_id, retry_at, text))
+
+    async def _run(self, pipeline) -> None:
+        while True:
+            self.wakeup.clear()
+            now = datetime.now().timestamp()
+            due = self.pop_due(now)
+            for reminder_id, chat_id, text in due:
+                pipeline.submit(chat_id, f"⏰ Напоминание: {text}", on_done=partial(self.done, reminder_id))
+            if due:
+                logger.info("Напоминания: в рассылку %d", len(due))
+            timeout = min(self.heap[0][0] - now, REMINDER_MAX_SLEEP) if self.heap else REMINDER_MAX_SLEEP
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
+
+reminder_scheduler = ReminderScheduler()
+
+# Время напоминания: через сколько («90», «10m», «1h30m», «2d») или когда
+# («18:30», «2025-01-31 18:30») — по часам сервера. Возвращает
+# (timestamp, сколько аргументов заняло время) или None.
+DURATION_PART = re.compile(r"(\d+)([smhd]?)")
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+def parse_reminder_time(args: list, now: datetime):
+    first = args[0].lower()
+    if re.fullmatch(r"(\d+[smhd]?)+", first):
+        seconds = sum(int(value) * DURATION_UNITS[unit] for value, unit in DURATION_PART.findall(first))
+        return (now + timedelta(seconds=seconds)).timestamp(), 1
+    if len(args) > 1 and re.fullmatch(r"\d{4}-\d{2}-\d{2}", first):
+        try:
+            return datetime.strptime(f"{first} {args[1]}", "%Y-%m-%d %H:%M").timestamp(), 2
+        except ValueError:
+            return None
+    try:
+        moment = datetime.combine(now.date(), datetime.strptime(first, "%H:%M").time())
+    except ValueError:
+        return None
+    if moment <= now:
+        moment += timedelta(days=1)
+    return moment.timestamp(), 1
+
+def format_due(due: float) -> str:
+    return datetime.fromtimestamp(due).strftime("%d.%m.%Y %H:%M:%S")
+
+def reminders_keyboard(items: list):
+    buttons = [InlineKeyboardButton(f"❌ #{reminder_id}", callback_data=callback_data("reminder", "cancel", reminder_id))
+               for reminder_id, _, _ in items[:12]]
+    return InlineKeyboardMarkup([buttons[i:i+4] for i in range(0, len(buttons), 4)]) if buttons else None
+
+def render_reminders(chat_id: int) -> tuple:
+    items = reminder_scheduler.list(chat_id)
+    if not items:
+        return "Активных напоминаний нет.", None
+    lines = ["<b>Ваши напоминания:</b>"]
+    lines += [f"#{reminder_id} — {format_due(due)}: {html.escape(text)}" for reminder_id, due, text in items[:50]]
+    if len(items) > 50:
+        lines.append(f"…и ещё {len(items) - 50}")
+    lines.append("\nОтменить: /reminders cancel &lt;номер&gt; или /reminders cancel all")
+    return "\n".join(lines), reminders_keyboard(items)
+
+# ------------------ Оповещения о погоде ------------------
+# Условия пользователей («температура ниже 0», «будет дождь») проверяет
+# один фоновый наблюдатель: каждое место (город или ячейка геосетки)
+# опрашивается раз в ALERT_CHECK_INTERVAL независимо от числа подписчиков.
+# Условия места хранятся по столбцам (метрика, знак) — порогам в
+# отсортированном array и id оповещений рядом. Срабатывают только условия,
+# ставшие истинными с прошлого замера: это пороги между старым и новым
+# значением, их диапазон находится двумя бинарными поисками, так что
+# проверка не перебирает пользователей, у которых ничего не изменилось.
+ALERT_METRICS = {
+    "temp": ("температура", "°C"),
+    "humidity": ("влажность", "%"),
+    "rain": ("осадки", ""),
+}
+ALERT_ALIASES = {"температура": "temp", "влажность": "humidity", "дождь": "rain", "осадки": "rain", "снег": "rain"}
+
+class AlertColumn:
+    def __init__(self):
+        self.thresholds = array("d")  # по возрастанию
+        self.ids = array("q")
+
+    def add(self, threshold: float, alert_id: int) -> None:
+        index = bisect_left(self.thresholds, threshold)
+        self.thresholds.insert(index, threshold)
+        self.ids.insert(index, alert_id)
+
+    def remove(self, threshold: float, alert_id: int) -> None:
+        index = bisect_left(self.thresholds, threshold)
+        while self.ids[index] != alert_id:
+            index += 1
+        del self.thresholds[index]
+        del self.ids[index]
+
+    # id условий, ложных при previous и истинных при value
+    def rising(self, op: str, previous: float, value: float):
+        if op == ">":  # previous <= порог < value
+            lo, hi = bisect_left(self.thresholds, previous), bisect_left(self.thresholds, value)
+        else:          # value < порог <= previous
+            lo, hi = bisect_right(self.thresholds, value), bisect_right(self.thresholds, previous)
+        return self.ids[lo:hi] if lo < hi else ()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+class AlertPlace:
+    def __init__(self, city: str, coords: tuple):
+        self.city = city
+        self.coords = coords
+        self.columns = {}     # {(метрика, знак): AlertColumn}
+        self.snapshot = None  # {метрика: значение} последнего замера
+
+    def metrics(self) -> set:
+        return {metric for metric, _ in self.columns}
+
+class AlertWatcher:
+    def __init__(self):
+        self.alerts = {}  # {id: (chat_id, ключ места, метрика, знак, порог)}
+        self.places = {}  # {ключ места: AlertPlace}
+        self.by_chat = {}  # {chat_id: {id, ...}}
+        self.next_id = 1
+        self.checks = 0
+        self.fired = 0
+
+    def load(self, rows: list, next_id: int = 1) -> None:
+        self.next_id = max(self.next_id, next_id)
+        for alert_id, chat_id, data in rows:
+            coords = (data["lat"], data["lon"]) if "lat" in data else None
+            self._insert(alert_id, chat_id, data["city"], coords, data["metric"], data["op"], data["threshold"])
+            self.next_id = max(self.next_id, alert_id + 1)
+
+    def _insert(self, alert_id, chat_id, city, coords, metric, op, threshold) -> None:
+        key = weather_key(city, coords)
+        place = self.places.get(key)
+        if place is None:
+            place = self.places[key] = AlertPlace(city, coords)
+        place.columns.setdefault((metric, op), AlertColumn()).add(threshold, alert_id)
+        self.alerts[alert_id] = (chat_id, key, metric, op, threshold)
+        self.by_chat.setdefault(chat_id, set()).add(alert_id)
+
+    def count(self, chat_id: int) -> int:
+        return len(self.by_chat.get(chat_id, ()))
+
+    # current — замер места при создании: новое условие сравнивается с ним, а не с пустотой
+    def add(self, chat_id: int, city: str, coords: tuple, metric: str, op: str, threshold: float, current: dict) -> int:
+        alert_id = self.next_id
+        self.next_id += 1
+        storage_writer.put("next_id", ("alert", 0), self.next_id)
+        self._insert(alert_id, chat_id, city, coords, metric, op, threshold)
+        place = self.places[weather_key(city, coords)]
+        place.snapshot = dict(current, **(place.snapshot or {}))
+        data = {"city": city, "metric": metric, "op": op, "threshold": threshold}
+        if coords:
+            data.update(lat=coords[0], lon=coords[1])
+        storage_writer.put("alert", alert_id, (chat_id, data))
+        return alert_id
+
+    def _discard(self, alert_id: int) -> None:
+        chat_id, key, metric, op, threshold = self.alerts.pop(alert_id)
+        place = self.places[key]
+        column = place.columns[(metric, op)]
+        column.remove(threshold, alert_id)
+        if not column:
+            del place.columns[(metric, op)]
+            if not place.columns:
+                del self.places[key]
+        ids = self.by_chat[chat_id]
+        ids.discard(alert_id)
+        if not ids:
+            del self.by_chat[chat_id]
+        storage_writer.put("alert", alert_id, None)
+
+    def cancel(self, chat_id: int, alert_id: int) -> bool:
+        if alert_id not in self.by_chat.get(chat_id, ()):
+            return False
+        self._discard(alert_id)
+        return True
+
+    def cancel_all(self, chat_id: int) -> int:
+        ids = list(self.by_chat.get(chat_id, ()))
+        for alert_id in ids:
+            self._discard(alert_id)
+        return len(ids)
+
+    def list(self, chat_id: int) -> list:  # [(id, город, метрика, знак, порог), ...]
+        return [(alert_id, self.places[self.alerts[alert_id][1]].city, *self.alerts[alert_id][2:])
+                for alert_id in sorted(self.by_chat.get(chat_id, ()))]
+
+    async def check(self, context: ContextTypes.DEFAULT_TYPE = None) -> None:
+        places = list(self.places.items())
+        results = await asyncio.gather(*(measure_place(place.city, place.coords, place.metrics())
+                                         for _, place in places), return_exceptions=True)
+        self.checks += 1
+        fired = 0
+        for (key, place), values in zip(places, results):
+            if isinstance(values, Exception) or not values:
+                logger.error("Оповещения: нет данных для %s: %s", place.city, values)
+                continue
+            previous, place.snapshot = place.snapshot, values
+            if previous is None:
+                continue  # первый замер после запуска — точка отсчёта
+            for (metric, op), column in place.columns.items():
+                if metric not in previous or metric not in values:
+                    continue
+                for alert_id in column.rising(op, previous[metric], values[metric]):
+                    chat_id, _, _, _, threshold = self.alerts[alert_id]
+                    send_pipeline.submit(chat_id, format_alert_fired(place.city, metric, op, threshold, values[metric]))
+                    fired += 1
+        if fired:
+            self.fired += fired
+            logger.info("Оповещения: сработало %d (мест %d)", fired, len(places))
+
+alert_watcher = AlertWatcher()
+
+@metrics.collector
+def collect_alert_metrics() -> list:
+    return [
+        ("omnibot_alerts", "gauge", (), len(alert_watcher.alerts)),
+        ("omnibot_alert_places", "gauge", (), len(alert_watcher.places)),
+        ("omnibot_alert_checks_total", "counter", (), alert_watcher.checks),
+        ("omnibot_alerts_fired_total", "counter", (), alert_watcher.fired),
+    ]
+
+# Значения метрик места; погода и прогноз берутся через общие кэши
+async def measure_place(city: str, coords: tuple, metrics: set) -> dict:
+    values = {}
+    if metrics & {"temp", "humidity"}:
+        data = await get_weather(city, coords)
+        if data.get("cod") != 200:
+            return {}
+        values["temp"] = float(data["main"]["temp"])
+        values["humidity"] = float(data["main"]["humidity"])
+    if "rain" in metrics:
+        data = await get_forecast(city, coords)
+        if data.get("cod") != "200":
+            return {}
+        upcoming = data["list"][:max(1, ALERT_RAIN_HOURS // 3)]
+        values["rain"] = float(any(entry.get("rain") or entry.get("snow") or
+                                   entry.get("pop", 0) >= ALERT_RAIN_PROBABILITY for entry in upcoming))
+    return values
+
+def describe_alert(metric: str, op: str, threshold: float) -> str:
+    if metric == "rain":
+        return f"осадки в ближайшие {ALERT_RAIN_HOURS} ч"
+    name, unit = ALERT_METRICS[metric]
+    return f"{name} {'выше' if op == '>' else 'ниже'} {format_number(threshold)}{unit}"
+
+def format_alert_fired(city: str, metric: str, op: str, threshold: float, value: float) -> str:
+    if metric == "rain":
+        return f"🌧 {city}: ожидаются осадки в ближайшие {ALERT_RAIN_HOURS} ч."
+    name, unit = ALERT_METRICS[metric]
+    return f"🔔 {city}: {describe_alert(metric, op, threshold)} — сейчас {format_number(value)}{unit}."
+
+# «temp < 0», «temp<0», «humidity > 90», «rain»; возвращает (метрика, знак, порог, занято аргументов) или None
+ALERT_CONDITION = re.compile(r"(\w+)([<>])(-?\d+(?:[.,]\d+)?)")
+
+def parse_alert_condition(args: list):
+    metric = args[0].lower()
+    if ALERT_ALIASES.get(metric, metric) == "rain":
+        return "rain", ">", 0.0, 1
+    # условие могло быть записано слитно или через пробелы — пробуем 1, 2 и 3 аргумента
+    for used in range(1, min(len(args), 3) + 1):
+        match = ALERT_CONDITION.fullmatch("".join(args[:used]).lower())
+        if match:
+            metric = ALERT_ALIASES.get(match[1], match[1])
+            if metric not in ALERT_METRICS or metric == "rain":
+                return None
+            return metric, match[2], float(match[3].replace(",", ".")), used
+    return None
+
+def alerts_keyboard(items: list):
+    buttons = [InlineKeyboardButton(f"❌ #{alert_id}", callback_data=callback_data("alert", "cancel", alert_id))
+               for alert_id, *_ in items[:12]]
+    return InlineKeyboardMarkup([buttons[i:i+4] for i in range(0, len(buttons), 4)]) if buttons else None
+
+def render_alerts(chat_id: int) -> tuple:
+    items = alert_watcher.list(chat_id)
+    if not items:
+        return "Оповещений о погоде нет.", None
+    lines = ["<b>Ваши оповещения о погоде:</b>"]
+    lines += [f"#{alert_id} — {html.escape(city)}: {describe_alert(metric, op, threshold)}"
+              for alert_id, city, metric, op, threshold in items]
+    lines.append("\nОтменить: /alert cancel &lt;номер&gt; или /alert cancel all")
+    return "\n".join(lines), alerts_keyboard(items)
+
+# ------------------ Конвертер единиц ------------------
+# Для каждой единицы хранится размерность и аффинное преобразование в базовую
+# единицу размерности: base = value * factor + offset. Любая пара единиц одной
+# размерности сводится к одному умножению и сложению.
+# (единица, размерность, factor, offset, подпись, алиасы)
+UNIT_DEFINITIONS = [
+    # Масса, базовая — килограмм
+    ("kg", "mass", 1.0, 0.0, "кг", ["kg", "кг", "килограмм", "килограмма", "килограммы", "килограммов"]),
+    ("g", "mass", 0.001, 0.0, "г", ["g", "г", "грамм", "грамма", "граммы", "граммов"]),
+    ("t", "mass", 1000.0, 0.0, "т", ["t", "т", "тонна", "тонны", "тонн"]),
+    ("lb", "mass", 0.45359237, 0.0, "фунт.", ["lb", "lbs", "pound", "pounds", "фунт", "фунта", "фунты", "фунтов"]),
+    ("oz", "mass", 0.028349523125, 0.0, "унц.", ["oz", "ounce", "ounces", "унция", "унции", "унций"]),
+    # Длина, базовая — метр
+    ("m", "length", 1.0, 0.0, "м", ["m", "м", "метр", "метра", "метры", "метров"]),
+    ("km", "length", 1000.0, 0.0, "км", ["km", "км", "километр", "километра", "километры", "километров"]),
+    ("cm", "length", 0.01, 0.0, "см", ["cm", "см", "сантиметр", "сантиметра", "сантиметры", "сантиметров"]),
+    ("mm", "length", 0.001, 0.0, "мм", ["mm", "мм", "миллиметр", "миллиметра", "миллиметры", "миллиметров"]),
+    ("mi", "length", 1609.344, 0.0, "миль", ["mi", "mile", "miles", "мил", "миля", "мили", "миль"]),
+    ("yd", "length", 0.9144, 0.0, "ярд.", ["yd", "yard", "yards", "ярд", "ярда", "ярды", "ярдов"]),
+    ("ft", "length", 0.3048, 0.0, "фут.", ["ft", "foot", "feet", "фут", "фута", "футы", "футов"]),
+    ("in", "length", 0.0254, 0.0, "дюйм.", ["in", "inch", "inches", "дюйм", "дюйма", "дюймы", "дюймов"]),
+    # Температура, базовая — кельвин
+    ("c", "temperature", 1.0, 273.15, "°C", ["c", "°c", "celsius", "цельсий", "цельсия"]),
+    ("f", "temperature", 5 / 9, 459.67 * 5 / 9, "°F", ["f", "°f", "fahrenheit", "фаренгейт", "фаренгейта"]),
+    ("k", "temperature", 1.0, 0.0, "K", ["k", "kelvin", "кельвин", "кельвина"]),
+    # Объём, базовая — литр
+    ("l", "volume", 1.0, 0.0, "л", ["l", "л", "литр", "литра", "литры", "литров"]),
+    ("ml", "volume", 0.001, 0.0, "мл", ["ml", "мл", "миллилитр", "миллилитра", "миллилитры", "миллилитров"]),
+    ("gal", "volume", 3.785411784, 0.0, "гал.", ["gal", "gallon", "gallons", "галлон", "галлона", "галлоны", "галлонов"]),
+    # Скорость, базовая — метр в секунду
+    ("m/s", "speed", 1.0, 0.0, "м/с", ["m/s", "м/с"]),
+    ("km/h", "speed", 1 / 3.6, 0.0, "км/ч", ["km/h", "kmh", "kph", "км/ч"]),
+    ("mph", "speed", 0.44704, 0.0, "mph", ["mph", "миль/ч"]),
+]
+
+# Русские названия валют; коды (usd, eur, ...) добавляются из таблицы курсов
+CURRENCY_ALIASES = {
+    "руб": "RUB", "рубль": "RUB", "рубля": "RUB", "рублей": "RUB", "₽": "RUB",
+    "доллар": "USD", "доллара": "USD", "долларов": "USD", "$": "USD",
+    "евро": "EUR", "€": "EUR",
+    "юань": "CNY", "юаня": "CNY", "юаней": "CNY",
+    "иена": "JPY", "иены": "JPY", "иен": "JPY",
+}
+
+class UnitRegistry:
+    def __init__(self, definitions: list):
+        self.units = {}    # {единица: (размерность, factor, offset, подпись)}
+        self.aliases = {}  # {алиас: единица}
+        self.currencies_loaded_at = None
+        self.currencies_lock = asyncio.Lock()
+        for unit, dimension, factor, offset, label, aliases in definitions:
+            self.add(unit, dimension, factor, offset, label, aliases)
+
+    def add(self, unit: str, dimension: str, factor: float, offset: float, label: str, aliases: list) -> None:
+        self.units[unit] = (dimension, factor, offset, label)
+        for alias in aliases:
+            self.aliases[alias.lower()] = unit
+
+    def resolve(self, name: str):
+        return self.aliases.get(name.lower())
+
+    def label(self, unit: str) -> str:
+        return self.units[unit][3]
+
+    # Коэффициенты (scale, shift) для перевода src -> dst или None, если размерности разные
+    def pair(self, src: str, dst: str):
+        src_dim, src_factor, src_offset, _ = self.units[src]
+        dst_dim, dst_factor, dst_offset, _ = self.units[dst]
+        if src_dim != dst_dim:
+            return None
+        return src_factor / dst_factor, (src_offset - dst_offset) / dst_factor
+
+    def convert(self, values: list, src: str, dst: str):
+        pair = self.pair(src, dst)
+        if pair is None:
+            return None
+        scale, shift = pair
+        return [value * scale + shift for value in values]
+
+    # Валюты — размерность "currency" с базой EUR; таблица грузится при первом
+    # обращении в отдельном потоке и обновляется раз в CURRENCY_TABLE_TTL
+    async def ensure_currencies(self) -> None:
+        async with self.currencies_lock:
+            if self.currencies_loaded_at is not None and monotonic() - self.currencies_loaded_at < CURRENCY_TABLE_TTL:
+                return
+            try:
+                table = await asyncio.to_thread(load_currency_table)
+            except Exception as e:
+                logger.error("Ошибка загрузки курсов для конвертера: %s", e)
+                table = {}
+            # Свежие курсы из RatesService важнее данных ЕЦБ
+            self.update_currencies(table, override=False)
+            # При ошибке повторим попытку через 5 минут, а не через полный TTL
+            self.currencies_loaded_at = monotonic() - (0 if table else CURRENCY_TABLE_TTL - 300)
+
+    def update_currencies(self, table: dict, override: bool = True) -> None:  # {код: EUR за единицу}
+        for code, eur_rate in table.items():
+            if override or code not in self.units:
+                self.add(code, "currency", eur_rate, 0.0, code, [code])
+        for alias, code in CURRENCY_ALIASES.items():
+            if code in self.units:
+                self.aliases[alias] = code
+
+def load_currency_table() -> dict:
+    from currency_converter import ECB_URL, CurrencyConverter
+    try:
+        converter = CurrencyConverter(ECB_URL)
+    except Exception as e:
+        logger.warning("Не удалось скачать курсы ЕЦБ, используем встроенные: %s", e)
+        converter = CurrencyConverter()
+    table = {}
+    for code in converter.currencies:
+        # Для валют, по которым ЕЦБ перестал публиковать курс, берём последний известный
+        table[code] = converter.convert(1, code, "EUR", date=converter.bounds[code].last_date)
+    return table
+
+unit_registry = UnitRegistry(UNIT_DEFINITIONS)
+
+def format_number(value: float) -> str:
+    if not isfinite(value):  # переполнение при конвертации огромных чисел
+        return "∞" if value > 0 else "-∞" if value < 0 else "?"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return f"{value:.2f}" if abs(value) >= 0.01 else f"{value:.6g}"
+
+# «1,5;10» → [1.0, 5.0, 10.0]; ValueError, если чисел нет или число не конечно
+def parse_values(raw: str) -> list:
+    values = [float(value) for value in raw.replace(";", ",").split(",") if value]
+    if not values or not all(map(isfinite, values)):
+        raise ValueError(raw)
+    return values
+
+# Строки «значение из = результат в»; None — единицы не заданы или несовместимы
+def format_conversion(values: list, from_unit: str, to_unit: str):
+    results = unit_registry.convert(values, from_unit, to_unit) if from_unit and to_unit else None
+    if results is None:
+        return None
+    from_label, to_label = unit_registry.label(from_unit), unit_registry.label(to_unit)
+    return "\n".join(f"{format_number(value)} {from_label} = {format_number(converted)} {to_label}"
+                     for value, converted in zip(values, results))
+
+# ------------------ Курсы валют ------------------
+# Оба источника обновляются параллельно в фоне; обработчики отвечают из
+# неизменяемого снимка с заранее отрисованным текстом. Если источник
+# недоступен, остаются его последние данные и к ответу добавляется их возраст.
+FIAT_CURRENCIES = ["USD", "EUR", "GBP", "JPY", "CNY"]
+CRYPTO_NAMES = {"bitcoin": "Bitcoin (BTC)", "ethereum": "Ethereum (ETH)",
+                "binancecoin": "Binance Coin (BNB)", "ripple": "Ripple (XRP)",
+                "cardano": "Cardano (ADA)"}
+
+RatesSnapshot = namedtuple("RatesSnapshot", "fiat crypto fiat_at crypto_at text")
+
+class RatesService:
+    def __init__(self):
+        self.snapshot = None  # RatesSnapshot
+        self.lock = asyncio.Lock()
+
+    async def refresh(self, context: ContextTypes.DEFAULT_TYPE = None) -> None:
+        async with self.lock:
+            if context is None and self.snapshot is not None:
+                return  # снимок уже получен, пока ждали блокировку
+            fiat_data, crypto_data = await asyncio.gather(
+                shared_fetch_json("rates:fiat", f"{EXCHANGE_API_URL}/v4/latest/RUB",
+                                  ttl=RATES_REFRESH_INTERVAL, cacheable=lambda data: bool(data.get("rates"))),
+                shared_fetch_json("rates:crypto", f"{COINGECKO_API_URL}/api/v3/simple/price",
+                                  {"ids": ",".join(CRYPTO_NAMES), "vs_currencies": "rub"},
+                                  RATES_REFRESH_INTERVAL, cacheable=bool),
+                return_exceptions=True,
+            )
+            old = self.snapshot
+            now = monotonic()
+            fiat, fiat_at = (old.fiat, old.fiat_at) if old else (None, None)
+            crypto, crypto_at = (old.crypto, old.crypto_at) if old else (None, None)
+            if isinstance(fiat_data, dict) and fiat_data.get("rates"):
+                fiat, fiat_at = fiat_data["rates"], now
+                if fiat.get("EUR"):
+                    unit_registry.update_currencies({code: fiat["EUR"] / rate for code, rate in fiat.items() if rate})
+            else:
+                logger.error("Ошибка обновления курсов валют: %s", fiat_data)
+            if isinstance(crypto_data, dict) and crypto_data:
+                crypto, crypto_at = crypto_data, now
+            else:
+                logger.error("Ошибка обновления курсов криптовалют: %s", crypto_data)
+            if fiat is None and crypto is None:
+                return
+            self.snapshot = RatesSnapshot(fiat, crypto, fiat_at, crypto_at, render_rates(fiat, crypto))
+
+    async def get_message(self):
+        if self.snapshot is None:
+            await self.refresh()
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        updated_at = min(t for t in (snapshot.fiat_at, snapshot.crypto_at) if t is not None)
+        age = monotonic() - updated_at
+        if age > 2 * RATES_REFRESH_INTERVAL or None in (snapshot.fiat, snapshot.crypto):
+            return f"{snapshot.text}\n⚠️ Данные могут быть устаревшими: обновлены {int(age // 60)} мин назад."
+        return snapshot.text
+
+def render_rates(fiat: dict, crypto: dict) -> str:
+    fiat_message = "<b>Фиатные валюты (базовая: RUB):</b>\n"
+    for cur in FIAT_CURRENCIES:
+        rate = (fiat or {}).get(cur)
+        if rate:
+            fiat_message += f"{cur}: {rate:.2f}\n"
+    crypto_message = "\n<b>Криптовалюты (цена в RUB):</b>\n"
+    for coin, name in CRYPTO_NAMES.items():
+        price = (crypto or {}).get(coin, {}).get("rub")
+        if price:
+            crypto_message += f"{name}: {price:,} RUB\n"
+    return fiat_message + crypto_message
+
+rates_service = RatesService()
+
+# ------------------ Новости ------------------
+# Ленты опрашиваются в фоне условными запросами (ETag / If-Modified-Since),
+# так что неизменившаяся лента стоит одного ответа 304. Разбор — в потоке,
+# записи дедуплицируются по GUID, для каждой ленты держится готовый
+# HTML-дайджест. Рассылка и /news только склеивают дайджесты выбранных лент.
+def parse_feed_list(spec: str) -> dict:
+    feeds = {}
+    for item in spec.split(","):
+        feed_id, sep, url = item.partition("=")
+        if sep and feed_id.strip() and url.strip():
+            feeds[feed_id.strip().lower()] = url.strip()
+    return feeds or {"bbc": NEWS_FEED_URL}
+
+# feedparser импортируется при первом разборе — в рабочем потоке, а не при старте
+def parse_feed(content: bytes):
+    import feedparser
+    return feedparser.parse(content)
+
+class Feed:
+    def __init__(self, feed_id: str, url: str):
+        self.id = feed_id
+        self.url = url
+        self.title = feed_id
+        self.etag = None
+        self.modified = None
+        self.seen = set()                              # GUID последних записей
+        self.seen_order = deque()                      # те же GUID по порядку — кольцо на NEWS_SEEN_SIZE
+        self.entries = deque(maxlen=NEWS_DIGEST_SIZE)  # (заголовок, ссылка), новые слева
+        self.digest = None                             # HTML-блок ленты
+        self.checked_at = None                         # monotonic() последней попытки опроса
+        self.updated_at = None                         # monotonic() последнего успешного опроса
+
+    def add(self, guid: str, title: str, link: str) -> bool:
+        if guid in self.seen:
+            return False
+        self.seen.add(guid)
+        self.seen_order.append(guid)
+        if len(self.seen_order) > NEWS_SEEN_SIZE:
+            self.seen.discard(self.seen_order.popleft())
+        self.entries.appendleft((title, link))
+        return True
+
+    def render(self) -> None:
+        lines = [f"<b>{html.escape(self.title)}</b>"]
+        lines += [f'<a href="{html.escape(link)}">{html.escape(title)}</a>' for title, link in self.entries]
+        self.digest = "\n".join(lines)
+
+class NewsService:
+    def __init__(self, feeds: dict):
+        self.feeds = {feed_id: Feed(feed_id, url) for feed_id, url in feeds.items()}
+        self.default = next(iter(self.feeds))
+        self.lock = asyncio.Lock()
+        self.polls = 0
+        self.not_modified = 0
+        self.new_entries = 0
+        self.errors = 0
+
+    async def refresh(self, context: ContextTypes.DEFAULT_TYPE = None) -> None:
+        await asyncio.gather(*(self.poll(feed) for feed in self.feeds.values()))
+
+    async def poll(self, feed: Feed) -> None:
+        headers = {}
+        if feed.etag:
+            headers["If-None-Match"] = feed.etag
+        if feed.modified:
+            headers["If-Modified-Since"] = feed.modified
+        feed.checked_at = monotonic()
+        self.polls += 1
+        try:
+            response = await http_get(feed.url, headers=headers)
+            if response.status_code == HTTPStatus.NOT_MODIFIED:
+                self.not_modified += 1
+                feed.updated_at = monotonic()
+                return
+            response.raise_for_status()
+            # feedparser — синхронный парсер, выносим его из event loop
+            parsed = await asyncio.to_thread(parse_feed, response.content)
+        except Exception as e:
+            self.errors += 1
+            logger.error("Ошибка загрузки ленты %s: %s", feed.url, e)
+            return
+        feed.etag = response.headers.get("ETag")
+        feed.modified = response.headers.get("Last-Modified")
+        feed.title = parsed.feed.get("title") or feed.id
+        added = 0
+        for entry in reversed(parsed.entries):  # в ленте новые сверху
+            title = entry.get("title", "")
+            link = entry.get("link", "")
+            guid = entry.get("id") or link or title
+            if guid and feed.add(guid, title, link):
+                added += 1
+        self.new_entries += added
+        if added or feed.digest is None:
+            feed.render()
+        feed.updated_at = monotonic()
+
+    def selected(self, chat_id: int) -> tuple:
+        chosen = tuple(feed_id for feed_id in get_chat(chat_id).feeds if feed_id in self.feeds)
+        return chosen or (self.default,)
+
+    async def digest(self, feed_ids: tuple, header: str):
+        # До первого фонового опроса ленту загружаем по требованию
+        missing = [self.feeds[feed_id] for feed_id in feed_ids if self.feeds[feed_id].checked_at is None]
+        if missing:
+            async with self.lock:
+                await asyncio.gather(*(self.poll(feed) for feed in missing if feed.checked_at is None))
+        feeds = [self.feeds[feed_id] for feed_id in feed_ids]
+        blocks = [feed.digest for feed in feeds if feed.digest]
+        if not blocks:
+            return None
+        message = header + "\n\n".join(blocks)
+        updated = [feed.updated_at for feed in feeds if feed.updated_at is not None]
+        age = monotonic() - min(updated) if updated else None
+        if age is None or age > 2 * NEWS_REFRESH_INTERVAL:
+            message += "\n⚠️ Ленты давно не обновлялись, новости могут быть устаревшими."
+        return message
+
+news_service = NewsService(parse_feed_list(NEWS_FEEDS))
+
+@metrics.collector
+def collect_news_metrics() -> list:
+    return [
+        ("omnibot_news_polls_total", "counter", (), news_service.polls),
+        ("omnibot_news_not_modified_total", "counter", (), news_service.not_modified),
+        ("omnibot_news_entries_total", "counter", (), news_service.new_entries),
+        ("omnibot_news_errors_total", "counter", (), news_service.errors),
+    ]
+
+# ------------------ Переводчик ------------------
+# Текст режется на фрагменты по границам предложений; фрагменты переводятся
+# параллельно и кэшируются по (src, tgt, хэш нормализованного текста):
+# в памяти (LRU + TTL, одинаковые запросы в полёте объединяются) и,
+# опционально, на диске в SQLite.
+# Файл открывается при первом обращении (из рабочего потока), а не при импорте
+class TranslationDiskCache:
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def connect(self) -> sqlite3.Connection:
+        with self.lock:
+            if self.conn is None:
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS translations "
+                    "(key TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL) WITHOUT ROWID")
+                self.conn = conn
+            return self.conn
+
+    def get(self, key: str):
+        conn = self.connect()
+        with self.lock:
+            row = conn.execute("SELECT text, created FROM translations WHERE key = ?", (key,)).fetchone()
+        if row and row[1] + self.ttl > datetime.now().timestamp():
+            return row[0]
+        return None
+
+    def set(self, key: str, text: str) -> None:
+        conn = self.connect()
+        with self.lock, conn:
+            conn.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?)",
+                              (key, text, datetime.now().timestamp()))
+
+translation_cache = TTLCache(TRANSLATION_CACHE_TTL, TRANSLATION_CACHE_SIZE)
+translation_disk_cache = TranslationDiskCache(TRANSLATION_CACHE_PATH, TRANSLATION_CACHE_TTL) if TRANSLATION_CACHE_PATH else None
+translation_semaphore = asyncio.Semaphore(TRANSLATION_CONCURRENCY)
+
+SENTENCE_END = re.compile(r"(?<=[.!?…])(\s+)")
+
+def utf8_len(text: str) -> int:
+    return len(text.encode())
+
+# [(фрагмент, разделитель после него), ...]; limit — в байтах UTF-8 (кириллица
+# занимает по 2 байта на букву); длинные предложения режутся по пробелам
+def split_text(text: str, limit: int) -> list:
+    pieces = SENTENCE_END.split(text)
+    sentences = list(zip(pieces[::2], pieces[1::2] + [""]))
+    chunks = []
+    current, current_sep, current_size = "", "", 0
+    for sentence, sep in sentences:
+        size = utf8_len(sentence)
+        while size > limit:
+            # Самый длинный префикс, который помещается в limit байт
+            fit = len(sentence.encode()[:limit].decode(errors="ignore"))
+            cut = sentence.rfind(" ", 0, fit)
+            cut = cut if cut > 0 else fit
+            head, sentence = sentence[:cut], sentence[cut:].lstrip()
+            size = utf8_len(sentence)
+            if current:
+                chunks.append((current, current_sep))
+                current, current_sep, current_size = "", "", 0
+            chunks.append((head, " "))
+        if current and current_size + utf8_len(current_sep) + size > limit:
+            chunks.append((current, current_sep))
+            current, current_sep, current_size = "", "", 0
+        if current:
+            current, current_size = f"{current}{current_sep}{sentence}", current_size + utf8_len(current_sep) + size
+        else:
+            current, current_size = sentence, size
+        current_sep = sep
+    if current:
+        chunks.append((current, current_sep))
+    return chunks
+
+async def translate_chunk(chunk: str, src_lang: str, target_lang: str):
+    digest = hashlib.sha1(" ".join(chunk.split()).casefold().encode()).hexdigest()
+    key = f"{src_lang}|{target_lang}|{digest}"
+
+    async def fetch():
+        if translation_disk_cache is not None:
+            cached = await asyncio.to_thread(translation_disk_cache.get, key)
+            if cached is not None:
+                return cached
+        async with translation_semaphore:
+            data = await fetch_json(f"{TRANSLATE_API_URL}/get",
+                                    {"q": chunk, "langpair": f"{src_lang}|{target_lang}"})
+        translation = data.get("responseData", {}).get("translatedText")
+        if str(data.get("responseStatus")) != "200" or not translation:
+            return None
+        if translation_disk_cache is not None:
+            await asyncio.to_thread(translation_disk_cache.set, key, translation)
+        return translation
+
+    return await translation_cache.get_or_fetch(key, fetch, cacheable=bool)
+
+async def translate_text(text: str, src_lang: str, target_lang: str):
+    chunks = split_text(text.strip(), TRANSLATION_CHUNK_SIZE)
+    translations = await asyncio.gather(*(translate_chunk(chunk, src_lang, target_lang) for chunk, _ in chunks))
+    if not chunks or not all(translations):
+        return None
+    return "".join(f"{translation}{sep}" for translation, (_, sep) in zip(translations, chunks)).strip()
+
+# ------------------ Поиск в Wikipedia ------------------
+# opensearch — поиск по префиксу названия, поэтому все увиденные в ответах
+# названия складываются в отсортированный индекс: если при промахе кэша
+# в нём уже есть SEARCH_RESULTS статей с таким префиксом, запрос
+# обслуживается локально, без обращения к Wikipedia.
+# Краткие описания берутся из REST API (/page/summary) параллельно
+# и кэшируются отдельно от результатов поиска.
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).casefold()
+
+class TitleIndex:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.keys = []               # отсортированные нормализованные названия
+        self.titles = OrderedDict()  # {нормализованное: (название, url)}, самые старые — первыми
+
+    def add(self, title: str, url: str) -> None:
+        key = normalize_query(title)
+        if key in self.titles:
+            self.titles.move_to_end(key)
+            return
+        self.titles[key] = (title, url)
+        insort(self.keys, key)
+        if len(self.titles) > self.maxsize:
+            oldest, _ = self.titles.popitem(last=False)
+            del self.keys[bisect_left(self.keys, oldest)]
+
+    def lookup(self, prefix: str, limit: int) -> list:
+        start = bisect_left(self.keys, prefix)
+        matches = []
+        for key in self.keys[start:start + 8 * limit]:
+            if not key.startswith(prefix):
+                break
+            matches.append(key)
+        # Ближе к запросу — короче название
+        matches.sort(key=len)
+        return [self.titles[key] for key in matches[:limit]]
+
+class WikipediaSearch:
+    def __init__(self):
+        self.results = TTLCache(SEARCH_CACHE_TTL, SEARCH_CACHE_SIZE)     # {запрос: [(название, url), ...]}
+        self.summaries = TTLCache(SEARCH_SUMMARY_TTL, SEARCH_CACHE_SIZE)  # {название: описание}
+        self.index = TitleIndex(SEARCH_INDEX_SIZE)
+        self.local_hits = 0
+
+    async def find(self, query: str) -> list:
+        key = normalize_query(query)
+
+        async def fetch():
+            local = self.index.lookup(key, SEARCH_RESULTS)
+            if len(local) >= SEARCH_RESULTS:
+                self.local_hits += 1
+                return local
+            data = await fetch_json(f"{WIKIPEDIA_API_URL}/w/api.php",
+                                    {"action": "opensearch", "search": query, "limit": SEARCH_RESULTS,
+                                     "namespace": 0, "format": "json"})
+            found = list(zip(data[1], data[3])) if len(data) >= 4 else []
+            for title, url in found:
+                self.index.add(title, url)
+            return found
+
+        return await self.results.get_or_fetch(key, fetch)
+
+    async def summary(self, title: str) -> str:
+        async def fetch():
+            path = urllib.parse.quote(title.replace(" ", "_"), safe="")
+            response = await http_get(f"{WIKIPEDIA_API_URL}/api/rest_v1/page/summary/{path}")
+            if response.status_code == HTTPStatus.NOT_FOUND:  # статьи без описания тоже кэшируем
+                return ""
+            response.raise_for_status()
+            return response.json().get("extract", "")
+
+        try:
+            return await self.summaries.get_or_fetch(title, fetch)
+        except Exception as e:
+            logger.warning("Не удалось получить описание «%s»: %s", title, e)
+            return ""
+
+    # Результаты без обращения к сети: из кэша поиска или индекса названий,
+    # описания — только уже загруженные. None — нужен запрос к Wikipedia.
+    def cached(self, query: str):
+        key = normalize_query(query)
+        found = self.results.get(key)
+        if found is None:
+            found = self.index.lookup(key, SEARCH_RESULTS)
+            if len(found) < SEARCH_RESULTS:
+                return None
+        return [(title, url, self.summaries.get(title, "")) for title, url in found]
+
+    async def search(self, query: str) -> list:  # [(название, url, описание), ...]
+        found = await self.find(query)
+        summaries = await asyncio.gather(*(self.summary(title) for title, _ in found))
+        return [(title, url, summary) for (title, url), summary in zip(found, summaries)]
+
+wikipedia_search = WikipediaSearch()
+
+def format_search_results(query: str, results: list) -> str:
+    if not results:
+        return f"По запросу «{html.escape(query)}» ничего не найдено."
+    lines = [f"<b>Результаты по запросу «{html.escape(query)}»:</b>"]
+    for title, url, summary in results:
+        if len(summary) > 300:
+            summary = summary[:300].rsplit(" ", 1)[0] + "…"
+        line = f'\n• <a href="{html.escape(url)}">{html.escape(title)}</a>'
+        lines.append(line + (f"\n{html.escape(summary)}" if summary else ""))
+    return "\n".join(lines)
+
+@metrics.collector
+def collect_cache_metrics() -> list:
+    samples = []
+    caches = (("weather", weather_cache), ("forecast", forecast_cache), ("translation", translation_cache),
+              ("search", wikipedia_search.results), ("summary", wikipedia_search.summaries),
+              ("geo", reverse_geocoder.cache))
+    for name, cache in caches:
+        labels = (("cache", name),)
+        stats = cache.stats()
+        samples += [
+            ("omnibot_cache_hits_total", "counter", labels, stats["hits"]),
+            ("omnibot_cache_coalesced_total", "counter", labels, stats["coalesced"]),
+            ("omnibot_cache_misses_total", "counter", labels, stats["misses"]),
+            ("omnibot_cache_size", "gauge", labels, stats["size"]),
+            ("omnibot_cache_hit_ratio", "gauge", labels, stats["hit_ratio"]),
+        ]
+    samples.append(("omnibot_search_local_hits_total", "counter", (), wikipedia_search.local_hits))
+    samples.append(("omnibot_geo_local_hits_total", "counter", (), reverse_geocoder.local_hits))
+    return samples
+
+# ------------------ Inline-режим ------------------
+# «@OmniBot weather Москва», «@OmniBot 10 km to mi», «@OmniBot rates»;
+# любой другой текст — поиск в Wikipedia. Telegram ждёт ответ считанные
+# секунды и присылает новый запрос на каждую набранную букву, поэтому:
+# - готовые ответы лежат в кэше по (вид, запрос) столько же, сколько
+#   cache_time, который уходит в answer_inline_query;
+# - ответ, который собирается из локальных кэшей (погода, курсы, индекс
+#   Wikipedia, таблица единиц), отдаётся сразу;
+# - к внешним API идёт только запрос, после которого пользователь
+#   INLINE_DEBOUNCE ничего не допечатал; остальные остаются без ответа.
+InlineAnswer = namedtuple("InlineAnswer", "results cache_time")
+
+INLINE_KEYWORDS = {"weather": "weather", "погода": "weather", "rates": "rates", "курсы": "rates",
+                   "convert": "convert", "search": "search", "wiki": "search"}
+INLINE_CONVERSION = re.compile(r"([\d.,;]+)\s*([^\s\d.,;]\S*)\s+to\s+(\S.*)", re.IGNORECASE)
+INLINE_MIN_SEARCH = 3   # короче — не ищем, первые буквы ещё ничего не значат
+UNIT_CACHE_TIME = 86400  # курсы единиц измерения не меняются
+INLINE_HELP = (
+    "<b>OmniBot в любом чате:</b>\n"
+    "• @бот weather &lt;город&gt; — погода (без города — из /settings)\n"
+    "• @бот 10 km to mi — конвертер\n"
+    "• @бот rates — курсы валют\n"
+    "• @бот &lt;запрос&gt; — поиск в Wikipedia"
+)
+
+def parse_inline_query(text: str) -> tuple:  # (вид, аргумент)
+    text = " ".join(text.split())
+    if not text:
+        return "help", ""
+    head, _, rest = text.partition(" ")
+    kind = INLINE_KEYWORDS.get(head.casefold())
+    if kind is not None:
+        return kind, rest
+    if INLINE_CONVERSION.fullmatch(text):
+        return "convert", text
+    return "search", text
+
+def inline_article(result_id: str, title: str, message: str, description: str = None) -> InlineQueryResultArticle:
+    content = InputTextMessageContent(message, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+    return InlineQueryResultArticle(result_id, title, content, description=description)
+
+# Сборщики ответов: local=True — только из того, что уже есть в памяти
+# (None, если нужен внешний запрос), local=False — с запросами.
+async def inline_weather(arg: str, user_id: int, local: bool):
+    city, coords = (arg, None) if arg else saved_place(user_id)
+    if not city:
+        return InlineAnswer([inline_article("usage", "Укажите город: weather <город>", INLINE_HELP)], 0)
+    data = weather_cache.get(weather_key(city, coords)) if local else await get_weather(city, coords)
+    if data is None:
+        return None
+    if data.get("cod") != 200:
+        return InlineAnswer([inline_article("none", f"Город не найден: {city}", f"Город не найден: {html.escape(city)}")], 60)
+    description = f"{data['main']['temp']}°C, {data['weather'][0]['description']}"
+    # Половина TTL: ответ из кэша Telegram не должен пережить наш кэш погоды надолго
+    return InlineAnswer([inline_article("weather", f"Погода: {city}", format_weather(html.escape(city), data), description)],
+                        WEATHER_CACHE_TTL // 2)
+
+async def inline_rates(arg: str, user_id: int, local: bool):
+    if local and rates_service.snapshot is None:
+        return None
+    message = await rates_service.get_message()
+    if message is None:
+        return InlineAnswer([], 0)
+    return InlineAnswer([inline_article("rates", "Курсы валют и криптовалют", message, "Базовая валюта: RUB")],
+                        RATES_REFRESH_INTERVAL // 2)
+
+async def inline_convert(arg: str, user_id: int, local: bool):
+    match = INLINE_CONVERSION.fullmatch(arg)
+    try:
+        values = parse_values(match.group(1)) if match else None
+    except ValueError:
+        values = None
+    if values is None:
+        return InlineAnswer([inline_article("usage", "Пример: 10 km to mi", INLINE_HELP)], UNIT_CACHE_TIME)
+    from_name, to_name = match.group(2), match.group(3)
+    from_unit, to_unit = unit_registry.resolve(from_name), unit_registry.resolve(to_name)
+    if from_unit is None or to_unit is None:
+        if local:
+            return None
+        await unit_registry.ensure_currencies()
+        from_unit, to_unit = unit_registry.resolve(from_name), unit_registry.resolve(to_name)
+    message = format_conversion(values, from_unit, to_unit)
+    if message is None:
+        return InlineAnswer([inline_article("none", "Конвертация для этих единиц не поддерживается",
+                                            html.escape(arg))], 60)
+    currency = unit_registry.units[from_unit][0] == "currency"
+    return InlineAnswer([inline_article("convert", message.split("\n")[0], html.escape(message))],
+                        RATES_REFRESH_INTERVAL // 2 if currency else UNIT_CACHE_TIME)
+
+async def inline_search(arg: str, user_id: int, local: bool):
+    if len(arg) < INLINE_MIN_SEARCH:
+        return InlineAnswer([], 0)
+    results = wikipedia_search.cached(arg) if local else await wikipedia_search.search(arg)
+    if results is None:
+        return None
+    articles = []
+    for i, (title, url, summary) in enumerate(results):
+        if len(summary) > 300:
+            summary = summary[:300].rsplit(" ", 1)[0] + "…"
+        message = f'<a href="{html.escape(url)}">{html.escape(title)}</a>' + (f"\n{html.escape(summary)}" if summary else "")
+        articles.append(inline_article(f"s{i}", title, message, summary[:100] or None))
+    # Без описаний (их ещё не загрузили) ответ держим недолго — следующий будет полнее
+    complete = all(summary for _, _, summary in results)
+    return InlineAnswer(articles, SEARCH_CACHE_TTL if complete else 60)
+
+async def inline_help(arg: str, user_id: int, local: bool):
+    rates = await inline_rates("", user_id, True)
+    usage = inline_article("help", "Как пользоваться", INLINE_HELP, "weather <город> · 10 km to mi · rates · <запрос>")
+    return InlineAnswer((rates.results if rates else []) + [usage], 60)
+
+INLINE_BUILDERS = {"weather": inline_weather, "rates": inline_rates, "convert": inline_convert,
+                   "search": inline_search, "help": inline_help}
+
+class InlineService:
+    def __init__(self):
+        self.answers = TTLCache(UNIT_CACHE_TIME, INLINE_CACHE_SIZE)  # {(вид, запрос): InlineAnswer}
+        self.latest = {}  # {user_id: номер последнего запроса, ждущего внешних данных}
+        self.seq = 0
+        self.served = {"cache": 0, "local": 0, "upstream": 0}
+        self.debounced = 0
+        self.timeouts = 0
+
+    def key(self, kind: str, arg: str, user_id: int) -> tuple:
+        if kind == "weather":
+            city, coords = (arg, None) if arg else saved_place(user_id)
+            return kind, weather_key(city or "", coords)
+        return kind, arg.casefold()
+
+    # True — за INLINE_DEBOUNCE пользователь не прислал запрос новее
+    async def settle(self, user_id: int) -> bool:
+        self.seq += 1
+        seq = self.latest[user_id] = self.seq
+        await asyncio.sleep(INLINE_DEBOUNCE)
+        if self.latest.get(user_id) != seq:
+            self.debounced += 1
+            return False
+        del self.latest[user_id]
+        return True
+
+    async def answer(self, kind: str, arg: str, user_id: int):  # InlineAnswer или None — запрос устарел
+        key = self.key(kind, arg, user_id)
+        answer = self.answers.get(key)
+        if answer is not None:
+            self.served["cache"] += 1
+            return answer
+        build = INLINE_BUILDERS[kind]
+        answer = await build(arg, user_id, True)
+        source = "local"
+        if answer is None:
+            if not await self.settle(user_id):
+                return None
+            # Не успели — отвечаем пустым списком, а запрос доделывается в фоне
+            # и наполняет кэши для следующей буквы
+            task = asyncio.ensure_future(build(arg, user_id, False))
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            try:
+                answer = await asyncio.wait_for(asyncio.shield(task), INLINE_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                return InlineAnswer([], 0)
+            except Exception as e:
+                logger.warning("Inline-запрос %s «%s»: %s", kind, arg, e)
+                return InlineAnswer([], 0)
+            source = "upstream"
+        self.served[source] += 1
+        if answer.cache_time:
+            self.answers.set(key, answer, answer.cache_time)
+        return answer
+
+inline_service = InlineService()
+
+@metrics.collector
+def collect_inline_metrics() -> list:
+    samples = [("omnibot_inline_answers_total", "counter", (("source", source),), count)
+               for source, count in inline_service.served.items()]
+    samples.append(("omnibot_inline_debounced_total", "counter", (), inline_service.debounced))
+    samples.append(("omnibot_inline_timeouts_total", "counter", (), inline_service.timeouts))
+    return samples
+
+# ------------------ Квиз ------------------
+# Банк вопросов — файл JSON Lines, по вопросу в строке:
+#   {"question": "...", "options": ["...", ...], "answer": "..."}
+# При первом обращении строится только индекс смещений строк (array),
+# сами вопросы читаются и разбираются по требованию и держатся в LRU.
+class QuizBank:
+    def __init__(self, path: str = "", questions: list = None):
+        self.path = path
+        self.questions = questions  # встроенный список, если файла нет
+        self.offsets = None         # array("Q") смещений строк в файле
+        self.file = None
+        self.cache = OrderedDict()  # {index: вопрос}
+        self.lock = asyncio.Lock()
+
+    async def load(self) -> None:
+        if self.questions is not None or self.offsets is not None:
+            return
+        async with self.lock:
+            if self.offsets is not None:
+                return
+            try:
+                offsets = await asyncio.to_thread(self._build_index)
+                self.file = open(self.path, "rb")
+                self.offsets = offsets
+                logger.info("Банк вопросов %s: %d вопросов", self.path, len(offsets))
+            except OSError as e:
+                logger.error("Не удалось загрузить банк вопросов %s: %s", self.path, e)
+                self.questions = quiz_questions
+
+    def _build_index(self) -> array:
+        offsets = array("Q")
+        position = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    offsets.append(position)
+                position += len(line)
+        return offsets
+
+    def __len__(self) -> int:
+        if self.questions is not None:
+            return len(self.questions)
+        return len(self.offsets) if self.offsets is not None else 0
+
+    def get(self, index: int):
+        if self.questions is not None:
+            return self.questions[index] if 0 <= index < len(self.questions) else None
+        if self.offsets is None or not 0 <= index < len(self.offsets):
+            return None
+        question = self.cache.get(index)
+        if question is not None:
+            self.cache.move_to_end(index)
+            return question
+        # Одна строка из файла, который почти наверняка в page cache
+        self.file.seek(self.offsets[index])
+        try:
+            question = json.loads(self.file.readline())
+            if question["answer"] not in question["options"]:
+                raise ValueError("answer not in options")
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Некорректный вопрос #%d в %s: %s", index, self.path, e)
+            return None
+        self.cache[index] = question
+        if len(self.cache) > QUIZ_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return question
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+
+quiz_bank = QuizBank(QUIZ_BANK_PATH) if QUIZ_BANK_PATH else QuizBank(questions=quiz_questions)
+
+# Порядок вопросов без повторов: i-й вопрос игрока — (offset + step * i) mod n,
+# где step взаимно прост с n, т.е. перестановка всех n вопросов. В состоянии
+# игрока хранятся только step, offset и курсор; после полного круга
+# (или смены размера банка) выбирается новая перестановка.
+def next_question_index(stats: dict, size: int) -> int:
+    if stats.get("size") != size or stats.get("cursor", 0) >= size:
+        step = random.randrange(1, size) if size > 1 else 1
+        while gcd(step, size) != 1:
+            step = random.randrange(1, size)
+        stats.update(size=size, step=step, offset=random.randrange(size), cursor=0)
+    index = (stats["offset"] + stats["step"] * stats["cursor"]) % size
+    stats["cursor"] += 1
+    return index
+
+# Таблица лидеров: отсортированный список из QUIZ_LEADERBOARD_SIZE лучших.
+# Очки игрока только растут, поэтому достаточно сравнивать обновлённого
+# игрока с последним местом — выбывший может вернуться лишь через
+# собственное обновление.
+class Leaderboard:
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = []  # [(-score, updated, user_id), ...] по возрастанию
+        self.index = {}    # {user_id: (entry, name)}
+
+    def update(self, user_id: int, score: int, updated: float, name: str) -> None:
+        entry = (-score, updated, user_id)
+        current = self.index.pop(user_id, None)
+        if current is not None:
+            del self.entries[bisect_left(self.entries, current[0])]
+        elif len(self.entries) >= self.size and entry >= self.entries[-1]:
+            return
+        insort(self.entries, entry)
+        self.index[user_id] = (entry, name)
+        if len(self.entries) > self.size:
+            _, _, evicted = self.entries.pop()
+            del self.index[evicted]
+
+    def top(self, limit: int) -> list:  # [(user_id, score, updated, name), ...]
+        return [(user_id, -neg_score, updated, self.index[user_id][1])
+                for neg_score, updated, user_id in self.entries[:limit]]
+
+    def rank(self, user_id: int):
+        current = self.index.get(user_id)
+        return bisect_left(self.entries, current[0]) + 1 if current else None
+
+quiz_leaderboard = Leaderboard(QUIZ_LEADERBOARD_SIZE)
+
+# В многопроцессном режиме у каждого шарда своя таблица: шард публикует
+# свою верхушку в общий кэш, а /top_quiz сливает верхушки всех шардов.
+# Игрок живёт в шарде по своему user_id, так что его счёт есть только там.
+async def publish_leaderboard() -> None:
+    if shared_cache is not None:
+        await shared_cache.set(f"quiz_top:{shard_id}", quiz_leaderboard.top(QUIZ_TOP_SHOWN))
+
+async def leaderboard_top(limit: int) -> list:
+    if shared_cache is None:
+        return quiz_leaderboard.top(limit)
+    tops = await asyncio.gather(*(shared_cache.get(f"quiz_top:{shard}") for shard in range(WORKERS)))
+    best = {}  # старая статистика игрока может остаться в другом шарде — берём лучший счёт
+    for entry in (entry for top in tops if top for entry in top):
+        if entry[0] not in best or entry[1] > best[entry[0]][1]:
+            best[entry[0]] = entry
+    return sorted(best.values(), key=lambda entry: (-entry[1], entry[2]))[:limit]
+
+async def render_leaderboard(user_id: int) -> str:
+    top = await leaderboard_top(QUIZ_TOP_SHOWN)
+    if not top:
+        return "Пока никто не набрал очков. Сыграйте: /quiz"
+    lines = ["<b>🏆 Таблица лидеров:</b>"]
+    lines += [f"{place}. {html.escape(name)} — {score}" for place, (_, score, _, name) in enumerate(top, 1)]
+    stats = await get_quiz_stats(user_id)
+    if shared_cache is None:
+        rank = quiz_leaderboard.rank(user_id)
+    else:
+        rank = next((place for place, entry in enumerate(top, 1) if entry[0] == user_id), None)
+    own = f"\nВаш счёт: {stats.get('score', 0)} из {stats.get('answered', 0)}"
+    lines.append(own + (f", место: {rank}" if rank else ""))
+    return "\n".join(lines)
+
+# ------------------ Маршрутизация callback-кнопок ------------------
+# Формат callback_data: "<namespace>:<action>[:<payload>]". Числовые аргументы
+# упаковываются в varint и кодируются base64url — индекс вопроса и ответа
+# викторины занимают пару байт, а не текст варианта (лимит Telegram — 64 байта).
+Callback = namedtuple("Callback", "namespace action args")
+
+def pack_ints(*values: int) -> str:
+    buf = bytearray()
+    for value in values:
+        while value >= 0x80:
+            buf.append(value & 0x7F | 0x80)
+            value >>= 7
+        buf.append(value)
+    return base64.urlsafe_b64encode(bytes(buf)).rstrip(b"=").decode()
+
+def unpack_ints(payload: str) -> tuple:
+    raw = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+    values, value, shift = [], 0, 0
+    for byte in raw:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    return tuple(values)
+
+def callback_data(namespace: str, action: str, *args: int) -> str:
+    data = f"{namespace}:{action}:{pack_ints(*args)}" if args else f"{namespace}:{action}"
+    if len(data.encode()) > 64:
+        raise ValueError(f"callback_data длиннее 64 байт: {data}")
+    return data
+
+class CallbackRouter:
+    def __init__(self):
+        self.routes = {}  # {(namespace, action): handler}; action None — любой action
+        self.stats = {}   # {"namespace:action": [вызовов, суммарное время, максимум]}
+
+    def route(self, namespace: str, action: str = None):
+        def register(handler):
+            self.routes[(namespace, action)] = handler
+            return handler
+        return register
+
+    @staticmethod
+    def parse(data: str) -> Callback:
+        namespace, _, rest = data.partition(":")
+        action, _, payload = rest.partition(":")
+        try:
+            args = unpack_ints(payload) if payload else ()
+        except ValueError:
+            args = ()
+        return Callback(namespace, action, args)
+
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        callback = self.parse(query.data or "")
+        name = f"{callback.namespace}:{callback.action}"
+        handler = self.routes.get((callback.namespace, callback.action))
+        if handler is None:
+            name = f"{callback.namespace}:*"
+            handler = self.routes.get((callback.namespace, None))
+        if handler is None:
+            await query.answer("Кнопка устарела. Откройте меню заново: /menu")
+            return
+        await query.answer()
+        started = perf_counter()
+        try:
+            await handler(update, context, callback)
+        finally:
+            elapsed = perf_counter() - started
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+
+callback_router = CallbackRouter()
+
+@metrics.collector
+def collect_callback_metrics() -> list:
+    samples = []
+    for route, (calls, total, _) in callback_router.stats.items():
+        labels = (("route", route),)
+        samples.append(("omnibot_callback_calls_total", "counter", labels, calls))
+        samples.append(("omnibot_callback_seconds_total", "counter", labels, round(total, 6)))
+    return samples
+
+# ------------------ Клавиатуры ------------------
+# Статические клавиатуры и тексты строятся один раз при импорте; объекты
+# telegram неизменяемы, поэтому их можно отдавать во все ответы.
+# Динамические (варианты викторины, список задач) кэшируются по содержимому.
+START_MESSAGE = (
+    "👋 <b>Привет!</b>\n\n"
+    "Я <b>OmniBot</b> — универсальный помощник. Вот что я умею:\n"
+    "🔔 /reminder &lt;когда&gt; &lt;текст&gt; — установить напоминание, /reminders — список\n"
+    "🌤 /weather &lt;город&gt; — текущая погода\n"
+    "⛅ /forecast [&lt;город&gt;] — прогноз погоды\n"
+    "🌧 /alert &lt;условие&gt; — оповещение о погоде (мороз, жара, дождь)\n"
+    "💱 /rates — курсы валют и криптовалют (базовая: RUB)\n"
+    "🔍 /search &lt;запрос&gt; — поиск в Wikipedia\n"
+    "🗞 /news — последние новости (ленты: /news list)\n"
+    "🔄 /convert &lt;значение&gt; &lt;из_единицы&gt; to &lt;в_единице&gt; — конвертер\n"
+    "🌐 /translate_interactive — интерактивный переводчик\n"
+    "📋 /todo — задачи с приоритетами и сроками (добавить, список, удалить)\n"
+    "❓ /quiz — викторина\n"
+    "⚙️ /settings — настройки (город по умолчанию и др.)\n"
+    "📰 /subscribe и /unsubscribe — подписка на уведомления\n"
+    "🏆 /top_quiz — таблица лидеров\n"
+    "✨ В любом чате: @имя_бота weather Москва, @имя_бота 10 km to mi, @имя_бота rates\n\n"
+    "Выберите нужную функцию ниже:"
+)
+
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔔 Напоминание", callback_data="menu:reminder")],
+    [InlineKeyboardButton("🌤 Погода", callback_data="menu:weather"),
+     InlineKeyboardButton("⛅ Прогноз", callback_data="menu:forecast")],
+    [InlineKeyboardButton("💱 Курсы", callback_data="menu:rates"),
+     InlineKeyboardButton("🔍 Поиск", callback_data="menu:search")],
+    [InlineKeyboardButton("🔄 Конвертер", callback_data="menu:convert"),
+     InlineKeyboardButton("🌐 Перевод", callback_data="menu:translate")],
+    [InlineKeyboardButton("📋 To-Do", callback_data="menu:todo"),
+     InlineKeyboardButton("❓ Викторина", callback_data="menu:quiz")],
+    [InlineKeyboardButton("⚙️ Настройки", callback_data="menu:settings"),
+     InlineKeyboardButton("📰 Подписки", callback_data="menu:subscribe")],
+    [InlineKeyboardButton("🗞 Новости", callback_data="menu:news"),
+     InlineKeyboardButton("🏆 Топ квиз", callback_data="menu:top_quiz")]
+])
+
+TODO_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Добавить", callback_data="todo:add")],
+    [InlineKeyboardButton("Показать", callback_data="todo:list")],
+    [InlineKeyboardButton("Удалить", callback_data="todo:remove")]
+])
+
+SETTINGS_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Показать настройки", callback_data="settings:show")],
+    [InlineKeyboardButton("Установить город вручную", callback_data="settings:city")],
+    [InlineKeyboardButton("Установить по геолокации", callback_data="settings:geoloc")]
+])
+
+SUBSCRIBE_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Погода", callback_data="subscribe:weather"),
+     InlineKeyboardButton("Новости", callback_data="subscribe:news")]
+])
+
+LOCATION_KEYBOARD = ReplyKeyboardMarkup([[KeyboardButton("Отправить местоположение", request_location=True)]],
+                                        one_time_keyboard=True, resize_keyboard=True)
+
+def build_language_keyboard(namespace: str) -> InlineKeyboardMarkup:
+    keyboard = [InlineKeyboardButton(f"{info['name']} {info['flag']}", callback_data=f"{namespace}:{code}")
+                for code, info in LANGUAGES.items()]
+    return InlineKeyboardMarkup([keyboard[i:i+3] for i in range(0, len(keyboard), 3)])
+
+SRC_LANGUAGE_KEYBOARD = build_language_keyboard("src")
+TGT_LANGUAGE_KEYBOARD = build_language_keyboard("tgt")
+
+@lru_cache(maxsize=1024)
+def quiz_keyboard(question_index: int, options: tuple) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(opt, callback_data=callback_data("quiz", "answer", question_index, option_index))]
+        for option_index, opt in enumerate(options)
+    ])
 
 # ------------------ Функции ------------------
 
 # /start и /help: приветствие с кнопочным меню
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    message = (
-        "👋 <b>Привет!</b>\n\n"
-        "Я <b>OmniBot</b> — универсальный помощник. Вот что я умею:\n"
-        "🔔 /reminder &lt;секунды&gt; &lt;текст&gt; — установить напоминание\n"
-        "🌤 /weather &lt;город&gt; — текущая погода\n"
-        "⛅ /forecast [&lt;город&gt;] — прогноз погоды\n"
-        "💱 /rates — курсы валют и криптовалют (базовая: RUB)\n"
-        "🔍 /search &lt;запрос&gt; — поиск в Wikipedia\n"
-        "🔄 /convert &lt;значение&gt; &lt;из_единицы&gt; to &lt;в_единице&gt; — конвертер\n"
-        "🌐 /translate_interactive — интерактивный переводчик\n"
-        "📋 /todo — задачи (добавить, список, удалить)\n"
-        "❓ /quiz — викторина\n"
-        "⚙️ /settings — настройки (город по умолчанию и др.)\n"
-        "📰 /subscribe и /unsubscribe — подписка на уведомления\n"
-        "🏆 /top_quiz — таблица лидеров\n\n"
-        "Выберите нужную функцию ниже:"
-    )
-    keyboard = [
-        [InlineKeyboardButton("🔔 Напоминание", callback_data="menu_reminder")],
-        [InlineKeyboardButton("🌤 Погода", callback_data="menu_weather"),
-         InlineKeyboardButton("⛅ Прогноз", callback_data="menu_forecast")],
-        [InlineKeyboardButton("💱 Курсы", callback_data="menu_rates"),
-         InlineKeyboardButton("🔍 Поиск", callback_data="menu_search")],
-        [InlineKeyboardButton("🔄 Конвертер", callback_data="menu_convert"),
-         InlineKeyboardButton("🌐 Перевод", callback_data="menu_translate")],
-        [InlineKeyboardButton("📋 To-Do", callback_data="menu_todo"),
-         InlineKeyboardButton("❓ Викторина", callback_data="menu_quiz")],
-        [InlineKeyboardButton("⚙️ Настройки", callback_data="menu_settings"),
-         InlineKeyboardButton("📰 Подписки", callback_data="menu_subscribe")],
-        [InlineKeyboardButton("🏆 Топ квиз", callback_data="menu_top_quiz")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    await update.message.reply_text(START_MESSAGE, parse_mode=ParseMode.HTML, reply_markup=MAIN_MENU_KEYBOARD)
 
 # Напоминание
+REMINDER_USAGE = (
+    "Использование: /reminder <когда> <текст>\n"
+    "• /reminder 90 размяться — через 90 секунд\n"
+    "• /reminder 1h30m созвон — через полтора часа\n"
+    "• /reminder 18:30 ужин — сегодня (или завтра) в 18:30\n"
+    "• /reminder 2025-01-31 09:00 отчёт — в указанную дату\n"
+    "Список и отмена: /reminders"
+)
+
 async def reminder(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) < 2:
-        await update.message.reply_text("Использование: /reminder <секунды> <текст>")
+        await update.message.reply_text(REMINDER_USAGE)
         return
     try:
-        seconds = int(context.args[0])
-        if seconds <= 0:
-            await update.message.reply_text("Укажите число секунд больше 0.")
+        chat_id = update.effective_chat.id
+        now = datetime.now()
+        parsed = parse_reminder_time(context.args, now)
+        if parsed is None:
+            await update.message.reply_text(REMINDER_USAGE)
             return
-        text = " ".join(context.args[1:])
-        context.job_queue.run_once(send_reminder, seconds, data={'chat_id': update.effective_chat.id, 'text': text})
-        await update.message.reply_text(f"Напоминание установлено через {seconds} секунд.")
-    except ValueError:
-        await update.message.reply_text("Пожалуйста, укажите корректное число секунд.")
+        due, used = parsed
+        text = " ".join(context.args[used:])
+        if due <= now.timestamp() or not text:
+            await update.message.reply_text("Укажите время в будущем и текст напоминания.")
+            return
+        if reminder_scheduler.count(chat_id) >= REMINDER_MAX_PER_CHAT:
+            await update.message.reply_text(f"Не больше {REMINDER_MAX_PER_CHAT} активных напоминаний. Список: /reminders")
+            return
+        reminder_id = reminder_scheduler.add(chat_id, due, text)
+        await update.message.reply_text(f"Напоминание #{reminder_id} установлено на {format_due(due)}.")
+    except (ValueError, OverflowError):
+        await update.message.reply_text("Пожалуйста, укажите корректное время.")
     except Exception as e:
         logger.error("Ошибка в /reminder: %s", e)
         await update.message.reply_text("Ошибка при установке напоминания.")
 
-async def send_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job_data = context.job.data
-    await context.bot.send_message(chat_id=job_data['chat_id'], text=f"⏰ Напоминание: {job_data['text']}")
+# Список и отмена напоминаний
+async def reminders(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    if len(context.args) >= 2 and context.args[0].lower() == "cancel":
+        if context.args[1].lower() == "all":
+            count = reminder_scheduler.cancel_all(chat_id)
+            await update.message.reply_text(f"Отменено напоминаний: {count}")
+            return
+        try:
+            reminder_id = int(context.args[1].lstrip("#"))
+        except ValueError:
+            await update.message.reply_text("Использование: /reminders cancel <номер|all>")
+            return
+        if reminder_scheduler.cancel(chat_id, reminder_id):
+            await update.message.reply_text(f"Напоминание #{reminder_id} отменено.")
+        else:
+            await update.message.reply_text(f"Напоминание #{reminder_id} не найдено.")
+        return
+    message, reply_markup = render_reminders(chat_id)
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+# Оповещения о погоде
+ALERT_USAGE = (
+    "Использование: /alert <условие> [<город>]\n"
+    "• /alert temp < 0 — температура опустится ниже 0°C\n"
+    "• /alert temp > 30 Сочи — поднимется выше 30°C в Сочи\n"
+    "• /alert humidity > 90 — влажность выше 90%\n"
+    "• /alert rain — осадки в ближайшие часы\n"
+    "Без города — город из /settings. Список: /alert list, отмена: /alert cancel <номер|all>"
+)
+
+async def alert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    args = context.args
+    if not args:
+        await update.message.reply_text(ALERT_USAGE)
+        return
+    subcommand = args[0].lower()
+    if subcommand == "list":
+        message, reply_markup = render_alerts(chat_id)
+        await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+        return
+    if subcommand == "cancel" and len(args) >= 2:
+        if args[1].lower() == "all":
+            await update.message.reply_text(f"Отменено оповещений: {alert_watcher.cancel_all(chat_id)}")
+            return
+        try:
+            alert_id = int(args[1].lstrip("#"))
+        except ValueError:
+            await update.message.reply_text("Использование: /alert cancel <номер|all>")
+            return
+        if alert_watcher.cancel(chat_id, alert_id):
+            await update.message.reply_text(f"Оповещение #{alert_id} отменено.")
+        else:
+            await update.message.reply_text(f"Оповещение #{alert_id} не найдено.")
+        return
+    parsed = parse_alert_condition(args)
+    if parsed is None:
+        await update.message.reply_text(ALERT_USAGE)
+        return
+    metric, op, threshold, used = parsed
+    city, coords = (" ".join(args[used:]), None) if args[used:] else saved_place(chat_id)
+    if not city:
+        await update.message.reply_text("Укажите город после условия или задайте город через /settings")
+        return
+    if alert_watcher.count(chat_id) >= ALERT_MAX_PER_CHAT:
+        await update.message.reply_text(f"Не больше {ALERT_MAX_PER_CHAT} оповещений. Список: /alert list")
+        return
+    try:
+        current = await measure_place(city, coords, {metric})
+    except Exception as e:
+        logger.error("Ошибка в /alert: %s", e)
+        await update.message.reply_text("Ошибка при получении данных о погоде.")
+        return
+    if not current:
+        await update.message.reply_text(f"Город не найден: {city}")
+        return
+    alert_id = alert_watcher.add(chat_id, city, coords, metric, op, threshold, current)
+    value = current[metric]
+    message = f"Оповещение #{alert_id}: {city}, {describe_alert(metric, op, threshold)}."
+    if metric != "rain":
+        message += f"\nСейчас: {format_number(value)}{ALERT_METRICS[metric][1]}."
+    if value > threshold if op == ">" else value < threshold:
+        message += "\nУсловие уже выполняется — сообщу, когда оно наступит снова."
+    await update.message.reply_text(message)
 
 # Погода и прогноз
 async def weather(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    city = " ".join(context.args) if context.args else user_settings.get(update.effective_chat.id, {}).get("city")
+    city, coords = (" ".join(context.args), None) if context.args else saved_place(update.effective_chat.id)
     if not city:
         await update.message.reply_text("Укажите город: /weather <город> или задайте город через /settings")
         return
     try:
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        data = requests.get(url).json()
+        data = await get_weather(city, coords)
         if data.get("cod") != 200:
             await update.message.reply_text(f"Город не найден: {city}")
             return
-        desc = data["weather"][0]["description"].capitalize()
-        temp = data["main"]["temp"]
-        humidity = data["main"]["humidity"]
-        message = f"Погода в <b>{city}</b>:\nУсловия: {desc}\nТемпература: {temp}°C\nВлажность: {humidity}%"
+        message = format_weather(city, data)
         await update.message.reply_text(message, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error("Ошибка в /weather: %s", e)
         await update.message.reply_text("Ошибка при получении данных о погоде.")
 
 async def forecast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    city = " ".join(context.args) if context.args else user_settings.get(update.effective_chat.id, {}).get("city")
+    city, coords = (" ".join(context.args), None) if context.args else saved_place(update.effective_chat.id)
     if not city:
         await update.message.reply_text("Укажите город: /forecast <город> или задайте город через /settings")
         return
     try:
-        url = f"http://api.openweathermap.org/data/2.5/forecast?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        data = requests.get(url).json()
+        data = await get_forecast(city, coords)
         if data.get("cod") != "200":
             await update.message.reply_text(f"Не удалось получить прогноз для: {city}")
             return
-        message = f"<b>Прогноз погоды в {city} на ближайшие 24 часа:</b>\n"
-        for entry in data["list"][:8]:
-            dt = entry["dt_txt"]
-            temp = entry["main"]["temp"]
-            desc = entry["weather"][0]["description"].capitalize()
-            message += f"{dt}: {temp}°C, {desc}\n"
+        message = format_forecast(city, data)
         await update.message.reply_text(message, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error("Ошибка в /forecast: %s", e)
@@ -177,30 +3430,64 @@ async def forecast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 # Курсы валют и криптовалют
 async def rates(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        fiat_url = "https://api.exchangerate-api.com/v4/latest/RUB"
-        fiat_data = requests.get(fiat_url).json()
-        fiat_currencies = ["USD", "EUR", "GBP", "JPY", "CNY"]
-        fiat_message = "<b>Фиатные валюты (базовая: RUB):</b>\n"
-        for cur in fiat_currencies:
-            rate = fiat_data["rates"].get(cur)
-            if rate:
-                fiat_message += f"{cur}: {rate:.2f}\n"
-        crypto_ids = "bitcoin,ethereum,binancecoin,ripple,cardano"
-        crypto_url = f"https://api.coingecko.com/api/v3/simple/price?ids={crypto_ids}&vs_currencies=rub"
-        crypto_data = requests.get(crypto_url).json()
-        crypto_message = "\n<b>Криптовалюты (цена в RUB):</b>\n"
-        mapping = {"bitcoin": "Bitcoin (BTC)", "ethereum": "Ethereum (ETH)",
-                   "binancecoin": "Binance Coin (BNB)", "ripple": "Ripple (XRP)",
-                   "cardano": "Cardano (ADA)"}
-        for coin, name in mapping.items():
-            price = crypto_data.get(coin, {}).get("rub")
-            if price:
-                crypto_message += f"{name}: {price:,} RUB\n"
-        await update.message.reply_text(f"{fiat_message}{crypto_message}", parse_mode=ParseMode.HTML)
+        message = await rates_service.get_message()
+        if message is None:
+            await update.message.reply_text("Ошибка при получении курсов валют/криптовалют.")
+            return
+        await update.message.reply_text(message, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.error("Ошибка в /rates: %s", e)
         await update.message.reply_text("Ошибка при получении курсов валют/криптовалют.")
 
+# Новости
+NEWS_USAGE = (
+    "Использование:\n"
+    "• /news — последние новости выбранных лент\n"
+    "• /news <лента> — одна лента\n"
+    "• /news list — доступные ленты\n"
+    "• /news use <лента> [<лента> ...] — выбрать ленты для /news и подписки"
+)
+
+def render_feed_list(chat_id: int) -> str:
+    chosen = news_service.selected(chat_id)
+    lines = ["<b>Ленты новостей:</b>"]
+    for feed_id, feed in news_service.feeds.items():
+        mark = "✅" if feed_id in chosen else "▫️"
+        lines.append(f"{mark} <code>{html.escape(feed_id)}</code> — {html.escape(feed.title)}")
+    return "\n".join(lines)
+
+async def news(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    args = [arg.lower() for arg in context.args]
+    if args[:1] == ["list"]:
+        await update.message.reply_text(render_feed_list(chat_id), parse_mode=ParseMode.HTML)
+        return
+    if args[:1] == ["use"]:
+        feed_ids = list(dict.fromkeys(args[1:]))
+        unknown = [feed_id for feed_id in feed_ids if feed_id not in news_service.feeds]
+        if not feed_ids or unknown or len(feed_ids) > NEWS_MAX_FEEDS_PER_CHAT:
+            await update.message.reply_text(
+                f"Укажите от 1 до {NEWS_MAX_FEEDS_PER_CHAT} лент из /news list." +
+                (f" Неизвестные ленты: {', '.join(unknown)}" if unknown else ""))
+            return
+        get_chat(chat_id).feeds = tuple(sys.intern(feed_id) for feed_id in feed_ids)
+        save_settings(chat_id)
+        await update.message.reply_text(render_feed_list(chat_id), parse_mode=ParseMode.HTML)
+        return
+    if args and any(feed_id not in news_service.feeds for feed_id in args):
+        await update.message.reply_text(NEWS_USAGE)
+        return
+    feed_ids = tuple(dict.fromkeys(args))[:NEWS_MAX_FEEDS_PER_CHAT] or news_service.selected(chat_id)
+    try:
+        message = await news_service.digest(feed_ids, "<b>Последние новости:</b>\n\n")
+    except Exception as e:
+        logger.error("Ошибка в /news: %s", e)
+        message = None
+    if message is None:
+        await update.message.reply_text("Не удалось получить новости.")
+        return
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
 # Поиск в Wikipedia
 async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
@@ -208,44 +3495,44 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     try:
         query = " ".join(context.args)
-        url = f"https://ru.wikipedia.org/w/api.php?action=opensearch&search={query}&limit=3&namespace=0&format=json"
-        data = requests.get(url).json()
-        if len(data) >= 4 and data[3]:
-            results = "\n".join(data[3])
-            message = f"<b>Найденные ссылки по запросу «{query}»:</b>\n{results}"
-        else:
-            message = f"По запросу «{query}» ничего не найдено."
-        await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+        results = await wikipedia_search.search(query)
+        await update.message.reply_text(format_search_results(query, results), parse_mode=ParseMode.HTML,
+                                        disable_web_page_preview=True)
     except Exception as e:
         logger.error("Ошибка в /search: %s", e)
         await update.message.reply_text("Ошибка при поиске информации.")
 
+# Inline-запрос: ответ собирает inline_service, см. раздел «Inline-режим»
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.inline_query
+    kind, arg = parse_inline_query(query.query)
+    answer = await inline_service.answer(kind, arg, query.from_user.id)
+    if answer is None:
+        return  # пользователь уже набрал запрос новее
+    try:
+        # Погода без города — по городу из настроек, такой ответ у каждого свой
+        await query.answer(answer.results, cache_time=answer.cache_time, is_personal=kind == "weather" and not arg)
+    except BadRequest as e:  # запрос устарел, пока собирали ответ
+        logger.info("Inline-ответ не принят: %s", e)
+
 # Конвертер единиц
 async def convert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if len(context.args) < 4 or "to" not in context.args:
+    if len(context.args) < 4 or "to" not in context.args[2:-1]:
         await update.message.reply_text(
-            "Использование: /convert <значение> <из_единицы> to <в_единице>\nПримеры:\n• /convert 100 kg to lb\n• /convert 10 km to mi\n• /convert 20 C to F\n• /convert 68 F to C"
+            "Использование: /convert <значение> <из_единицы> to <в_единице>\nПримеры:\n• /convert 100 kg to lb\n• /convert 10 km to mi\n• /convert 20 C to F\n• /convert 100 usd to eur\n• /convert 1,5,10,100 km to mi"
         )
         return
     try:
-        to_index = context.args.index("to")
-        value = float(context.args[0])
-        from_unit = context.args[1].lower()
-        to_unit = context.args[to_index + 1].lower()
-        if from_unit in ["kg", "кг"] and to_unit in ["lb", "фунт", "фунты"]:
-            converted = value * 2.20462
-            message = f"{value} кг = {converted:.2f} фунтов"
-        elif from_unit in ["km", "километр", "километры"] and to_unit in ["mi", "miles", "мил", "мили"]:
-            converted = value * 0.621371
-            message = f"{value} км = {converted:.2f} миль"
-        elif from_unit in ["c", "°c", "celsius"] and to_unit in ["f", "°f", "fahrenheit"]:
-            converted = value * 9/5 + 32
-            message = f"{value}°C = {converted:.2f}°F"
-        elif from_unit in ["f", "°f", "fahrenheit"] and to_unit in ["c", "°c", "celsius"]:
-            converted = (value - 32) * 5/9
-            message = f"{value}°F = {converted:.2f}°C"
-        else:
-            message = "Конвертация для данных единиц не поддерживается."
+        to_index = context.args.index("to", 2)
+        # Несколько значений через запятую: /convert 1,5,10 km to mi
+        values = parse_values("".join(context.args[:to_index - 1]))
+        from_name = context.args[to_index - 1]
+        to_name = " ".join(context.args[to_index + 1:])
+        from_unit, to_unit = unit_registry.resolve(from_name), unit_registry.resolve(to_name)
+        if from_unit is None or to_unit is None:
+            await unit_registry.ensure_currencies()
+            from_unit, to_unit = unit_registry.resolve(from_name), unit_registry.resolve(to_name)
+        message = format_conversion(values, from_unit, to_unit) or "Конвертация для данных единиц не поддерживается."
         await update.message.reply_text(message)
     except ValueError:
         await update.message.reply_text("Пожалуйста, укажите корректное числовое значение.")
@@ -255,143 +3542,111 @@ async def convert(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 # Интерактивный переводчик
 async def translate_interactive(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    keyboard = []
-    for code, info in LANGUAGES.items():
-        button_text = f"{info['name']} {info['flag']}"
-        keyboard.append(InlineKeyboardButton(button_text, callback_data=f"src_{code}"))
-    rows = [keyboard[i:i+3] for i in range(0, len(keyboard), 3)]
-    reply_markup = InlineKeyboardMarkup(rows)
-    await update.message.reply_text("Выберите, с какого языка переводить текст:", reply_markup=reply_markup)
-
-async def translation_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("Выберите, с какого языка переводить текст:", reply_markup=SRC_LANGUAGE_KEYBOARD)
+
+@callback_router.route("src")
+async def translation_src_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
     query = update.callback_query
-    data = query.data
-    if data.startswith("src_"):
-        src_code = data.split("_")[1]
-        context.user_data["src_lang"] = src_code
-        keyboard = []
-        for code, info in LANGUAGES.items():
-            button_text = f"{info['name']} {info['flag']}"
-            keyboard.append(InlineKeyboardButton(button_text, callback_data=f"tgt_{code}"))
-        rows = [keyboard[i:i+3] for i in range(0, len(keyboard), 3)]
-        reply_markup = InlineKeyboardMarkup(rows)
-        await query.edit_message_text("Выберите, на какой язык переводить текст:", reply_markup=reply_markup)
-    elif data.startswith("tgt_"):
-        tgt_code = data.split("_")[1]
-        context.user_data["target_lang"] = tgt_code
-        context.user_data["awaiting_translation"] = True
-        await query.edit_message_text("Введите текст для перевода:")
+    get_chat(query.message.chat.id).src_lang = LANGUAGE_CODES.get(callback.action)
+    await query.edit_message_text("Выберите, на какой язык переводить текст:", reply_markup=TGT_LANGUAGE_KEYBOARD)
 
-async def translation_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if context.user_data.get("awaiting_translation"):
-        text = update.message.text
-        src_lang = context.user_data.get("src_lang")
-        target_lang = context.user_data.get("target_lang")
-        url = f"https://api.mymemory.translated.net/get?q={text}&langpair={src_lang}|{target_lang}"
-        data = requests.get(url).json()
-        translation = data.get("responseData", {}).get("translatedText")
-        if translation:
-            reply = "Вот ваш текст!\n```\n" + translation + "\n```"
-            await update.message.reply_text(reply, parse_mode=ParseMode.MARKDOWN)
-        else:
-            await update.message.reply_text("Не удалось получить перевод.")
-        context.user_data.pop("awaiting_translation", None)
-        context.user_data.pop("src_lang", None)
-        context.user_data.pop("target_lang", None)
+@callback_router.route("tgt")
+async def translation_tgt_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    state = get_chat(query.message.chat.id)
+    state.target_lang = LANGUAGE_CODES.get(callback.action)
+    state.mode = ChatMode.TRANSLATE
+    await query.edit_message_text("Введите текст для перевода:")
 
 # Управление задачами (To-Do)
+TODO_USAGE = (
+    "Использование:\n"
+    "• /todo add <текст> [!1|!2|!3] [@когда] — каждая строка сообщения станет задачей;\n"
+    "  !1 — высокий приоритет, !3 — низкий; @90m, @18:30, @2025-01-31 18:30 — срок с напоминанием\n"
+    "• /todo list — задачи по приоритету и сроку\n"
+    "• /todo remove 1-5,8 — удалить задачи по номерам (без номеров — выбрать кнопкой)"
+)
+
 async def todo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     # Если вызов без аргументов, показать интерактивное меню
     if not context.args:
-        keyboard = [
-            [InlineKeyboardButton("Добавить", callback_data="todo_add")],
-            [InlineKeyboardButton("Показать", callback_data="todo_list")],
-            [InlineKeyboardButton("Удалить", callback_data="todo_remove")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Выберите действие с задачами:", reply_markup=reply_markup)
+        await update.message.reply_text("Выберите действие с задачами:", reply_markup=TODO_MENU_KEYBOARD)
         return
     subcommand = context.args[0].lower()
     if subcommand == "add":
-        task = " ".join(context.args[1:])
-        if not task:
+        # Берём исходный текст, а не context.args, — в нём сохранены переводы строк
+        parts = update.message.text.split(maxsplit=2)
+        if len(parts) < 3:
             await update.message.reply_text("Укажите текст задачи после add.")
             return
-        todo_tasks.setdefault(chat_id, []).append(task)
-        await update.message.reply_text(f"Задача добавлена: {task}")
+        await update.message.reply_text(add_tasks(chat_id, parts[2]), parse_mode=ParseMode.HTML)
     elif subcommand == "list":
-        tasks = todo_tasks.get(chat_id, [])
-        if not tasks:
-            await update.message.reply_text("Список задач пуст.")
-            return
-        message = "<b>Ваш список задач:</b>\n"
-        for i, task in enumerate(tasks, 1):
-            message += f"{i}. {task}\n"
-        await update.message.reply_text(message, parse_mode=ParseMode.HTML)
+        message, markup = render_todo_page(chat_id, {})
+        await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=markup)
     elif subcommand == "remove":
-        try:
-            index = int(context.args[1]) - 1
-            tasks = todo_tasks.get(chat_id, [])
-            if 0 <= index < len(tasks):
-                removed = tasks.pop(index)
-                await update.message.reply_text(f"Задача удалена: {removed}")
-            else:
-                await update.message.reply_text("Некорректный номер задачи.")
-        except (IndexError, ValueError):
-            await update.message.reply_text("Использование: /todo remove <номер задачи>")
-    else:
-        await update.message.reply_text("Используйте subcommand add, list или remove.")
-
-# Интерактивное добавление задачи (обработка через callback)
-async def todo_add_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    context.user_data["todo_action"] = "add"
-    await update.message.reply_text("Введите текст задачи для добавления:")
-
-# Обработка текстового сообщения для добавления задачи
-async def todo_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    if context.user_data.get("todo_action") == "add":
-        task = update.message.text
-        chat_id = update.effective_chat.id
-        todo_tasks.setdefault(chat_id, []).append(task)
-        await update.message.reply_text(f"Задача добавлена: {task}")
-        context.user_data.pop("todo_action", None)
+        if len(context.args) < 2:
+            message, markup = render_todo_page(chat_id, {}, removing=True)
+            await update.message.reply_text(message, parse_mode=ParseMode.HTML, reply_markup=markup)
+            return
+        task_ids = parse_task_ids("".join(context.args[1:]), get_tasks(chat_id).next_id - 1)
+        if task_ids is None:
+            await update.message.reply_text("Использование: /todo remove <номера>, например 3 или 1-5,8")
+            return
+        removed = remove_tasks(chat_id, task_ids)
+        if len(removed) == 1:
+            task_id, task = removed[0]
+            await update.message.reply_text(f"Задача удалена: #{task_id} {task.text}")
+        elif removed:
+            await update.message.reply_text(f"Удалено задач: {len(removed)}")
+        else:
+            await update.message.reply_text("Задач с такими номерами нет.")
     else:
-        await translation_text_handler(update, context)  # Если не todo, обрабатываем как перевод
+        await update.message.reply_text(TODO_USAGE)
 
 # Викторина (Quiz)
 async def quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    question_index = random.randrange(len(quiz_questions))
-    question = quiz_questions[question_index]
-    text = f"<b>Вопрос:</b> {question['question']}"
-    buttons = [
-        [InlineKeyboardButton(opt, callback_data=f"quiz|{question_index}|{opt}")]
-        for opt in question["options"]
-    ]
-    reply_markup = InlineKeyboardMarkup(buttons)
+    await quiz_bank.load()
+    if not len(quiz_bank):
+        await update.effective_message.reply_text("Банк вопросов пуст.")
+        return
+    user_id = update.effective_user.id
+    stats = await get_quiz_stats(user_id)
+    question, attempts = None, 0
+    while question is None and attempts < 5:  # битые строки банка пропускаем
+        question_index = next_question_index(stats, len(quiz_bank))
+        question = quiz_bank.get(question_index)
+        attempts += 1
+    if question is None:
+        await update.effective_message.reply_text("Не удалось загрузить вопрос, попробуйте позже.")
+        return
+    stats["pending"] = question_index
+    save_quiz_stats(user_id, stats)
+    text = f"<b>Вопрос:</b> {html.escape(question['question'])}"
+    reply_markup = quiz_keyboard(question_index, tuple(question["options"]))
     await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
+# Таблица лидеров квиза
+async def top_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(await render_leaderboard(update.effective_user.id), parse_mode=ParseMode.HTML)
+
 # Настройки пользователя
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     if not context.args:
-        keyboard = [
-            [InlineKeyboardButton("Показать настройки", callback_data="settings_show")],
-            [InlineKeyboardButton("Установить город вручную", callback_data="settings_city")],
-            [InlineKeyboardButton("Установить по геолокации", callback_data="settings_geoloc")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+        await update.message.reply_text("Выберите действие:", reply_markup=SETTINGS_MENU_KEYBOARD)
         return
     subcommand = context.args[0].lower()
     if subcommand == "show":
-        settings_data = user_settings.get(chat_id, {})
-        city = settings_data.get("city", "не задан")
+        city = get_chat(chat_id).city or "не задан"
         await update.message.reply_text(f"Ваши настройки:\nГород по умолчанию: {city}")
     elif subcommand == "city":
         city = " ".join(context.args[1:])
         if city:
-            user_settings.setdefault(chat_id, {})["city"] = city
+            state = get_chat(chat_id)
+            state.city = city
+            state.lat = state.lon = None  # город задан вручную — координаты больше не его
+            save_settings(chat_id)
             await update.message.reply_text(f"Город по умолчанию установлен: {city}")
         else:
             await update.message.reply_text("Укажите город после команды /settings city")
@@ -403,11 +3658,15 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if update.message.location:
         lat = update.message.location.latitude
         lon = update.message.location.longitude
-        url = f"http://api.openweathermap.org/geo/1.0/reverse?lat={lat}&lon={lon}&limit=1&appid={OPENWEATHER_API_KEY}"
-        data = requests.get(url).json()
-        if data and isinstance(data, list) and data[0].get("name"):
-            city = data[0]["name"]
-            user_settings[update.effective_chat.id] = {"city": city}
+        try:
+            city = await reverse_geocoder.city_at(lat, lon)
+        except Exception as e:
+            logger.error("Ошибка геокодирования: %s", e)
+            city = None
+        if city:
+            state = get_chat(update.effective_chat.id)
+            state.city, state.lat, state.lon = city, round(lat, 4), round(lon, 4)
+            save_settings(update.effective_chat.id)
             await update.message.reply_text(f"Город по умолчанию установлен: {city}")
         else:
             await update.message.reply_text("Не удалось определить город по вашей геолокации.")
@@ -415,41 +3674,71 @@ async def location_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text("Местоположение не получено.")
 
 # Подписки на уведомления
-async def daily_weather(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job_data = context.job.data
-    chat_id = job_data["chat_id"]
-    city = user_settings.get(chat_id, {}).get("city")
-    if not city:
-        await context.bot.send_message(chat_id, text="[Подписка] Город по умолчанию не установлен. Используйте /settings для установки.")
-        return
+# Подписчики сгруппированы по слотам времени: на каждый слот одна задача
+# JobQueue, которая загружает каждый ресурс один раз (погоду — один раз на
+# город) и отдаёт готовые сообщения в очередь рассылки.
+async def daily_weather_message(city: str, coords: tuple = None) -> str:
     try:
-        url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-        data = requests.get(url).json()
+        data = await get_weather(city, coords)
         if data.get("cod") != 200:
-            message = f"[Подписка] Не удалось получить погоду для {city}."
-        else:
-            desc = data["weather"][0]["description"].capitalize()
-            temp = data["main"]["temp"]
-            message = f"[Подписка] Погода в {city}:\n{desc}, {temp}°C"
-        await context.bot.send_message(chat_id, text=message)
+            return f"[Подписка] Не удалось получить погоду для {city}."
+        desc = data["weather"][0]["description"].capitalize()
+        temp = data["main"]["temp"]
+        return f"[Подписка] Погода в {city}:\n{desc}, {temp}°C"
     except Exception as e:
         logger.error("Ошибка в daily_weather: %s", e)
+        return f"[Подписка] Не удалось получить погоду для {city}."
 
-async def daily_news(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job_data = context.job.data
-    chat_id = job_data["chat_id"]
-    try:
-        feed_url = "http://feeds.bbci.co.uk/russian/rss.xml"
-        feed = feedparser.parse(feed_url)
-        if feed.entries:
-            message = "<b>[Подписка] Последние новости:</b>\n"
-            for entry in feed.entries[:5]:
-                message += f"<a href='{entry.link}'>{entry.title}</a>\n"
-        else:
-            message = "[Подписка] Не удалось получить новости."
-        await context.bot.send_message(chat_id, text=message, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    except Exception as e:
-        logger.error("Ошибка в daily_news: %s", e)
+async def run_subscription_slot(context: ContextTypes.DEFAULT_TYPE) -> None:
+    slot = subscription_slots.get(context.job.data)
+    if not slot:
+        return
+    if slot["weather"]:
+        by_place = {}  # {ключ кэша погоды: (город, координаты, [chat_id, ...])}
+        places = await subscriber_places(list(slot["weather"]))
+        for chat_id, (city, coords) in places.items():
+            if not city:
+                send_pipeline.submit(chat_id, "[Подписка] Город по умолчанию не установлен. Используйте /settings для установки.")
+                continue
+            by_place.setdefault(weather_key(city, coords), (city, coords, []))[2].append(chat_id)
+        messages = await asyncio.gather(*(daily_weather_message(city, coords) for city, coords, _ in by_place.values()))
+        for (_, _, chat_ids), message in zip(by_place.values(), messages):
+            for chat_id in chat_ids:
+                send_pipeline.submit(chat_id, message)
+    if slot["news"]:
+        by_feeds = {}  # {выбранные ленты: [chat_id, ...]} — одно сообщение на каждый набор лент
+        for chat_id in slot["news"]:
+            by_feeds.setdefault(news_service.selected(chat_id), []).append(chat_id)
+        for feed_ids, chat_ids in by_feeds.items():
+            message = await news_service.digest(feed_ids, "<b>[Подписка] Последние новости:</b>\n\n")
+            message = message or "[Подписка] Не удалось получить новости."
+            for chat_id in chat_ids:
+                send_pipeline.submit(chat_id, message, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+def add_subscription(job_queue, chat_id: int, sub_type: str, scheduled_time: time, persist: bool = True) -> None:
+    remove_subscription(chat_id, sub_type, persist=False)
+    subscriptions[sub_type][chat_id] = scheduled_time
+    if persist:
+        storage_writer.put("subscription", (chat_id, sub_type), f"{scheduled_time:%H:%M}")
+    slot = subscription_slots.setdefault(scheduled_time, {"weather": set(), "news": set()})
+    slot[sub_type].add(chat_id)
+    if scheduled_time not in slot_jobs:
+        slot_jobs[scheduled_time] = job_queue.run_daily(
+            instrumented("subscription_slot", run_subscription_slot, "job"), scheduled_time, data=scheduled_time,
+            name=f"subscriptions {scheduled_time:%H:%M}")
+
+def remove_subscription(chat_id: int, sub_type: str, persist: bool = True) -> bool:
+    scheduled_time = subscriptions[sub_type].pop(chat_id, None)
+    if scheduled_time is None:
+        return False
+    if persist:
+        storage_writer.put("subscription", (chat_id, sub_type), None)
+    slot = subscription_slots[scheduled_time]
+    slot[sub_type].discard(chat_id)
+    if not slot["weather"] and not slot["news"]:
+        del subscription_slots[scheduled_time]
+        slot_jobs.pop(scheduled_time).schedule_removal()
+    return True
 
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) < 2:
@@ -465,12 +3754,10 @@ async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     chat_id = update.effective_chat.id
     if sub_type == "weather":
-        job = context.job_queue.run_daily(daily_weather, scheduled_time, data={"chat_id": chat_id})
-        subscriptions[(chat_id, "weather")] = job
+        add_subscription(context.job_queue, chat_id, "weather", scheduled_time)
         await update.message.reply_text(f"Подписка на погоду установлена на {time_str}.")
     elif sub_type == "news":
-        job = context.job_queue.run_daily(daily_news, scheduled_time, data={"chat_id": chat_id})
-        subscriptions[(chat_id, "news")] = job
+        add_subscription(context.job_queue, chat_id, "news", scheduled_time)
         await update.message.reply_text(f"Подписка на новости установлена на {time_str}.")
     else:
         await update.message.reply_text("Тип подписки должен быть weather или news.")
@@ -481,274 +3768,770 @@ async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
     sub_type = context.args[0].lower()
     chat_id = update.effective_chat.id
-    key = (chat_id, sub_type)
-    job = subscriptions.pop(key, None)
-    if job:
-        job.schedule_removal()
+    if remove_subscription(chat_id, sub_type):
         await update.message.reply_text(f"Подписка на {sub_type} отменена.")
     else:
         await update.message.reply_text(f"Подписка на {sub_type} не найдена.")
 
 # Интерактивное меню с кнопками для всех функций
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    keyboard = [
-        [InlineKeyboardButton("🔔 Напоминание", callback_data="menu_reminder")],
-        [InlineKeyboardButton("🌤 Погода", callback_data="menu_weather"),
-         InlineKeyboardButton("⛅ Прогноз", callback_data="menu_forecast")],
-        [InlineKeyboardButton("💱 Курсы", callback_data="menu_rates"),
-         InlineKeyboardButton("🔍 Поиск", callback_data="menu_search")],
-        [InlineKeyboardButton("🔄 Конвертер", callback_data="menu_convert"),
-         InlineKeyboardButton("🌐 Перевод", callback_data="menu_translate")],
-        [InlineKeyboardButton("📋 To-Do", callback_data="menu_todo"),
-         InlineKeyboardButton("❓ Викторина", callback_data="menu_quiz")],
-        [InlineKeyboardButton("⚙️ Настройки", callback_data="menu_settings"),
-         InlineKeyboardButton("📰 Подписки", callback_data="menu_subscribe")],
-        [InlineKeyboardButton("🏆 Топ квиз", callback_data="menu_top_quiz")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите опцию:", reply_markup=reply_markup)
+    await update.message.reply_text("Выберите опцию:", reply_markup=MAIN_MENU_KEYBOARD)
 
-# Callback handler для меню, викторины, переводчика и настроек
+# Callback-кнопки меню, викторины, настроек и задач.
+# Разбор callback_data и выбор обработчика — в CallbackRouter.
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await callback_router.dispatch(update, context)
+
+@callback_router.route("menu", "reminder")
+async def menu_reminder(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text(REMINDER_USAGE)
+
+@callback_router.route("reminder", "cancel")
+async def reminder_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
     query = update.callback_query
-    await query.answer()
-    data = query.data
-    if data.startswith("menu_"):
-        option = data.split("_")[1]
-        if option == "reminder":
-            await query.edit_message_text("Для установки напоминания используйте: /reminder <секунды> <текст>")
-        elif option == "weather":
-            chat_id = query.message.chat.id
-            city = user_settings.get(chat_id, {}).get("city")
-            if not city:
-                await query.edit_message_text("Город по умолчанию не установлен. Используйте /settings city <город> или выберите по геолокации.")
-            else:
-                try:
-                    url = f"http://api.openweathermap.org/data/2.5/weather?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-                    data_weather = requests.get(url).json()
-                    if data_weather.get("cod") != 200:
-                        message = f"Город не найден: {city}"
-                    else:
-                        desc = data_weather["weather"][0]["description"].capitalize()
-                        temp = data_weather["main"]["temp"]
-                        humidity = data_weather["main"]["humidity"]
-                        message = f"Погода в <b>{city}</b>:\nУсловия: {desc}\nТемпература: {temp}°C\nВлажность: {humidity}%"
-                    await query.edit_message_text(message, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error("Ошибка в меню погода: %s", e)
-                    await query.edit_message_text("Ошибка при получении данных о погоде.")
-        elif option == "forecast":
-            chat_id = query.message.chat.id
-            city = user_settings.get(chat_id, {}).get("city")
-            if not city:
-                await query.edit_message_text("Город по умолчанию не установлен. Используйте /settings city <город>.")
-            else:
-                try:
-                    url = f"http://api.openweathermap.org/data/2.5/forecast?q={city}&appid={OPENWEATHER_API_KEY}&units=metric&lang=ru"
-                    data_forecast = requests.get(url).json()
-                    if data_forecast.get("cod") != "200":
-                        message = f"Не удалось получить прогноз для: {city}"
-                    else:
-                        message = f"<b>Прогноз погоды в {city} на ближайшие 24 часа:</b>\n"
-                        for entry in data_forecast["list"][:8]:
-                            dt = entry["dt_txt"]
-                            temp = entry["main"]["temp"]
-                            desc = entry["weather"][0]["description"].capitalize()
-                            message += f"{dt}: {temp}°C, {desc}\n"
-                    await query.edit_message_text(message, parse_mode=ParseMode.HTML)
-                except Exception as e:
-                    logger.error("Ошибка в меню прогноз: %s", e)
-                    await query.edit_message_text("Ошибка при получении прогноза.")
-        elif option == "rates":
-            try:
-                fiat_url = "https://api.exchangerate-api.com/v4/latest/RUB"
-                fiat_data = requests.get(fiat_url).json()
-                fiat_currencies = ["USD", "EUR", "GBP", "JPY", "CNY"]
-                fiat_message = "<b>Фиатные валюты (базовая: RUB):</b>\n"
-                for cur in fiat_currencies:
-                    rate = fiat_data["rates"].get(cur)
-                    if rate:
-                        fiat_message += f"{cur}: {rate:.2f}\n"
-                crypto_ids = "bitcoin,ethereum,binancecoin,ripple,cardano"
-                crypto_url = f"https://api.coingecko.com/api/v3/simple/price?ids={crypto_ids}&vs_currencies=rub"
-                crypto_data = requests.get(crypto_url).json()
-                crypto_message = "\n<b>Криптовалюты (цена в RUB):</b>\n"
-                mapping = {"bitcoin": "Bitcoin (BTC)", "ethereum": "Ethereum (ETH)",
-                           "binancecoin": "Binance Coin (BNB)", "ripple": "Ripple (XRP)",
-                           "cardano": "Cardano (ADA)"}
-                for coin, name in mapping.items():
-                    price = crypto_data.get(coin, {}).get("rub")
-                    if price:
-                        crypto_message += f"{name}: {price:,} RUB\n"
-                message = fiat_message + crypto_message
-                await query.edit_message_text(message, parse_mode=ParseMode.HTML)
-            except Exception as e:
-                logger.error("Ошибка в меню rates: %s", e)
-                await query.edit_message_text("Ошибка при получении курсов валют/криптовалют.")
-        elif option == "search":
-            await query.edit_message_text("Для поиска используйте: /search <запрос>")
-        elif option == "convert":
-            await query.edit_message_text("Для конвертации используйте: /convert <значение> <из_единицы> to <в_единице>")
-        elif option == "translate":
-            keyboard = []
-            for code, info in LANGUAGES.items():
-                button_text = f"{info['name']} {info['flag']}"
-                keyboard.append(InlineKeyboardButton(button_text, callback_data=f"src_{code}"))
-            rows = [keyboard[i:i+3] for i in range(0, len(keyboard), 3)]
-            reply_markup = InlineKeyboardMarkup(rows)
-            await query.edit_message_text("Выберите, с какого языка переводить текст:", reply_markup=reply_markup)
-        elif option == "todo":
-            keyboard = [
-                [InlineKeyboardButton("Добавить", callback_data="todo_add")],
-                [InlineKeyboardButton("Показать", callback_data="todo_list")],
-                [InlineKeyboardButton("Удалить", callback_data="todo_remove")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите действие с задачами:", reply_markup=reply_markup)
-        elif option == "quiz":
-            await quiz(update, context)
-        elif option == "settings":
-            chat_id = query.message.chat.id
-            settings_data = user_settings.get(chat_id, {})
-            city = settings_data.get("city", "не задан")
-            keyboard = [
-                [InlineKeyboardButton("Показать настройки", callback_data="settings_show")],
-                [InlineKeyboardButton("Установить город вручную", callback_data="settings_city")],
-                [InlineKeyboardButton("Установить по геолокации", callback_data="settings_geoloc")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            message = f"Ваши настройки:\nГород по умолчанию: {city}\nВыберите действие:"
-            await query.edit_message_text(message, reply_markup=reply_markup)
-        elif option == "subscribe":
-            keyboard = [
-                [InlineKeyboardButton("Погода", callback_data="subscribe_weather"),
-                 InlineKeyboardButton("Новости", callback_data="subscribe_news")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("Выберите тип подписки:", reply_markup=reply_markup)
-        elif option == "top_quiz":
-            await query.edit_message_text("Функция /top_quiz пока в разработке.")
+    chat_id = query.message.chat.id
+    if callback.args:
+        reminder_scheduler.cancel(chat_id, callback.args[0])
+    message, reply_markup = render_reminders(chat_id)
+    await query.edit_message_text(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+@callback_router.route("alert", "cancel")
+async def alert_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    chat_id = query.message.chat.id
+    if callback.args:
+        alert_watcher.cancel(chat_id, callback.args[0])
+    message, reply_markup = render_alerts(chat_id)
+    await query.edit_message_text(message, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+@callback_router.route("menu", "weather")
+async def menu_weather(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    city, coords = saved_place(query.message.chat.id)
+    if not city:
+        await query.edit_message_text("Город по умолчанию не установлен. Используйте /settings city <город> или выберите по геолокации.")
+        return
+    try:
+        data_weather = await get_weather(city, coords)
+        if data_weather.get("cod") != 200:
+            message = f"Город не найден: {city}"
+        else:
+            message = format_weather(city, data_weather)
+        await query.edit_message_text(message, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error("Ошибка в меню погода: %s", e)
+        await query.edit_message_text("Ошибка при получении данных о погоде.")
+
+@callback_router.route("menu", "forecast")
+async def menu_forecast(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    city, coords = saved_place(query.message.chat.id)
+    if not city:
+        await query.edit_message_text("Город по умолчанию не установлен. Используйте /settings city <город>.")
+        return
+    try:
+        data_forecast = await get_forecast(city, coords)
+        if data_forecast.get("cod") != "200":
+            message = f"Не удалось получить прогноз для: {city}"
+        else:
+            message = format_forecast(city, data_forecast)
+        await query.edit_message_text(message, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error("Ошибка в меню прогноз: %s", e)
+        await query.edit_message_text("Ошибка при получении прогноза.")
+
+@callback_router.route("menu", "news")
+async def menu_news(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    message = await news_service.digest(news_service.selected(query.message.chat.id), "<b>Последние новости:</b>\n\n")
+    if message is None:
+        await query.edit_message_text("Не удалось получить новости.")
+    else:
+        await query.edit_message_text(message, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+@callback_router.route("menu", "rates")
+async def menu_rates(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    try:
+        message = await rates_service.get_message()
+        if message is None:
+            await query.edit_message_text("Ошибка при получении курсов валют/криптовалют.")
         else:
-            await query.edit_message_text("Неизвестная опция.")
-    elif data.startswith("quiz|"):
-        parts = data.split("|")
-        if len(parts) < 3:
-            return
-        q_index = int(parts[1])
-        selected = parts[2]
-        correct = quiz_questions[q_index]["answer"]
-        response = "✅ Верно!" if selected == correct else f"❌ Неверно. Правильный ответ: {correct}"
-        await query.edit_message_text(text=response)
-    elif data.startswith("settings_"):
-        sub = data.split("_")[1]
-        if sub == "show":
-            chat_id = query.message.chat.id
-            settings_data = user_settings.get(chat_id, {})
-            city = settings_data.get("city", "не задан")
-            await query.edit_message_text(f"Ваши настройки:\nГород по умолчанию: {city}")
-        elif sub == "city":
-            await query.edit_message_text("Введите город для установки вручную через: /settings city <город>")
-        elif sub == "geoloc":
-            keyboard = ReplyKeyboardMarkup([[KeyboardButton("Отправить местоположение", request_location=True)]],
-                                           one_time_keyboard=True, resize_keyboard=True)
-            await query.edit_message_text("Нажмите кнопку ниже, чтобы отправить своё местоположение:")
-            await query.message.reply_text("Отправьте своё местоположение:", reply_markup=keyboard)
-    elif data.startswith("todo_"):
-        if data == "todo_add":
-            context.user_data["todo_action"] = "add"
-            await query.edit_message_text("Введите текст задачи для добавления:")
-        elif data == "todo_list":
-            tasks = todo_tasks.get(query.message.chat.id, [])
-            if tasks:
-                message = "<b>Ваш список задач:</b>\n" + "\n".join(f"{i+1}. {task}" for i, task in enumerate(tasks))
-            else:
-                message = "Список задач пуст."
             await query.edit_message_text(message, parse_mode=ParseMode.HTML)
-        elif data == "todo_remove":
-            tasks = todo_tasks.get(query.message.chat.id, [])
-            if tasks:
-                keyboard = []
-                for i, task in enumerate(tasks):
-                    keyboard.append([InlineKeyboardButton(f"{i+1}. {task}", callback_data=f"todo_remove_{i}")])
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text("Выберите задачу для удаления:", reply_markup=reply_markup)
-            else:
-                await query.edit_message_text("Список задач пуст.")
-        elif data.startswith("todo_remove_"):
-            index = int(data.split("_")[2])
-            tasks = todo_tasks.get(query.message.chat.id, [])
-            if 0 <= index < len(tasks):
-                removed = tasks.pop(index)
-                await query.edit_message_text(f"Задача удалена: {removed}")
-            else:
-                await query.edit_message_text("Некорректный номер задачи.")
-    elif data.startswith("subscribe_"):
-        sub = data.split("_")[1]
-        if sub == "weather":
-            await query.edit_message_text("Для подписки на погоду используйте: /subscribe weather <HH:MM>")
-        elif sub == "news":
-            await query.edit_message_text("Для подписки на новости используйте: /subscribe news <HH:MM>")
-    elif data.startswith("src_") or data.startswith("tgt_"):
-        await translation_callback_handler(update, context)
+    except Exception as e:
+        logger.error("Ошибка в меню rates: %s", e)
+        await query.edit_message_text("Ошибка при получении курсов валют/криптовалют.")
+
+@callback_router.route("menu", "search")
+async def menu_search(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Для поиска используйте: /search <запрос>")
+
+@callback_router.route("menu", "convert")
+async def menu_convert(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Для конвертации используйте: /convert <значение> <из_единицы> to <в_единице>")
+
+@callback_router.route("menu", "translate")
+async def menu_translate(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Выберите, с какого языка переводить текст:", reply_markup=SRC_LANGUAGE_KEYBOARD)
+
+@callback_router.route("menu", "todo")
+async def menu_todo(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Выберите действие с задачами:", reply_markup=TODO_MENU_KEYBOARD)
+
+@callback_router.route("menu", "quiz")
+async def menu_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await quiz(update, context)
+
+@callback_router.route("menu", "settings")
+async def menu_settings(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    city = get_chat(query.message.chat.id).city or "не задан"
+    message = f"Ваши настройки:\nГород по умолчанию: {city}\nВыберите действие:"
+    await query.edit_message_text(message, reply_markup=SETTINGS_MENU_KEYBOARD)
+
+@callback_router.route("menu", "subscribe")
+async def menu_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Выберите тип подписки:", reply_markup=SUBSCRIBE_MENU_KEYBOARD)
+
+@callback_router.route("menu", "top_quiz")
+async def menu_top_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text(await render_leaderboard(update.effective_user.id),
+                                                  parse_mode=ParseMode.HTML)
+
+@callback_router.route("menu")
+async def menu_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Неизвестная опция.")
+
+@callback_router.route("quiz", "answer")
+async def quiz_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    if len(callback.args) < 2:
+        return
+    await quiz_bank.load()
+    question_index, option_index = callback.args[0], callback.args[1]
+    question = quiz_bank.get(question_index)
+    if question is None:
+        return
+    options = question["options"]
+    selected = options[option_index] if option_index < len(options) else None
+    correct = question["answer"]
+    response = "✅ Верно!" if selected == correct else f"❌ Неверно. Правильный ответ: {correct}"
+    # Засчитывается только первый ответ на последний выданный вопрос
+    user = update.effective_user
+    stats = await get_quiz_stats(user.id)
+    if stats.get("pending") == question_index:
+        stats["pending"] = None
+        stats["answered"] = stats.get("answered", 0) + 1
+        if selected == correct:
+            stats["score"] = stats.get("score", 0) + 1
+            stats["updated"] = datetime.now().timestamp()
+            stats["name"] = user.full_name
+            quiz_leaderboard.update(user.id, stats["score"], stats["updated"], stats["name"])
+            rank = quiz_leaderboard.rank(user.id)
+            if rank is not None and rank <= QUIZ_TOP_SHOWN:
+                await publish_leaderboard()
+        save_quiz_stats(user.id, stats)
+        response += f"\nВаш счёт: {stats.get('score', 0)} из {stats['answered']}"
+    await update.callback_query.edit_message_text(text=response)
+
+@callback_router.route("settings", "show")
+async def settings_show(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    city = get_chat(query.message.chat.id).city or "не задан"
+    await query.edit_message_text(f"Ваши настройки:\nГород по умолчанию: {city}")
+
+@callback_router.route("settings", "city")
+async def settings_city(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Введите город для установки вручную через: /settings city <город>")
+
+@callback_router.route("settings", "geoloc")
+async def settings_geoloc(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    await query.edit_message_text("Нажмите кнопку ниже, чтобы отправить своё местоположение:")
+    await query.message.reply_text("Отправьте своё местоположение:", reply_markup=LOCATION_KEYBOARD)
+
+@callback_router.route("todo", "add")
+async def todo_add_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    get_chat(update.callback_query.message.chat.id).mode = ChatMode.TODO_ADD
+    await update.callback_query.edit_message_text("Введите текст задачи для добавления:")
+
+@callback_router.route("todo", "list")
+async def todo_list_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    message, markup = render_todo_page(query.message.chat.id, todo_cursor(callback.args))
+    await query.edit_message_text(message, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+@callback_router.route("todo", "remove")
+async def todo_remove_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    message, markup = render_todo_page(query.message.chat.id, todo_cursor(callback.args), removing=True)
+    await query.edit_message_text(message, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+@callback_router.route("todo", "del")
+async def todo_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    query = update.callback_query
+    chat_id = query.message.chat.id
+    if len(callback.args) != 5:  # кнопки старого формата несли позицию в списке, а не id
+        await query.edit_message_text("Список устарел, откройте его заново: /todo remove")
+        return
+    removed = remove_tasks(chat_id, callback.args[:1])
+    # Остаёмся на той же странице: курсор — её первая задача
+    message, markup = render_todo_page(chat_id, todo_cursor(callback.args[1:]), removing=True)
+    if removed:
+        task_id, task = removed[0]
+        message = f"Задача удалена: #{task_id} {html.escape(task.text)}\n\n" + message
+    else:
+        message = "Задача уже удалена.\n\n" + message
+    await query.edit_message_text(message, parse_mode=ParseMode.HTML, reply_markup=markup)
+
+@callback_router.route("subscribe", "weather")
+async def subscribe_weather_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Для подписки на погоду используйте: /subscribe weather <HH:MM>")
+
+@callback_router.route("subscribe", "news")
+async def subscribe_news_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback: Callback) -> None:
+    await update.callback_query.edit_message_text("Для подписки на новости используйте: /subscribe news <HH:MM>")
 
 # Обработчик текстовых сообщений для интерактивного переводчика и задач
 async def translation_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # Если ожидается текст для перевода
-    if context.user_data.get("awaiting_translation"):
-        text = update.message.text
-        src_lang = context.user_data.get("src_lang")
-        target_lang = context.user_data.get("target_lang")
-        url = f"https://api.mymemory.translated.net/get?q={text}&langpair={src_lang}|{target_lang}"
-        data = requests.get(url).json()
-        translation = data.get("responseData", {}).get("translatedText")
+    chat_id = update.effective_chat.id
+    state = get_chat(chat_id)
+    mode = state.mode
+    if mode == ChatMode.IDLE:
+        return
+    # Шаг диалога сбрасываем до await, чтобы следующее сообщение его не повторило
+    src_lang, target_lang = state.src_lang, state.target_lang
+    state.reset_dialog()
+    if state.spilled:
+        save_settings(chat_id, state)
+    if mode == ChatMode.TRANSLATE:
+        try:
+            translation = await translate_text(update.message.text, src_lang, target_lang)
+        except Exception as e:
+            logger.error("Ошибка перевода: %s", e)
+            translation = None
         if translation:
             reply = "Вот ваш текст!\n```\n" + translation + "\n```"
             await update.message.reply_text(reply, parse_mode=ParseMode.MARKDOWN)
         else:
             await update.message.reply_text("Не удалось получить перевод.")
-        context.user_data.pop("awaiting_translation", None)
-        context.user_data.pop("src_lang", None)
-        context.user_data.pop("target_lang", None)
-    # Если ожидается текст для добавления задачи
-    elif context.user_data.get("todo_action") == "add":
-        task = update.message.text
-        chat_id = update.effective_chat.id
-        todo_tasks.setdefault(chat_id, []).append(task)
-        await update.message.reply_text(f"Задача добавлена: {task}")
-        context.user_data.pop("todo_action", None)
+    elif mode == ChatMode.TODO_ADD:
+        await update.message.reply_text(add_tasks(chat_id, update.message.text), parse_mode=ParseMode.HTML)
 
 # ------------------ Основная функция ------------------
-async def main() -> None:
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+# Регистрируется один раз при импорте: повторный запуск в том же процессе
+# (тесты) не должен дублировать серии
+@metrics.collector
+def collect_runtime_metrics() -> list:
+    app = application
+    if app is None:
+        return []
+    samples = [
+        ("omnibot_jobqueue_jobs", "gauge", (), len(app.job_queue.jobs())),
+        ("omnibot_send_queue_size", "gauge", (), send_pipeline.queue.qsize()),
+        ("omnibot_send_messages_total", "counter", (("result", "sent"),), send_pipeline.sent),
+        ("omnibot_send_messages_total", "counter", (("result", "failed"),), send_pipeline.failed),
+        ("omnibot_send_merged_total", "counter", (), send_pipeline.merged),
+        ("omnibot_reminders_pending", "gauge", (), len(reminder_scheduler.reminders)),
+        ("omnibot_reminders_delivered_total", "counter", (), reminder_scheduler.delivered),
+    ]
+    limiter = app.bot.rate_limiter
+    if isinstance(limiter, OutboundRateLimiter):
+        samples += [
+            ("omnibot_send_retry_after_total", "counter", (), limiter.retry_after),
+            ("omnibot_send_network_retries_total", "counter", (), limiter.retries),
+            ("omnibot_send_delayed_total", "counter", (("lane", "interactive"),), limiter.delayed["interactive"]),
+            ("omnibot_send_delayed_total", "counter", (("lane", "broadcast"),), limiter.delayed["broadcast"]),
+        ]
+    processor = app.update_processor
+    if isinstance(processor, ChatOrderedUpdateProcessor):
+        stats = processor.stats()
+        samples += [
+            ("omnibot_updates_queue_depth", "gauge", (), stats["queue_depth"]),
+            ("omnibot_updates_active", "gauge", (), stats["active"]),
+            ("omnibot_updates_processed_total", "counter", (), stats["processed"]),
+            ("omnibot_updates_wait_seconds_total", "counter", (), round(processor.wait_total, 6)),
+        ]
+    return samples
+
+async def on_startup(app) -> None:
+    global send_pipeline, storage, storage_writer, metrics_server, application
+    send_pipeline = SendPipeline(app.bot)
+    send_pipeline.start()
+    storage = create_storage()
+    storage_writer = StorageWriter(storage)
+    storage_writer.start()
+    startup_profile.mark("open storage")
+    for chat_id, sub_type, time_str in storage.load_subscriptions():
+        hour, minute = map(int, time_str.split(":"))
+        add_subscription(app.job_queue, chat_id, sub_type, time(hour, minute), persist=False)
+    logger.info("Восстановлено подписок: %d", sum(map(len, subscriptions.values())))
+    startup_profile.mark("load subscriptions")
+    reminder_scheduler.load(storage.load_reminders(), storage.load_next_id("reminder", 0))
+    reminder_scheduler.start(send_pipeline)
+    logger.info("Загружено напоминаний: %d", len(reminder_scheduler.reminders))
+    startup_profile.mark("load reminders")
+    alert_watcher.load(storage.load_alerts(), storage.load_next_id("alert", 0))
+    logger.info("Загружено оповещений о погоде: %d (мест: %d)", len(alert_watcher.alerts), len(alert_watcher.places))
+    startup_profile.mark("load alerts")
+    for user_id, data in storage.load_quiz_top(QUIZ_LEADERBOARD_SIZE):
+        quiz_leaderboard.update(user_id, data.get("score", 0), data.get("updated", 0), data.get("name", str(user_id)))
+    await publish_leaderboard()
+    startup_profile.mark("load leaderboard")
+
+    application = app
+    if METRICS_PORT:
+        metrics_server = HttpServer({("GET", "/metrics"): metrics_handler}, METRICS_LISTEN, METRICS_PORT)
+        await metrics_server.start()
+        logger.info("Метрики: http://%s:%d/metrics", METRICS_LISTEN, metrics_server.port)
+    app.job_queue.run_repeating(instrumented("rates_refresh", rates_service.refresh, "job"), RATES_REFRESH_INTERVAL, first=0, name="rates refresh")
+    app.job_queue.run_repeating(instrumented("news_refresh", news_service.refresh, "job"), NEWS_REFRESH_INTERVAL, first=0, name="news refresh")
+    app.job_queue.run_repeating(instrumented("alert_check", alert_watcher.check, "job"), ALERT_CHECK_INTERVAL, first=0, name="weather alerts")
+    app.job_queue.run_repeating(instrumented("chat_eviction", evict_idle_chats, "job"), CHAT_EVICT_INTERVAL, first=CHAT_EVICT_INTERVAL, name="chat eviction")
+    startup_profile.mark("start jobs and metrics")
+
+# Фоновый прогрев: то, что иначе загрузилось бы на первом запросе
+# пользователя, догружается сразу после старта, когда бот уже отвечает.
+# Потом пишется отчёт профиля запуска.
+async def warm_up(**extra) -> None:
+    steps = []
+    if WARM_UP:
+        steps += [
+            ("import feedparser", lambda: asyncio.to_thread(importlib.import_module, "feedparser")),
+            ("import currency_converter", lambda: asyncio.to_thread(importlib.import_module, "currency_converter")),
+            ("quiz bank", quiz_bank.load),
+            ("currency table", unit_registry.ensure_currencies),
+        ]
+        if translation_disk_cache is not None:
+            steps.append(("translation cache", lambda: asyncio.to_thread(translation_disk_cache.connect)))
+        if reverse_geocoder.cities is not None:
+            steps.append(("city index", reverse_geocoder.cities.load))
+    for name, step in steps:
+        started = perf_counter()
+        try:
+            await step()
+        except Exception as e:
+            logger.warning("Прогрев %s не удался: %s", name, e)
+        startup_profile.warm_up.append((name, perf_counter() - started))
+    startup_profile.report(**extra)
+
+# Вызывается и после неудачного старта: останавливает только то, что успело
+# запуститься, и обнуляет ссылки, чтобы повторный запуск начинал с чистого листа
+async def on_shutdown(app) -> None:
+    global send_pipeline, storage_writer, metrics_server, application
+    application = None
+    if metrics_server is not None:
+        await metrics_server.stop()
+        metrics_server = None
+    await reminder_scheduler.stop()
+    if send_pipeline is not None:
+        await send_pipeline.stop()
+        send_pipeline = None
+    if storage_writer is not None:
+        await storage_writer.stop()
+        storage_writer = None
+    quiz_bank.close()
+    logger.info("Кэш погоды: %s, кэш прогнозов: %s", weather_cache.stats(), forecast_cache.stats())
+    logger.info("Callback-маршруты (вызовов, сек всего, сек максимум): %s", callback_router.stats)
+    logger.info("Обработка обновлений: %s", app.update_processor.stats())
+    if http_client is not None:
+        await http_client.aclose()
+
+def build_application():
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_BACKLOG))
+        .rate_limiter(OutboundRateLimiter())
+        .application_class(OmniApplication)
+        .build()
+    )
 
     # Регистрация команд
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", start))
-    app.add_handler(CommandHandler("reminder", reminder))
-    app.add_handler(CommandHandler("weather", weather))
-    app.add_handler(CommandHandler("forecast", forecast))
-    app.add_handler(CommandHandler("rates", rates))
-    app.add_handler(CommandHandler("search", search))
-    app.add_handler(CommandHandler("convert", convert))
-    app.add_handler(CommandHandler("translate_interactive", translate_interactive))
-    app.add_handler(CommandHandler("todo", todo))
-    app.add_handler(CommandHandler("quiz", quiz))
-    app.add_handler(CommandHandler("settings", settings))
-    app.add_handler(CommandHandler("subscribe", subscribe))
-    app.add_handler(CommandHandler("unsubscribe", unsubscribe))
-    app.add_handler(CommandHandler("menu", menu))
-    app.add_handler(CommandHandler("top_quiz", lambda update, context: update.message.reply_text("Функция /top_quiz пока в разработке.")))
+    app.add_handler(CommandHandler("start", instrumented("start", start)))
+    app.add_handler(CommandHandler("help", instrumented("help", start)))
+    app.add_handler(CommandHandler("reminder", instrumented("reminder", reminder)))
+    app.add_handler(CommandHandler("reminders", instrumented("reminders", reminders)))
+    app.add_handler(CommandHandler("weather", instrumented("weather", weather)))
+    app.add_handler(CommandHandler("forecast", instrumented("forecast", forecast)))
+    app.add_handler(CommandHandler("alert", instrumented("alert", alert)))
+    app.add_handler(CommandHandler("rates", instrumented("rates", rates)))
+    app.add_handler(CommandHandler("search", instrumented("search", search)))
+    app.add_handler(CommandHandler("news", instrumented("news", news)))
+    app.add_handler(CommandHandler("convert", instrumented("convert", convert)))
+    app.add_handler(CommandHandler("translate_interactive", instrumented("translate_interactive", translate_interactive)))
+    app.add_handler(CommandHandler("todo", instrumented("todo", todo)))
+    app.add_handler(CommandHandler("quiz", instrumented("quiz", quiz)))
+    app.add_handler(CommandHandler("settings", instrumented("settings", settings)))
+    app.add_handler(CommandHandler("subscribe", instrumented("subscribe", subscribe)))
+    app.add_handler(CommandHandler("unsubscribe", instrumented("unsubscribe", unsubscribe)))
+    app.add_handler(CommandHandler("menu", instrumented("menu", menu)))
+    app.add_handler(CommandHandler("top_quiz", instrumented("top_quiz", top_quiz)))
+    app.add_handler(InlineQueryHandler(instrumented("inline", inline_query)))
     
     # Обработчик callback'ов от inline-кнопок
-    app.add_handler(CallbackQueryHandler(callback_handler))
+    app.add_handler(CallbackQueryHandler(instrumented("callback", callback_handler)))
     
     # Обработчик текстовых сообщений для интерактивного переводчика и для добавления задач
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, translation_text_handler))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("text", translation_text_handler)))
     # Обработчик для геолокации
-    app.add_handler(MessageHandler(filters.LOCATION, location_handler))
+    app.add_handler(MessageHandler(filters.LOCATION, instrumented("location", location_handler)))
+    return app
+
+# ------------------ Многопроцессный режим ------------------
+# WORKERS > 1: фронт-процесс получает обновления (polling или webhook) и
+# пересылает их пачками по локальному HTTP рабочим процессам; шард
+# выбирается по crc32(chat_id), так что все данные чата (задачи, настройки,
+# подписки, напоминания, шаг диалога) живут в одном процессе со своим файлом
+# хранилища. Исключение — квиз: его статистика ведётся по игроку, поэтому
+# команды и кнопки квиза шардируются по crc32(user_id), и игрок из разных
+# чатов всегда попадает в один шард. Для каждого шарда пересылка идёт одним
+# потоком, поэтому порядок обновлений чата сохраняется. Общие для всех шардов данные (погода, курсы,
+# таблица лидеров) лежат в кэше фронт-процесса, доступном по тому же HTTP.
+def shard_for(chat_key, shards: int) -> int:
+    return zlib.crc32(str(chat_key).encode()) % shards if chat_key is not None else 0
+
+QUIZ_COMMANDS = frozenset(("/quiz", "/top_quiz"))
+QUIZ_CALLBACKS = frozenset((("quiz", "answer"), ("menu", "quiz"), ("menu", "top_quiz")))
+
+def is_quiz_update(update: Update) -> bool:
+    if update.callback_query is not None:
+        callback = CallbackRouter.parse(update.callback_query.data or "")
+        return (callback.namespace, callback.action) in QUIZ_CALLBACKS
+    message = update.message
+    if message is None or not message.text:
+        return False
+    return message.text.split(maxsplit=1)[0].partition("@")[0].lower() in QUIZ_COMMANDS
+
+def update_shard_key(update: object):
+    if isinstance(update, Update) and update.effective_user is not None and is_quiz_update(update):
+        return update.effective_user.id
+    return update_chat_key(update)
+
+def shard_storage_path(path: str, shard: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+class SharedCacheServer:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data = OrderedDict()  # {key: (expires_at, JSON-байты)}
+
+    def routes(self) -> dict:
+        return {("POST", "/cache/get"): self.handle_get, ("POST", "/cache/set"): self.handle_set}
+
+    async def handle_get(self, request: HttpRequest) -> tuple:
+        key = request.body.decode()
+        item = self.data.get(key)
+        if item is None or item[0] <= monotonic():
+            return 404, "text/plain", b"not found"
+        self.data.move_to_end(key)
+        return 200, "application/json", item[1]
+
+    async def handle_set(self, request: HttpRequest) -> tuple:
+        try:
+            entry = json.loads(request.body)
+            ttl = entry.get("ttl")
+            value = json.dumps(entry["value"], ensure_ascii=False).encode()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, "text/plain", b"bad request"
+        self.data[entry["key"]] = (monotonic() + ttl if ttl else float("inf"), value)
+        self.data.move_to_end(entry["key"])
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+        return 200, "text/plain", b"ok"
+
+# Клиент общего кэша в шарде: ошибки связи с фронтом — это просто промах
+class SharedCacheClient:
+    def __init__(self, url: str):
+        self.url = url
+        self.errors = 0
+
+    async def get(self, key: str):
+        try:
+            response = await http_client.post(f"{self.url}/cache/get", content=key.encode())
+            return response.json() if response.status_code == 200 else None
+        except (httpx.HTTPError, ValueError) as e:
+            self.errors += 1
+            logger.warning("Общий кэш недоступен: %s", e)
+            return None
+
+    async def set(self, key: str, value, ttl: float = None) -> None:
+        try:
+            await http_client.post(f"{self.url}/cache/set",
+                                   content=json.dumps({"key": key, "value": value, "ttl": ttl}, ensure_ascii=False).encode())
+        except httpx.HTTPError as e:
+            self.errors += 1
+            logger.warning("Общий кэш недоступен: %s", e)
+
+class ShardRouter:
+    def __init__(self, urls: list):
+        self.urls = urls  # адреса /updates рабочих процессов
+        self.queues = [asyncio.Queue(UPDATE_BACKLOG) for _ in urls]
+        self.tasks = []
+        self.forwarded = [0] * len(urls)
+        self.dropped = 0
+
+    def start(self) -> None:
+        self.tasks = [asyncio.create_task(self._forward(shard)) for shard in range(len(self.urls))]
+
+    async def stop(self, timeout: float = 10) -> None:
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Фронт: не переслано %d обновлений при остановке", sum(q.qsize() for q in self.queues))
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def route(self, update: Update) -> None:
+        shard = shard_for(update_shard_key(update), len(self.urls))
+        try:
+            self.queues[shard].put_nowait(update.to_dict())
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.error("Фронт: очередь шарда %d переполнена, обновление %s отброшено", shard, update.update_id)
+
+    async def _forward(self, shard: int) -> None:
+        queue, url = self.queues[shard], self.urls[shard]
+        headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET} if WEBHOOK_SECRET else {}
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < SHARD_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            body = json.dumps(batch, ensure_ascii=False).encode()
+            for attempt in range(HTTP_RETRIES + 1):
+                try:
+                    response = await http_client.post(url, content=body, headers=headers)
+                    if response.status_code == 200:
+                        self.forwarded[shard] += len(batch)
+                        break
+                    logger.error("Шард %d ответил %d", shard, response.status_code)
+                except httpx.TransportError as e:
+                    logger.warning("Шард %d недоступен: %s", shard, e)
+                await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+            else:
+                logger.error("Шард %d: потеряно обновлений: %d", shard, len(batch))
+            for _ in batch:
+                queue.task_done()
+
+# Рабочий процесс: обычное приложение со своим файлом хранилища и долей
+# общего лимита отправки; обновления принимает на локальном /updates
+def run_worker(shard: int, conn, cache_url: str) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C обрабатывает фронт
+    asyncio.run(worker_main(shard, conn, cache_url))
+
+async def worker_main(shard: int, conn, cache_url: str) -> None:
+    global http_client, shared_cache, shard_id, STORAGE_PATH, SEND_GLOBAL_RATE, METRICS_PORT
+    shard_id = shard
+    STORAGE_PATH = shard_storage_path(STORAGE_PATH, shard)
+    SEND_GLOBAL_RATE = SEND_GLOBAL_RATE / WORKERS
+    if METRICS_PORT:
+        METRICS_PORT += 1 + shard
+    http_client = create_http_client()
+    shared_cache = SharedCacheClient(cache_url)
+    startup_profile.mark("http client")
+    app = build_application()
+    startup_profile.mark("build application")
+
+    stop_event = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+    server = warm_up_task = None
+    reported = False
+    try:
+        await app.initialize()
+        startup_profile.mark("initialize (getMe)")
+        await on_startup(app)
+        await app.start()
+        startup_profile.mark("start application")
+        server = HttpServer({("POST", "/updates"): make_webhook_handler(app)}, "127.0.0.1", 0, WEBHOOK_MAX_CONNECTIONS)
+        await server.start()
+        conn.send(server.port)
+        reported = True
+        conn.close()
+        startup_profile.mark("start shard server")
+        logger.info("Шард %d запущен (хранилище %s)", shard, STORAGE_PATH)
+        warm_up_task = asyncio.create_task(warm_up(mode="shard", shard=shard))
+        await stop_event.wait()
+    finally:
+        # Фронт ждёт порт; при ошибке запуска вместо него уходит None, и фронт
+        # останавливается, не дожидаясь остальных шардов
+        if not reported:
+            conn.send(None)
+            conn.close()
+        if warm_up_task is not None:
+            warm_up_task.cancel()
+        if server is not None:
+            await server.stop()
+        if app.running:
+            await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
+
+# Ждёт порты всех шардов, проверяя и пайпы, и сами процессы: шард, упавший
+# до отправки порта, или SIGTERM фронту прерывают ожидание (возвращается None)
+async def wait_shard_ports(workers: list, stop_event: asyncio.Event):  # [порт, ...] или None
+    ports = [None] * len(workers)
+    while None in ports:
+        for shard, (process, conn) in enumerate(workers):
+            if ports[shard] is not None:
+                continue
+            if conn.poll():
+                try:
+                    ports[shard] = conn.recv()
+                except EOFError:
+                    pass
+                if ports[shard] is None:
+                    logger.error("Шард %d не запустился", shard)
+                    return None
+            elif not process.is_alive():
+                logger.error("Шард %d завершился при запуске (код %s)", shard, process.exitcode)
+                return None
+        if stop_event.is_set():
+            return None
+        await asyncio.sleep(0.1)
+    return ports
+
+async def run_front() -> None:
+    global http_client
+    http_client = create_http_client()
+    cache_server = HttpServer(SharedCacheServer(SHARED_CACHE_SIZE).routes(), "127.0.0.1", 0)
+    await cache_server.start()
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for shard in range(WORKERS):
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=run_worker, args=(shard, child_conn, f"http://127.0.0.1:{cache_server.port}"),
+                                  name=f"omnibot-shard{shard}")
+        process.start()
+        child_conn.close()  # иначе EOF не придёт, если шард упадёт до отправки порта
+        workers.append((process, parent_conn))
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .build()
+    )
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    router = server = pump = None
+    try:
+        # Шард сообщает порт, когда готов принимать обновления
+        ports = await wait_shard_ports(workers, stop_event)
+        if ports is None:
+            return
+        router = ShardRouter([f"http://127.0.0.1:{port}/updates" for port in ports])
+        router.start()
+        await app.initialize()
+        if BOT_MODE == "webhook":
+            server = HttpServer({("POST", WEBHOOK_PATH): make_webhook_handler(app)},
+                                WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS)
+            await server.start()
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+        else:
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+
+        # Обработчиков во фронте нет: всё из очереди обновлений уходит шардам
+        async def pump_updates():
+            while True:
+                router.route(await app.update_queue.get())
+
+        pump = asyncio.create_task(pump_updates())
+        startup_profile.mark(f"start shards and {BOT_MODE}")
+        logger.info("Фронт запущен (%s), шардов: %d", BOT_MODE, WORKERS)
+        startup_profile.report(mode=BOT_MODE, shard="front")
+        while not stop_event.is_set():
+            try:
+                await asyncio.wait_for(stop_event.wait(), 5)
+            except asyncio.TimeoutError:
+                dead = [process.name for process, _ in workers if not process.is_alive()]
+                if dead:
+                    logger.error("Рабочие процессы завершились: %s — останавливаемся", ", ".join(dead))
+                    break
+    finally:
+        logger.info("Остановка фронта")
+        if server is not None:
+            await server.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        if router is not None:
+            while not app.update_queue.empty():
+                router.route(app.update_queue.get_nowait())
+            if pump is not None:
+                pump.cancel()
+            await router.stop()
+            logger.info("Переслано шардам: %s, отброшено: %d", router.forwarded, router.dropped)
+        for process, _ in workers:
+            process.terminate()
+        await asyncio.gather(*(asyncio.to_thread(process.join, 30) for process, _ in workers))
+        await cache_server.stop()
+        await app.shutdown()
+        await http_client.aclose()
+
+# Жизненный цикл приложения управляется вручную (без run_polling), поэтому
+# nest_asyncio не нужен, а polling и webhook запускаются одинаково.
+async def main() -> None:
+    if WORKERS > 1:
+        await run_front()
+        return
+    global http_client
+    http_client = create_http_client()
+    startup_profile.mark("http client")
+    app = build_application()
+    startup_profile.mark("build application")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    server = warm_up_task = None
+    # Запуск внутри try: при ошибке старта (неверный токен, недоступный
+    # Bot API) HTTP-клиент и хранилище всё равно закрываются
+    try:
+        await app.initialize()
+        startup_profile.mark("initialize (getMe)")
+        await on_startup(app)
+        await app.start()
+        startup_profile.mark("start application")
+        if BOT_MODE == "webhook":
+            server = HttpServer({("POST", WEBHOOK_PATH): make_webhook_handler(app)},
+                                WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS)
+            await server.start()
+            await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS, allowed_updates=Update.ALL_TYPES)
+        else:
+            await app.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        startup_profile.mark(f"start {BOT_MODE}")
+        logger.info("Бот запущен (%s)", BOT_MODE)
+        warm_up_task = asyncio.create_task(warm_up(mode=BOT_MODE))
+        await stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Остановка бота")
+        if warm_up_task is not None:
+            warm_up_task.cancel()
+        if server is not None:
+            await server.stop()
+        if app.updater.running:
+            await app.updater.stop()
+        if app.running:
+            await app.stop()
+        await on_shutdown(app)
+        await app.shutdown()
 
-    logger.info("Бот запущен")
-    await app.run_polling(close_loop=False)
+startup_profile.mark("module init")
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,27 @@
+# Конфигурация main.py читается при импорте, поэтому окружение тестов
+# выставляется здесь, до первого импорта. Внешние API указывают на
+# закрытый порт: тесты не ходят в сеть, ошибки соединения приходят сразу.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_TOKEN = "123456:TEST"
+CLOSED_URL = "http://127.0.0.1:9"
+
+os.environ.update({
+    "BOT_TOKEN": TEST_TOKEN,
+    "OPENWEATHER_API_KEY": "test",
+    "OPENWEATHER_API_URL": CLOSED_URL,
+    "EXCHANGE_API_URL": CLOSED_URL,
+    "COINGECKO_API_URL": CLOSED_URL,
+    "TRANSLATE_API_URL": CLOSED_URL,
+    "WIKIPEDIA_API_URL": CLOSED_URL,
+    "NEWS_FEED_URL": f"{CLOSED_URL}/rss.xml",
+    "STORAGE_BACKEND": "memory",
+    "TRANSLATION_CACHE_PATH": "",
+    "METRICS_PORT": "0",
+    "WARM_UP": "0",
+    "HTTP_RETRIES": "0",
+})
@@ -0,0 +1,71 @@
+# Поддельный Bot API на HttpServer из main.py: записывает вызовы и отвечает
+# как Telegram; ответ на отдельный вызов можно подменить через script.
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+import main
+from conftest import TEST_TOKEN
+
+BOT_METHODS = ("getMe", "setWebhook", "deleteWebhook", "getUpdates", "sendMessage", "editMessageText",
+               "answerCallbackQuery", "sendChatAction")
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = []   # [(метод, параметры, время monotonic)]
+        self.script = {}  # {метод: [ответ Bot API для очередного вызова, ...]}
+        self.delay = 0.0
+        self.server = main.HttpServer({("POST", f"/bot{TEST_TOKEN}/{method}"): self.handle for method in BOT_METHODS},
+                                      "127.0.0.1", 0)
+        self.message_id = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.port}"
+
+    async def __aenter__(self):
+        await self.server.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.stop(timeout=1)
+
+    def called(self, method: str) -> list:
+        return [params for name, params, _ in self.calls if name == method]
+
+    async def wait_for(self, method: str, count: int = 1, timeout: float = 5) -> list:
+        async def poll():
+            while len(self.called(method)) < count:
+                await asyncio.sleep(0.01)
+        await asyncio.wait_for(poll(), timeout)
+        return self.called(method)
+
+    async def handle(self, request):
+        method = request.path.rsplit("/", 1)[1]
+        params = {key: values[0] for key, values in parse_qs(request.body.decode()).items()}
+        self.calls.append((method, params, asyncio.get_running_loop().time()))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        scripted = self.script.get(method)
+        if scripted:
+            payload = scripted.pop(0)
+        elif method == "getMe":
+            payload = {"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "Test", "username": "test_bot"}}
+        elif method in ("sendMessage", "editMessageText"):
+            self.message_id += 1
+            payload = {"ok": True, "result": {"message_id": int(params.get("message_id", self.message_id)), "date": 0,
+                                              "chat": {"id": int(params["chat_id"]), "type": "private"},
+                                              "text": params.get("text", "")}}
+        elif method == "getUpdates":
+            payload = {"ok": True, "result": []}
+        else:
+            payload = {"ok": True, "result": True}
+        status = 200 if payload["ok"] else payload.get("error_code", 400)
+        return status, "application/json", json.dumps(payload).encode()
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {"message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"},
+               "from": {"id": chat_id, "is_bot": False, "first_name": "User"}, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
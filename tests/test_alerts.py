@@ -0,0 +1,101 @@
+# Оповещения о погоде: срабатывают только условия, ставшие истинными с
+# прошлого замера, — пересечение порога в нужную сторону, без повторов.
+import asyncio
+
+import pytest
+
+import main
+
+# (знак, прошлое значение, новое значение, сработавшие пороги) при порогах 0, 10, 20
+CROSSINGS = [
+    (">", 5, 15, [10]),            # пересёк вверх
+    (">", 15, 5, []),              # пересёк вниз — условие «выше» стало ложным
+    (">", 15, 15, []),             # не изменилось
+    (">", 15, 16, []),             # уже было истинным
+    (">", 10, 15, [10]),           # было ровно на пороге — «выше» ещё не выполнялось
+    (">", 5, 10, []),              # дошло ровно до порога — «выше» пока не выполняется
+    (">", -5, 25, [0, 10, 20]),    # скачок через несколько порогов
+    ("<", 15, 5, [10]),            # пересёк вниз
+    ("<", 5, 15, []),              # пересёк вверх — условие «ниже» стало ложным
+    ("<", 5, 5, []),               # не изменилось
+    ("<", 10, 5, [10]),            # было ровно на пороге — «ниже» ещё не выполнялось
+    ("<", 15, 10, []),             # дошло ровно до порога — «ниже» пока не выполняется
+    ("<", 25, -5, [0, 10, 20]),
+]
+
+@pytest.mark.parametrize("op, previous, value, fired", CROSSINGS)
+def test_column_fires_only_on_crossing(op, previous, value, fired):
+    column = main.AlertColumn()
+    for threshold in (20, 0, 10):
+        column.add(threshold, threshold)  # id = порог, чтобы сравнивать наглядно
+    assert sorted(column.rising(op, previous, value)) == fired
+
+def test_column_equal_thresholds_fire_together_and_remove_by_id():
+    column = main.AlertColumn()
+    for alert_id in (1, 2, 3):
+        column.add(10, alert_id)
+    assert sorted(column.rising(">", 5, 15)) == [1, 2, 3]
+    column.remove(10, 2)
+    assert sorted(column.rising(">", 5, 15)) == [1, 3]
+    assert len(column) == 2
+
+class FakePipeline:
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, chat_id, text, **kwargs):
+        self.sent.append(chat_id)
+
+@pytest.fixture
+def watcher(monkeypatch):
+    storage = main.MemoryStorage()
+    monkeypatch.setattr(main, "storage", storage)
+    monkeypatch.setattr(main, "storage_writer", main.StorageWriter(storage))
+    monkeypatch.setattr(main, "send_pipeline", FakePipeline())
+    readings = []  # значения температуры для очередных замеров
+
+    async def measure_place(city, coords, metrics):
+        return {"temp": readings.pop(0)}
+
+    monkeypatch.setattr(main, "measure_place", measure_place)
+    watcher = main.AlertWatcher()
+    watcher.readings = readings
+    return watcher
+
+def run_checks(watcher, *values) -> list:
+    watcher.readings.extend(values)
+    fired = []
+    for _ in values:
+        asyncio.run(watcher.check())
+        fired.append(list(main.send_pipeline.sent))
+        main.send_pipeline.sent.clear()
+    return fired
+
+# (значения замеров, сколько чатов получили оповещение после каждого) для «temp < 0»
+WATCHER_CASES = [
+    ((5, -1), [[], [1]]),               # первый замер — только точка отсчёта
+    ((-5, -10), [[], []]),              # после перезапуска уже ниже — не повторяем
+    ((5, -1, -1, -2), [[], [1], [], []]),  # сработало один раз
+    ((5, -1, 3, -1), [[], [1], [], [1]]),  # вернулось выше и снова пересекло
+    ((5, 0, -0.5), [[], [], [1]]),      # ровно на пороге — ещё не ниже
+]
+
+@pytest.mark.parametrize("values, fired", WATCHER_CASES)
+def test_watcher_after_restart(watcher, values, fired):
+    watcher.load([(7, 1, {"city": "Москва", "metric": "temp", "op": "<", "threshold": 0.0})], next_id=8)
+    assert run_checks(watcher, *values) == fired
+    assert watcher.fired == sum(map(len, fired))
+
+def test_new_alert_compares_with_current_value(watcher):
+    # Условие уже выполняется при создании — оповещение не приходит, пока
+    # значение не выйдет за порог и не пересечёт его снова
+    alert_id = watcher.add(1, "Москва", None, "temp", "<", 0.0, {"temp": -3})
+    assert alert_id == 1
+    assert run_checks(watcher, -4, 2, -1) == [[], [], [1]]
+
+def test_cancelled_alert_does_not_fire(watcher):
+    first = watcher.add(1, "Москва", None, "temp", ">", 20.0, {"temp": 10})
+    watcher.add(2, "Москва", None, "temp", ">", 20.0, {"temp": 10})
+    assert watcher.cancel(1, first)
+    assert not watcher.cancel(2, first)
+    assert run_checks(watcher, 25) == [[2]]
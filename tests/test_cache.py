@@ -0,0 +1,106 @@
+# TTLCache: single-flight, срок жизни, вытеснение по LRU и повтор запроса
+# ожидающими, когда ведущий запрос отменили.
+import asyncio
+
+import pytest
+
+import main
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main, "monotonic", clock)
+    return clock
+
+def counting_fetch(result="value", delay: float = 0.05):
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return f"{result}{len(calls)}"
+    return fetch, calls
+
+def test_concurrent_misses_share_one_fetch():
+    async def scenario():
+        cache = main.TTLCache(60, 10)
+        fetch, calls = counting_fetch()
+        results = await asyncio.gather(*(cache.get_or_fetch("k", fetch) for _ in range(5)))
+        assert results == ["value1"] * 5
+        assert len(calls) == 1
+        assert (cache.misses, cache.coalesced) == (1, 4)
+        assert await cache.get_or_fetch("k", fetch) == "value1"
+        assert cache.hits == 1
+
+    asyncio.run(scenario())
+
+def test_entries_expire_after_ttl(clock):
+    cache = main.TTLCache(60, 10)
+    cache.set("default", 1)
+    cache.set("short", 2, ttl=5)
+    clock.now += 5
+    assert cache.get("short") is None
+    assert cache.get("default") == 1
+    clock.now += 55
+    assert cache.get("default", "gone") == "gone"
+    assert cache.stats()["size"] == 0
+
+def test_expired_entry_is_fetched_again(clock):
+    async def scenario():
+        cache = main.TTLCache(60, 10)
+        fetch, calls = counting_fetch(delay=0)
+        assert await cache.get_or_fetch("k", fetch) == "value1"
+        clock.now += 61
+        assert await cache.get_or_fetch("k", fetch) == "value2"
+        assert len(calls) == 2
+
+    asyncio.run(scenario())
+
+def test_size_is_bounded_least_recently_used_first():
+    cache = main.TTLCache(60, 3)
+    for key in "abc":
+        cache.set(key, key)
+    assert cache.get("a") == "a"  # a становится самым свежим
+    cache.set("d", "d")
+    assert [key for key in "abcd" if cache.get(key) is not None] == ["a", "c", "d"]
+
+@pytest.mark.parametrize("cacheable", [None, lambda value: False])
+def test_failures_and_uncacheable_values_are_not_cached(cacheable):
+    async def scenario():
+        cache = main.TTLCache(60, 10)
+        failing, failed_calls = counting_fetch(RuntimeError("upstream"))
+        waiters = [cache.get_or_fetch("k", failing) for _ in range(3)]
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert len(failed_calls) == 1
+        fetch, calls = counting_fetch(delay=0)
+        assert await cache.get_or_fetch("k", fetch, cacheable) == "value1"
+        assert await cache.get_or_fetch("k", fetch, cacheable) == ("value1" if cacheable is None else "value2")
+
+    asyncio.run(scenario())
+
+def test_waiters_refetch_when_leader_is_cancelled():
+    async def scenario():
+        cache = main.TTLCache(60, 10)
+        fetch, calls = counting_fetch(delay=0.1)
+        leader = asyncio.create_task(cache.get_or_fetch("k", fetch))
+        await asyncio.sleep(0.01)
+        waiters = [asyncio.create_task(cache.get_or_fetch("k", fetch)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        # Отменён только ведущий; один из ожидающих становится новым ведущим
+        assert await asyncio.gather(*waiters) == ["value2"] * 3
+        assert leader.cancelled()
+        assert len(calls) == 2
+        assert cache.get("k") == "value2"
+
+    asyncio.run(scenario())
@@ -0,0 +1,78 @@
+# callback_data: упаковка чисел, лимит Telegram в 64 байта и разбор
+# кнопок, оставшихся в старых сообщениях.
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import main
+
+@pytest.mark.parametrize("values", [(), (0,), (1, 127, 128, 255), (16383, 16384, 2 ** 31), (main.NO_DUE, 2 ** 63)])
+def test_pack_unpack_round_trip(values):
+    payload = main.pack_ints(*values)
+    assert set(payload) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_")
+    assert main.unpack_ints(payload) == values
+
+def test_parse_round_trip():
+    data = main.callback_data("todo", "del", 42, 1, 3, main.NO_DUE, 42)
+    assert main.CallbackRouter.parse(data) == main.Callback("todo", "del", (42, 1, 3, main.NO_DUE, 42))
+    assert main.CallbackRouter.parse("menu:weather") == main.Callback("menu", "weather", ())
+
+def test_largest_buttons_fit_in_64_bytes():
+    # Самая длинная кнопка — удаление задачи: id и курсор страницы (приоритет, срок, id)
+    big_id = 10 ** 9
+    for data in (main.callback_data("todo", "del", big_id, 1, 3, main.NO_DUE, big_id),
+                 main.callback_data("todo", "remove", 1, 3, main.NO_DUE, big_id),
+                 main.callback_data("quiz", "answer", 10 ** 6, 9),
+                 main.callback_data("reminder", "cancel", big_id)):
+        assert len(data.encode()) <= 64
+
+def test_too_long_callback_data_is_refused():
+    with pytest.raises(ValueError):
+        main.callback_data("todo", "del", *[2 ** 63] * 6)
+
+def keyboard_data(markup) -> list:
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+@pytest.mark.parametrize("markup", ["MAIN_MENU_KEYBOARD", "TODO_MENU_KEYBOARD", "SETTINGS_MENU_KEYBOARD",
+                                    "SUBSCRIBE_MENU_KEYBOARD", "SRC_LANGUAGE_KEYBOARD", "TGT_LANGUAGE_KEYBOARD"])
+def test_static_keyboards_fit_and_have_routes(markup):
+    for data in keyboard_data(getattr(main, markup)):
+        assert len(data.encode()) <= 64
+        callback = main.CallbackRouter.parse(data)
+        routes = main.callback_router.routes
+        assert (callback.namespace, callback.action) in routes or (callback.namespace, None) in routes, data
+
+class FakeQuery:
+    def __init__(self, data: str):
+        self.data = data
+        self.message = SimpleNamespace(chat=SimpleNamespace(id=1))
+        self.answers = []
+        self.edits = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+    async def edit_message_text(self, text, **kwargs):
+        self.edits.append(text)
+
+def dispatch(data: str) -> FakeQuery:
+    query = FakeQuery(data)
+    asyncio.run(main.callback_router.dispatch(SimpleNamespace(callback_query=query), None))
+    return query
+
+# Форматы до маршрутизатора: «menu_weather», «src_en», «quiz|3|Париж», «todo_list»
+@pytest.mark.parametrize("data", ["menu_weather", "src_en", "quiz|3|Париж", "todo_list", "", "unknown:action"])
+def test_old_format_buttons_are_answered_as_expired(data):
+    query = dispatch(data)
+    assert query.answers == ["Кнопка устарела. Откройте меню заново: /menu"]
+    assert query.edits == []
+
+@pytest.mark.parametrize("data", ["todo:del:" + main.pack_ints(3), "todo:del:!!!", "todo:del"])
+def test_todo_delete_from_old_or_broken_button_is_refused(data):
+    query = dispatch(data)
+    assert query.answers == [None]
+    assert query.edits == ["Список устарел, откройте его заново: /todo remove"]
+
+def test_broken_payload_parses_without_arguments():
+    assert main.CallbackRouter.parse("quiz:answer:%%%").args == ()
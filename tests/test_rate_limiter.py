@@ -0,0 +1,104 @@
+# OutboundRateLimiter и SendPipeline против поддельного Bot API:
+# приоритет ответов над рассылкой, пауза по RetryAfter, склейка рассылки
+# и какие сетевые ошибки повторяются.
+import asyncio
+
+import pytest
+from telegram.error import TimedOut
+from telegram.ext import ExtBot
+from telegram.request import HTTPXRequest
+
+import main
+from conftest import CLOSED_URL, TEST_TOKEN
+from fakes import FakeBotAPI
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(main, "SEND_GLOBAL_RATE", 5)
+    monkeypatch.setattr(main, "SEND_PER_CHAT_RATE", 1)
+    monkeypatch.setattr(main, "SEND_PER_CHAT_BURST", 3)
+    monkeypatch.setattr(main, "SEND_RETRIES", 3)
+    monkeypatch.setattr(main, "HTTP_BACKOFF", 0.01)
+
+def make_bot(url: str, read_timeout: float = 5) -> ExtBot:
+    return ExtBot(TEST_TOKEN, base_url=f"{url}/bot", request=HTTPXRequest(read_timeout=read_timeout),
+                  rate_limiter=main.OutboundRateLimiter())
+
+def sent_chats(api: FakeBotAPI) -> list:
+    return [int(params["chat_id"]) for params in api.called("sendMessage")]
+
+def test_interactive_replies_overtake_broadcast():
+    async def scenario():
+        async with FakeBotAPI() as api:
+            async with make_bot(api.url) as bot:
+                broadcast = [asyncio.create_task(bot.send_message(chat_id, "news", rate_limit_args=main.PRIORITY_BROADCAST))
+                             for chat_id in range(100, 110)]
+                await asyncio.sleep(0.05)
+                replies = [asyncio.create_task(bot.send_message(chat_id, "reply")) for chat_id in (1, 2, 3)]
+                await asyncio.gather(*broadcast, *replies)
+                assert bot.rate_limiter.delayed["interactive"] == 3
+            # Бакет на 5 сообщений: первые 5 рассылок уходят сразу, ответы
+            # резервируют следующие токены, остальная рассылка ждёт их
+            chats = sent_chats(api)
+            assert chats[:8] == [100, 101, 102, 103, 104, 1, 2, 3]
+            assert sorted(chats[8:]) == [105, 106, 107, 108, 109]
+
+    asyncio.run(scenario())
+
+def test_retry_after_pauses_all_requests():
+    async def scenario():
+        async with FakeBotAPI() as api:
+            api.script["sendMessage"] = [{"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                          "parameters": {"retry_after": 1}}]
+            async with make_bot(api.url) as bot:
+                first = asyncio.create_task(bot.send_message(1, "first"))
+                await api.wait_for("sendMessage")
+                await asyncio.sleep(0.05)
+                await asyncio.gather(first, bot.send_message(2, "second"))
+                assert bot.rate_limiter.retry_after == 1
+            (_, _, rejected_at), *later = [call for call in api.calls if call[0] == "sendMessage"]
+            assert sorted(int(params["chat_id"]) for _, params, _ in later) == [1, 2]
+            assert all(at - rejected_at >= 0.9 for _, _, at in later)
+
+    asyncio.run(scenario())
+
+def test_broadcast_merges_queued_messages(monkeypatch):
+    monkeypatch.setattr(main, "SEND_MERGE", True)
+
+    async def scenario():
+        async with FakeBotAPI() as api:
+            async with make_bot(api.url) as bot:
+                pipeline = main.SendPipeline(bot)
+                for text in ("a", "b", "c"):
+                    pipeline.submit(1, text)
+                pipeline.submit(2, "other")
+                pipeline.submit(1, "html", parse_mode="HTML")  # другие параметры — отдельное сообщение
+                pipeline.start()
+                await pipeline.stop()
+            assert pipeline.merged == 2
+            assert sorted((int(params["chat_id"]), params["text"]) for params in api.called("sendMessage")) == [
+                (1, "a\n\nb\n\nc"), (1, "html"), (2, "other")]
+
+    asyncio.run(scenario())
+
+def test_timed_out_send_is_not_repeated():
+    async def scenario():
+        async with FakeBotAPI() as api:
+            async with make_bot(api.url, read_timeout=0.2) as bot:
+                api.delay = 0.5
+                with pytest.raises(TimedOut):
+                    await bot.send_message(1, "maybe delivered")
+                assert bot.rate_limiter.retries == 0
+            assert len(api.called("sendMessage")) == 1
+
+    asyncio.run(scenario())
+
+def test_unsent_request_is_repeated():
+    async def scenario():
+        bot = make_bot(CLOSED_URL)
+        with pytest.raises(main.NetworkError):
+            await bot.send_message(1, "never left")
+        assert bot.rate_limiter.retries == main.SEND_RETRIES - 1
+        await bot.shutdown()
+
+    asyncio.run(scenario())
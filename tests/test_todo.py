@@ -0,0 +1,134 @@
+# Задачи: номера из старого формата хранения, id без повторов после
+# перезапуска, постраничный вывод при удалениях и разбор номеров.
+import asyncio
+import random
+import sqlite3
+from collections import OrderedDict
+
+import pytest
+
+import main
+
+def test_legacy_positions_keep_visible_numbers(tmp_path):
+    # Старая схема: список с позициями с нуля, пользователь видел «1.», «2.», …
+    path = str(tmp_path / "legacy.db")
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE todo_tasks (chat_id INTEGER NOT NULL, position INTEGER NOT NULL, "
+                   "text TEXT NOT NULL, PRIMARY KEY (chat_id, position)) WITHOUT ROWID")
+        db.executemany("INSERT INTO todo_tasks VALUES (?, ?, ?)",
+                       [(1, 0, "первая"), (1, 1, "вторая"), (1, 2, "третья"), (2, 0, "другой чат")])
+    db.close()
+    for _ in range(2):  # повторное открытие ничего не меняет
+        storage = main.SQLiteStorage(path)
+        assert sorted(storage.load_tasks(1)) == [(1, "первая", 2, None, None), (2, "вторая", 2, None, None),
+                                                 (3, "третья", 2, None, None)]
+        assert storage.load_tasks(2) == [(1, "другой чат", 2, None, None)]
+        storage.close()
+    todo = main.TodoList(main.SQLiteStorage(path).load_tasks(1))
+    tasks, _, _ = todo.page(10)
+    assert [(task_id, task.text) for task_id, task in tasks] == [(1, "первая"), (2, "вторая"), (3, "третья")]
+    assert todo.add("четвёртая") == 4
+
+def open_storage(monkeypatch, path: str) -> main.StorageWriter:
+    storage = main.SQLiteStorage(path)
+    writer = main.StorageWriter(storage)
+    monkeypatch.setattr(main, "storage", storage)
+    monkeypatch.setattr(main, "storage_writer", writer)
+    monkeypatch.setattr(main, "chat_states", OrderedDict())
+    return writer
+
+def test_ids_not_reused_after_restart(tmp_path, monkeypatch):
+    path = str(tmp_path / "tasks.db")
+    writer = open_storage(monkeypatch, path)
+    todo = main.get_tasks(1)
+    assert [todo.add(text) for text in ("а", "б", "в")] == [1, 2, 3]
+    todo.remove(3)  # удалена последняя — её id не должен достаться новой задаче
+    main.save_tasks(1)
+    asyncio.run(writer.stop())
+
+    writer = open_storage(monkeypatch, path)
+    todo = main.get_tasks(1)
+    assert sorted(todo.tasks) == [1, 2]
+    assert todo.add("г") == 4
+    todo.remove(1)
+    todo.remove(2)
+    todo.remove(4)
+    main.save_tasks(1)
+    asyncio.run(writer.stop())
+
+    writer = open_storage(monkeypatch, path)
+    assert len(main.get_tasks(1)) == 0
+    assert main.get_tasks(1).add("д") == 5
+    assert main.get_tasks(2).add("другой чат") == 1
+    asyncio.run(writer.stop())
+
+def sorted_keys(todo: main.TodoList) -> list:
+    return sorted(todo.key(task_id) for task_id in todo.tasks)
+
+# Ожидаемая страница, посчитанная перебором: с ключа start или, если там
+# пусто, последняя полная страница перед ним
+def expected_page(todo: main.TodoList, size: int, start: tuple = None) -> list:
+    keys = sorted_keys(todo)
+    page = [key for key in keys if start is None or key >= start][:size]
+    if not page and start is not None and keys:
+        return expected_page_before(todo, size, start)
+    return page
+
+def expected_page_before(todo: main.TodoList, size: int, before: tuple) -> list:
+    earlier = [key for key in sorted_keys(todo) if key < before]
+    return earlier[-size:] if len(earlier) >= size else sorted_keys(todo)[:size]
+
+def check_page(todo: main.TodoList, size: int, result: tuple, expected: list) -> tuple:
+    tasks, has_prev, next_key = result
+    assert [todo.key(task_id) for task_id, _ in tasks] == expected
+    keys = sorted_keys(todo)
+    assert has_prev == (bool(expected) and keys[0] < expected[0])
+    later = [key for key in keys if expected and key > expected[-1]]
+    assert next_key == (later[0] if later else None)
+    return expected[0] if expected else None, has_prev, next_key
+
+@pytest.mark.parametrize("seed", range(5))
+def test_paging_forward_and_back_across_deletes(seed):
+    rng = random.Random(seed)
+    size = 5
+    todo = main.TodoList()
+    for i in range(40):
+        todo.add(f"задача {i}", rng.choice((1, 2, 3)), rng.choice((None, 1000, 2000, 3000)))
+    start, has_prev, next_key = check_page(todo, size, todo.page(size), expected_page(todo, size))
+    for _ in range(200):
+        action = rng.choice(("next", "prev", "delete", "delete", "add"))
+        if action == "next" and next_key is not None:
+            result, expected = todo.page(size, start=next_key), expected_page(todo, size, next_key)
+        elif action == "prev" and has_prev:
+            result, expected = todo.page(size, before=start), expected_page_before(todo, size, start)
+        elif action == "delete" and todo.tasks:
+            # Удаляем с текущей страницы, включая её первую задачу, или где угодно
+            for _ in range(rng.randint(1, 3)):
+                if todo.tasks:
+                    todo.remove(rng.choice(list(todo.tasks)))
+            result, expected = todo.page(size, start=start), expected_page(todo, size, start)
+        elif action == "add":
+            todo.add("новая", rng.choice((1, 2, 3)), rng.choice((None, 1500)))
+            result, expected = todo.page(size, start=start), expected_page(todo, size, start)
+        else:
+            continue
+        start, has_prev, next_key = check_page(todo, size, result, expected)
+        if not todo.tasks:
+            break
+
+@pytest.mark.parametrize("spec, expected", [
+    ("3", [3]),
+    ("#3", [3]),
+    ("1-3,8", [1, 2, 3, 8]),
+    ("#2-#4", [2, 3, 4]),
+    ("1, 3", [1, 3]),
+    ("1,,3,", [1, 3]),
+    ("2-99999999999", [2, 3, 4, 5, 6, 7, 8, 9, 10]),  # диапазон обрезается по последнему id
+    ("42", []),
+])
+def test_parse_task_ids(spec, expected):
+    assert main.parse_task_ids(spec, 10) == expected
+
+@pytest.mark.parametrize("spec", ["abc", "3-1", "1-", "-2", "1--3", "#", "1-2-3", "1;2", "½", "1.5"])
+def test_parse_task_ids_rejects_bad_input(spec):
+    assert main.parse_task_ids(spec, 10) is None
@@ -0,0 +1,56 @@
+# split_text: лимит фрагмента — в байтах UTF-8 (MyMemory принимает до 500),
+# а не в символах; склейка фрагментов с разделителями даёт исходный текст.
+import pytest
+
+import main
+
+LIMIT = 450
+
+def reassemble(chunks: list) -> str:
+    return "".join(chunk + sep for chunk, sep in chunks).strip()
+
+def assert_fits(chunks: list, limit: int = LIMIT) -> None:
+    assert chunks
+    assert all(chunk and len(chunk.encode()) <= limit for chunk, _ in chunks)
+
+@pytest.mark.parametrize("sentence", [
+    "Съешь же ещё этих мягких французских булок, да выпей чаю.",  # кириллица — 2 байта на букву
+    "東京は日本の首都です。人口は非常に多いです!",                     # иероглифы — 3 байта
+    "Погода 🌧️ сегодня дождливая, возьмите зонт 🙂.",                 # эмодзи — 4 байта
+    "Short English sentence number one.",
+])
+def test_multibyte_text_is_split_by_bytes(sentence):
+    text = " ".join([sentence] * 40)
+    chunks = main.split_text(text, LIMIT)
+    assert_fits(chunks)
+    assert reassemble(chunks) == text
+    if len(sentence.encode()) > len(sentence):
+        # В символах фрагменты заметно короче лимита — резали бы по байтам
+        assert max(len(chunk) for chunk, _ in chunks) < LIMIT
+
+def test_separators_between_sentences_are_kept():
+    text = "Первое предложение.  Второе!\nТретье?\n\nЧетвёртое… Пятое."
+    chunks = main.split_text(text, 40)
+    assert_fits(chunks, 40)
+    assert reassemble(chunks) == text
+    # Предложения собираются во фрагменты до лимита; пробелы и переводы
+    # строк между ними сохраняются как были
+    assert chunks == [("Первое предложение.", "  "), ("Второе!\nТретье?", "\n\n"), ("Четвёртое… Пятое.", "")]
+
+def test_short_text_is_one_chunk():
+    assert main.split_text("Привет, мир.", LIMIT) == [("Привет, мир.", "")]
+
+def test_long_sentence_is_cut_at_spaces():
+    sentence = " ".join(["слово"] * 200)  # 2199 байт без единой точки
+    chunks = main.split_text(sentence, LIMIT)
+    assert len(chunks) > 1
+    assert_fits(chunks)
+    assert all(not chunk.startswith(" ") and not chunk.endswith(" ") for chunk, _ in chunks)
+    assert reassemble(chunks) == sentence
+
+def test_word_longer_than_limit_is_cut_on_character_boundary():
+    word = "щ" * 300 + "🙂" * 100  # 1000 байт без пробелов
+    chunks = main.split_text(word, LIMIT)
+    assert_fits(chunks)
+    # Склеиваются без пробелов-разделителей, которые добавила нарезка
+    assert "".join(chunk for chunk, _ in chunks) == word
@@ -0,0 +1,91 @@
+# Webhook-режим целиком: main() поднимает бота против поддельного Bot API,
+# обновления приходят POST-запросами на HttpServer, остановка — по SIGTERM.
+import asyncio
+import json
+import os
+import signal
+import socket
+
+import httpx
+import pytest
+from telegram.error import InvalidToken
+
+import main
+from fakes import FakeBotAPI, message_update
+
+SECRET = "s3cret"
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def webhook_config(monkeypatch):
+    port = free_port()
+    monkeypatch.setattr(main, "BOT_MODE", "webhook")
+    monkeypatch.setattr(main, "WEBHOOK_LISTEN", "127.0.0.1")
+    monkeypatch.setattr(main, "WEBHOOK_PORT", port)
+    monkeypatch.setattr(main, "WEBHOOK_SECRET", SECRET)
+    monkeypatch.setattr(main, "WEBHOOK_URL", "https://bot.example/telegram")
+    return f"http://127.0.0.1:{port}{main.WEBHOOK_PATH}"
+
+async def post_raw(port: int, head: str) -> bytes:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(head.encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response
+
+def test_webhook_updates_and_graceful_stop(webhook_config, monkeypatch):
+    async def scenario():
+        async with FakeBotAPI() as api:
+            monkeypatch.setattr(main, "TELEGRAM_API_URL", api.url)
+            bot = asyncio.create_task(main.main())
+            [registered] = await api.wait_for("setWebhook")
+            assert registered["url"] == "https://bot.example/telegram"
+            assert registered["secret_token"] == SECRET
+
+            async with httpx.AsyncClient() as client:
+                ok = await client.post(webhook_config, json=message_update(1, 42, "/start"),
+                                       headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+                forbidden = await client.post(webhook_config, json=message_update(2, 43, "/start"),
+                                              headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+                malformed = await client.post(webhook_config, content=b"{not json",
+                                              headers={"X-Telegram-Bot-Api-Secret-Token": SECRET})
+            assert (ok.status_code, forbidden.status_code, malformed.status_code) == (200, 403, 400)
+            oversized = await post_raw(main.WEBHOOK_PORT,
+                                       f"POST {main.WEBHOOK_PATH} HTTP/1.1\r\nHost: test\r\n"
+                                       f"X-Telegram-Bot-Api-Secret-Token: {SECRET}\r\n"
+                                       f"Content-Length: {main.HTTP_MAX_BODY + 1}\r\n\r\n")
+            assert oversized.startswith(b"HTTP/1.1 413")
+
+            [reply] = await api.wait_for("sendMessage")
+            assert reply["chat_id"] == "42"
+            samples = [line for line in main.metrics.render().splitlines() if not line.startswith("#")]
+            assert any(line.startswith("omnibot_jobqueue_jobs") for line in samples)
+            assert len(samples) == len(set(samples))  # коллектор не зарегистрирован повторно
+            await asyncio.sleep(0.2)
+            assert [params["chat_id"] for params in api.called("sendMessage")] == ["42"]
+
+            os.kill(os.getpid(), signal.SIGTERM)
+            await asyncio.wait_for(bot, 10)
+            assert "omnibot_jobqueue_jobs" not in main.metrics.render()
+            assert main.http_client.is_closed
+            with pytest.raises(OSError):
+                await asyncio.open_connection("127.0.0.1", main.WEBHOOK_PORT)
+
+    asyncio.run(scenario())
+
+def test_failed_startup_closes_resources(webhook_config, monkeypatch):
+    async def scenario():
+        async with FakeBotAPI() as api:
+            monkeypatch.setattr(main, "TELEGRAM_API_URL", api.url)
+            api.script["getMe"] = [{"ok": False, "error_code": 401, "description": "Unauthorized"}]
+            with pytest.raises(InvalidToken):
+                await asyncio.wait_for(main.main(), 10)
+            assert main.http_client.is_closed
+            assert not api.called("setWebhook")
+
+    asyncio.run(scenario())